@@ -11,19 +11,50 @@ import math
 import subprocess
 import webbrowser
 import hashlib
+import html as html_lib
 import unicodedata  # 正規化用
 import importlib
 import json  # JSON書き出し用
+import concurrent.futures
+import bisect
+import mmap
+import io
+import struct
+import zipfile
+import zlib
+import itertools
+import mimetypes
+import urllib.parse
+import argparse
+import shutil
+import hmac
+import select
+import ctypes
+import ctypes.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array  # 分割インデックス（オフセット列）をコンパクトに保持
 
 # ==========================================
 # 0. ライブラリ読み込み (堅牢な環境判定版)
 # ==========================================
+def _headless(argv) -> bool:
+    """--serve / --watch で起動されたら画面を作らない。"""
+    return any(a == "--serve" or a == "--watch" or a.startswith("--watch=") for a in argv)
+
+
+# --stub-analyzer（または環境変数 YOMITOKU_STUB_ANALYZER=1）では OCR モデルを使わないので、
+# YomiToku・torch・OpenCV・NumPy・pyperclip がなくても起動できるようにする（動作確認・テスト用）
+STUB_ANALYZER = "--stub-analyzer" in sys.argv[1:] or os.environ.get("YOMITOKU_STUB_ANALYZER") == "1"
+STUB_OPTIONAL_LIBS = ("cv2", "numpy", "pyperclip", "torch", "yomitoku")
+
 MISSING_LIBS = []
 import_error_detail = ""
 
 
 def get_yomitoku_requirements():
     """環境に合わせて必要なyomitoku関連パッケージを返す"""
+    if STUB_ANALYZER:
+        return ["yomitoku", "onnxruntime"]  # CUDA の確認に torch を読み込まない
     try:
         import torch
         if torch.cuda.is_available():
@@ -40,6 +71,8 @@ def safe_import(module_name, pip_packages):
     try:
         return importlib.import_module(module_name)
     except ImportError:
+        if STUB_ANALYZER and module_name in STUB_OPTIONAL_LIBS:
+            return None
         pkgs = [pip_packages] if isinstance(pip_packages, str) else pip_packages
         for pkg in pkgs:
             if pkg not in MISSING_LIBS:
@@ -66,19 +99,24 @@ yomitoku = safe_import("yomitoku", yomitoku_pkgs)
 if not MISSING_LIBS:
     try:
         from pdf2image import convert_from_path, pdfinfo_from_path
-        from yomitoku import DocumentAnalyzer
         from ebooklib import epub
-        from PIL import Image, ImageTk
+        from PIL import Image, ImageOps, ImageTk
     except Exception as e:
         import_error_detail += f"\n[Sub-module Import]: {str(e)}"
-        for lib in ["pdf2image", "EbookLib", "Pillow"] + yomitoku_pkgs:
+        for lib in ["pdf2image", "EbookLib", "Pillow"]:
             if lib not in MISSING_LIBS:
                 MISSING_LIBS.append(lib)
+    try:
+        from yomitoku import DocumentAnalyzer
+    except Exception as e:
+        DocumentAnalyzer = None
+        if not STUB_ANALYZER:
+            import_error_detail += f"\n[Sub-module Import]: {str(e)}"
+            for lib in yomitoku_pkgs:
+                if lib not in MISSING_LIBS:
+                    MISSING_LIBS.append(lib)
 
 if MISSING_LIBS:
-    root = tk.Tk()
-    root.withdraw()
-
     libs_unique = sorted(list(set(MISSING_LIBS)))
     install_cmd = f"pip install " + " ".join(libs_unique)
 
@@ -89,6 +127,12 @@ if MISSING_LIBS:
         "※ GPUを使用する場合はCUDAの設定が必要です。\n"
         f"▼ 詳細:\n{import_error_detail}"
     )
+    if _headless(sys.argv[1:]):
+        # サービスモード・フォルダ監視は画面を出さない
+        print(error_message, file=sys.stderr)
+        sys.exit(1)
+    root = tk.Tk()
+    root.withdraw()
     messagebox.showerror("起動失敗", error_message)
     sys.exit(1)
 
@@ -98,6 +142,2335 @@ MAX_LOG_LINES = 1000
 # Popplerのデフォルトパス（Windows想定）
 DEFAULT_POPPLER_PATH = r"C:\poppler\Library\bin"
 
+
+# ==========================================
+# 分割サイズ計算（Tab2-1 のサイズ均等・上限指定モード）
+# ==========================================
+# 分割モード（表示名 -> 内部キー）
+SPLIT_MODE_LABELS = {
+    "ブロック数で均等（従来）": "blocks",
+    "サイズ均等（最大チャンク最小化）": "balanced",
+    "上限Bytesで分割": "max_bytes",
+    "上限トークン（推定）で分割": "max_tokens",
+}
+
+# 推定トークン：日本語（非ASCII）は1文字≒1トークン、ASCIIは4文字≒1トークンとして概算する
+# （LLM側の実トークン数よりやや多めに出る＝上限超過を起こしにくい側に倒す）
+TOKEN_PER_NON_ASCII_CHAR = 1.0
+ASCII_CHARS_PER_TOKEN = 4.0
+
+
+def estimate_tokens_ja(text: str) -> int:
+    """日本語テキストのトークン数を高速に概算する（外部ライブラリ不要）。"""
+    if not text:
+        return 0
+    n_ascii = len(text.encode("ascii", "ignore"))
+    n_other = len(text) - n_ascii
+    return int(math.ceil(n_other * TOKEN_PER_NON_ASCII_CHAR + n_ascii / ASCII_CHARS_PER_TOKEN))
+
+
+def _partition_greedy(sizes, cap):
+    """先頭から cap を超えない範囲で詰め込み、各グループの開始インデックスを返す。"""
+    starts = [0] if sizes else []
+    acc = 0
+    for i, s in enumerate(sizes):
+        if acc > 0 and acc + s > cap:
+            starts.append(i)
+            acc = 0
+        acc += s
+    return starts
+
+
+def partition_min_max(sizes, parts: int):
+    """連続ブロック列を parts 個以下に分け、最大グループサイズが最小になる開始位置を返す。
+
+    最大サイズを二分探索し、貪欲詰めで parts 個以内に収まるかを判定する（O(n log S)）。
+    """
+    if not sizes:
+        return []
+    parts = max(1, min(int(parts), len(sizes)))
+    lo = max(sizes)
+    hi = sum(sizes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(_partition_greedy(sizes, mid)) <= parts:
+            hi = mid
+        else:
+            lo = mid + 1
+    return _partition_greedy(sizes, lo)
+
+
+def partition_by_budget(sizes, max_size: int):
+    """1グループが max_size 以下になる最小グループ数で、最大グループが最小になる開始位置を返す。
+
+    max_size を単独で超えるブロックは分割できないため、そのブロックだけで1グループとする。
+    その間にあるブロックの並びは、それぞれ別に詰める（超過ブロックの大きさに引っぱられて、
+    ほかのグループまで max_size を超えないように）。
+    """
+    if not sizes:
+        return []
+    max_size = max(1, int(max_size))
+    starts = []
+    run_start = 0
+    for i in itertools.chain((i for i, s in enumerate(sizes) if s > max_size), [len(sizes)]):
+        if run_start < i:
+            run = sizes[run_start:i]
+            n_parts = len(_partition_greedy(run, max_size))
+            starts.extend(run_start + k for k in partition_min_max(run, n_parts))
+        if i < len(sizes):
+            starts.append(i)
+        run_start = i + 1
+    return starts
+
+
+class MarkdownBlockIndex:
+    """見出し行の位置・レベルと、各位置までの累積値（Bytes/ASCII文字数/改行数）を保持する。
+
+    見出しレベルや分割数を変えても、テキストを再走査せずにブロック境界とサイズを求められる。
+    """
+
+    _HEADING_RE = re.compile(r"(?m)^(#{1,6})\s")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.length = len(text)
+        self.head_offsets = array("q")
+        self.head_levels = array("b")
+        # 累積値は「区切り候補位置（0, 各見出し, 末尾）」ごとに持つ
+        self._pos = array("q", [0])
+        self._bytes = array("q", [0])
+        self._ascii = array("q", [0])
+        self._newlines = array("q", [0])
+        self._pos_to_k = {0: 0}
+
+        for m in self._HEADING_RE.finditer(text):
+            self.head_offsets.append(m.start())
+            self.head_levels.append(len(m.group(1)))
+            self._add_point(m.start())
+        self._add_point(self.length)
+
+    def _add_point(self, off: int):
+        prev = self._pos[-1]
+        if off <= prev:
+            return
+        seg = self.text[prev:off]
+        self._pos.append(off)
+        self._bytes.append(self._bytes[-1] + len(seg.encode("utf-8")))
+        self._ascii.append(self._ascii[-1] + len(seg.encode("ascii", "ignore")))
+        self._newlines.append(self._newlines[-1] + seg.count("\n"))
+        self._pos_to_k[off] = len(self._pos) - 1
+
+    def block_bounds(self, header_level: int):
+        """header_level 以下の見出しで区切ったブロック境界（先頭0・末尾lengthを含む）を返す。"""
+        if self.length == 0:
+            return []
+        cuts = [0]
+        for off, lv in zip(self.head_offsets, self.head_levels):
+            if lv <= header_level and off > 0:
+                cuts.append(off)
+        cuts.append(self.length)
+        return cuts
+
+    def measure(self, start: int, end: int):
+        """区切り候補位置 start..end の (bytes, lines, chars, tokens) を累積値から求める。"""
+        k0 = self._pos_to_k[start]
+        k1 = self._pos_to_k[end]
+        chars = end - start
+        n_ascii = self._ascii[k1] - self._ascii[k0]
+        tokens = 0
+        if chars:
+            tokens = int(math.ceil((chars - n_ascii) * TOKEN_PER_NON_ASCII_CHAR + n_ascii / ASCII_CHARS_PER_TOKEN))
+        lines = (self._newlines[k1] - self._newlines[k0] + 1) if chars else 0
+        return self._bytes[k1] - self._bytes[k0], lines, chars, tokens
+
+
+class SplitPlanCache:
+    """Tab2-1 のテスト／分割実行／JSON書き出しで共有する分割案キャッシュ。
+
+    入力ファイルは (パス, サイズ, mtime, SHA256) で識別し、変更されていれば自動で読み直す。
+    分割案は (ファイル識別, 分割数, 見出しレベル, 出力先, 分割方法, 上限値) ごとに保持する。
+    """
+
+    def __init__(self):
+        self._path = None
+        self._stat = None
+        self._sha256 = None
+        self._index = None
+        self._plans = {}
+
+    def get_index(self, src_path: str):
+        """最新の MarkdownBlockIndex と、ファイル識別キーを返す。"""
+        path = os.path.abspath(src_path)
+        st = os.stat(path)
+        stat_key = (st.st_size, st.st_mtime_ns)
+        if path == self._path and stat_key == self._stat and self._index is not None:
+            return self._index, self.file_key()
+
+        with open(path, "rb") as f:
+            data = f.read()
+        sha = hashlib.sha256(data).hexdigest()
+        if path != self._path or sha != self._sha256 or self._index is None:
+            # 読み込みは従来どおりユニバーサル改行（CRLF/CR -> LF）
+            text = data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+            self._index = MarkdownBlockIndex(text)
+            self._plans = {}
+        self._path = path
+        self._stat = stat_key
+        self._sha256 = sha
+        return self._index, self.file_key()
+
+    def file_key(self):
+        if self._path is None:
+            return None
+        return (self._path, self._stat[0], self._stat[1], self._sha256)
+
+    def get_plan(self, key):
+        return self._plans.get(key)
+
+    def put_plan(self, key, plan):
+        self._plans[key] = plan
+
+
+# ==========================================
+# バックグラウンド処理（分割テスト/分割実行などを UI スレッド外で実行）
+# ==========================================
+class TaskCancelled(Exception):
+    """バックグラウンド処理がキャンセル要求で中断したことを示す。"""
+
+
+class TaskProgress:
+    """ワーカースレッドから進捗を報告し、キャンセル要求を確認するための窓口。
+
+    report() は min_interval 秒に1回まで間引いて report_fn(text, done, total, unit) を呼ぶ（UI への投げすぎ防止）。
+    """
+
+    def __init__(self, report_fn, min_interval: float = 0.1):
+        self.cancel_event = threading.Event()
+        self._report_fn = report_fn
+        self._min_interval = min_interval
+        self._last = 0.0
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise TaskCancelled()
+
+    def report(self, text: str, force: bool = False, done=None, total=None, unit: str = ""):
+        """done / total は処理量（unit="bytes" ならバイト数、それ以外は unit 単位の件数）。速度の表示に使う。"""
+        self.check()
+        now = time.monotonic()
+        if force or now - self._last >= self._min_interval:
+            self._last = now
+            self._report_fn(text, done, total, unit)
+
+
+def format_bytes(n: int) -> str:
+    """進捗表示用の簡易サイズ表記。"""
+    if n >= 1024 * 1024:
+        return f"{n / (1024 * 1024):,.1f} MB"
+    return f"{n / 1024:,.1f} KB"
+
+
+# ==========================================
+# ジョブ管理（全タブ共通のスレッドプール。進捗と状態の変化はイベントで UI へ）
+# ==========================================
+JOB_MAX_WORKERS = 4  # 同時に動かすジョブの数（同じタブの処理は重ねない）
+JOB_HISTORY = 50  # 一覧に残す終了済みジョブの数
+
+JOB_QUEUED = "待機中"
+JOB_RUNNING = "実行中"
+JOB_DONE = "完了"
+JOB_FAILED = "失敗"
+JOB_CANCELLED = "キャンセル"
+
+
+class JobEvent:
+    """ジョブの状態変化（kind="state"）または進捗（kind="progress"）。state はイベント発生時の状態。"""
+
+    __slots__ = ("job", "kind", "state", "text", "done", "total", "unit")
+
+    def __init__(self, job, kind: str, text: str = "", done=None, total=None, unit: str = ""):
+        self.job = job
+        self.kind = kind
+        self.state = job.state
+        self.text = text
+        self.done = done
+        self.total = total
+        self.unit = unit
+
+
+class Job:
+    """ジョブ管理に登録された1件の処理と、その最新の状態・進捗。"""
+
+    def __init__(self, job_id: int, title: str, slot, on_done=None, on_error=None, on_event=None):
+        self.id = job_id
+        self.title = title
+        self.slot = slot
+        self.state = JOB_QUEUED
+        self.text = ""
+        self.done = None
+        self.total = None
+        self.unit = ""
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_event = on_event
+        self.progress = None
+        self.future = None
+
+    @property
+    def active(self) -> bool:
+        return self.state in (JOB_QUEUED, JOB_RUNNING)
+
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def rate(self):
+        """1秒あたりの処理量（done を報告していなければ None）。"""
+        t = self.elapsed()
+        if self.done is None or t <= 0:
+            return None
+        return self.done / t
+
+
+class JobManager:
+    """全タブ共通のジョブ実行。スレッドプールで同時に動かし、状態と進捗を JobEvent で知らせる。
+
+    post(fn) は fn を UI スレッドで呼ぶ関数（Tk では root.after(0, fn)）。購読者と各ジョブの
+    on_done / on_error / on_event は post 経由で呼ぶ。slot が同じジョブは同時に1本だけ
+    （同じタブの状態を触る処理が重ならないように）。
+    """
+
+    def __init__(self, post, max_workers: int = JOB_MAX_WORKERS):
+        self._post = post
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._next_id = 1
+        self._subscribers = []
+
+    def subscribe(self, fn):
+        """fn(JobEvent) を全ジョブのイベントで呼ぶ。"""
+        self._subscribers.append(fn)
+
+    def jobs(self) -> list:
+        with self._lock:
+            return list(self._jobs)
+
+    def active(self, slot):
+        """slot で実行中・待機中のジョブ（なければ None）。"""
+        with self._lock:
+            return next((j for j in self._jobs if j.active and j.slot == slot), None)
+
+    def submit(self, title: str, work, on_done=None, on_error=None, on_event=None, slot=None):
+        """work(progress) をジョブとして登録する。同じ slot のジョブが動いていれば None を返す。"""
+        with self._lock:
+            if slot is not None and any(j.active and j.slot == slot for j in self._jobs):
+                return None
+            job = Job(self._next_id, title, slot, on_done, on_error, on_event)
+            self._next_id += 1
+            self._jobs.append(job)
+            finished = [j for j in self._jobs if not j.active]
+            for old in finished[: max(0, len(finished) - JOB_HISTORY)]:
+                self._jobs.remove(old)
+        job.progress = TaskProgress(lambda *args: self._report(job, *args))
+        event = JobEvent(job, "state")
+        self._post(lambda: self._dispatch(event))
+        job.future = self._executor.submit(self._run, job, work)
+        return job
+
+    def cancel(self, job: Job):
+        if not job.active:
+            return
+        job.progress.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            # まだ始まっていなかった
+            job.finished = time.monotonic()
+            self._post(lambda: self._finish(job, JOB_CANCELLED, None))
+
+    def cancel_slot(self, slot):
+        job = self.active(slot)
+        if job is not None:
+            self.cancel(job)
+
+    def clear_finished(self):
+        with self._lock:
+            self._jobs = [j for j in self._jobs if j.active]
+
+    def shutdown(self):
+        for job in self.jobs():
+            if job.active:
+                job.progress.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # ---- 内部 ----
+    def _report(self, job: Job, text: str, done, total, unit: str):
+        job.text = text
+        if done is not None:
+            job.done, job.total, job.unit = done, total, unit
+        event = JobEvent(job, "progress", text, done, total, unit)
+        self._post(lambda: self._dispatch(event))
+
+    def _run(self, job: Job, work):
+        job.started = time.monotonic()
+        job.state = JOB_RUNNING
+        event = JobEvent(job, "state")
+        self._post(lambda: self._dispatch(event))
+        try:
+            job.progress.check()
+            result = work(job.progress)
+        except TaskCancelled:
+            state, result = JOB_CANCELLED, None
+        except Exception as e:
+            state, result = JOB_FAILED, e
+        else:
+            state = JOB_DONE
+        job.finished = time.monotonic()
+        self._post(lambda: self._finish(job, state, result))
+
+    def _finish(self, job: Job, state: str, result):
+        # 状態は UI スレッドで切り替え、on_done より前に同じタブの次のジョブを受け付けないようにする
+        job.state = state
+        self._dispatch(JobEvent(job, "state"))
+        if state == JOB_DONE and job.on_done is not None:
+            job.on_done(result)
+        elif state == JOB_FAILED and job.on_error is not None:
+            job.on_error(result)
+
+    def _dispatch(self, event: JobEvent):
+        for fn in list(self._subscribers):
+            fn(event)
+        if event.job.on_event is not None:
+            event.job.on_event(event)
+
+
+# ==========================================
+# テキストビューア（行オフセット索引で表示範囲だけ読み込む）
+# ==========================================
+VIEWER_WINDOW_LINES = 600  # Text ウィジェットへ一度に読み込む行数
+VIEWER_EDGE_FRACTION = 0.15  # 読み込み範囲の端からこの割合に入ったら範囲をずらす
+_UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+
+class StringLineSource:
+    """文字列を行単位で切り出す（行頭の文字オフセット列を保持）。"""
+
+    def __init__(self, text: str):
+        self.text = text
+        starts = array("q", [0])
+        find = text.find
+        pos = find("\n")
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = find("\n", pos + 1)
+        self._starts = starts
+        self.line_count = len(starts)
+        self.char_length = len(text)
+
+    def get_lines(self, first: int, last: int) -> str:
+        end = self._starts[last] if last < self.line_count else self.char_length
+        return self.text[self._starts[first] : end]
+
+    def locate_char(self, offset: int):
+        """文字オフセット → (行, 桁)"""
+        offset = max(0, min(int(offset), self.char_length))
+        line = bisect.bisect_right(self._starts, offset) - 1
+        return line, offset - self._starts[line]
+
+    def find(self, query: str, line: int, col: int = 0):
+        """(line, col) 以降で query を探す。戻り値: (行, 桁) / 見つからなければ None"""
+        pos = self.text.find(query, self._starts[line] + col)
+        if pos < 0:
+            return None
+        return self.locate_char(pos)
+
+    def close(self):
+        pass
+
+
+class MmapLineSource:
+    """ディスク上の UTF-8 テキストを読み取り専用 mmap で開き、行単位で切り出す。
+
+    ファイル全体を str にせず、行頭のバイト位置と文字位置だけを保持する。ファイルは読むときだけ
+    開いてすぐ閉じる（表示中も掴みっぱなしにすると、Windows では上書きや名前の変更ができなくなる）。
+    索引を作った後にファイルが変わっていたら、読むときに OSError にする。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            try:
+                byte_starts = array("q", [0])
+                char_starts = array("q", [0])
+                chars = 0
+                prev = 0
+                pos = mm.find(b"\n")
+                while pos != -1:
+                    # UTF-8 の継続バイトを除いた数 = 文字数
+                    chars += len(mm[prev : pos + 1].translate(None, _UTF8_CONTINUATION_BYTES))
+                    prev = pos + 1
+                    byte_starts.append(prev)
+                    char_starts.append(chars)
+                    pos = mm.find(b"\n", prev)
+                chars += len(mm[prev:size].translate(None, _UTF8_CONTINUATION_BYTES))
+            finally:
+                if size:
+                    mm.close()
+
+        self._stamp = (st.st_size, st.st_mtime_ns)
+        self._size = size
+        self._byte_starts = byte_starts
+        self._char_starts = char_starts
+        self.line_count = len(byte_starts)
+        self.char_length = chars
+
+    def _read(self, fn):
+        """ファイルを開いて fn(mm) を呼び、すぐ閉じる。"""
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_size, st.st_mtime_ns) != self._stamp:
+                raise OSError(f"表示中にファイルが変更されました。開き直してください: {self.path}")
+            if not st.st_size:
+                return fn(b"")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return fn(mm)
+
+    def _line_end(self, line: int) -> int:
+        return self._byte_starts[line + 1] if line + 1 < self.line_count else self._size
+
+    def get_lines(self, first: int, last: int) -> str:
+        end = self._byte_starts[last] if last < self.line_count else self._size
+        return self._read(lambda mm: mm[self._byte_starts[first] : end].decode("utf-8", "replace"))
+
+    def locate_char(self, offset: int):
+        offset = max(0, min(int(offset), self.char_length))
+        line = bisect.bisect_right(self._char_starts, offset) - 1
+        return line, offset - self._char_starts[line]
+
+    def find(self, query: str, line: int, col: int = 0):
+        def _find(mm):
+            head = mm[self._byte_starts[line] : self._line_end(line)].decode("utf-8", "replace")[:col]
+            pos = mm.find(query.encode("utf-8"), self._byte_starts[line] + len(head.encode("utf-8")))
+            if pos < 0:
+                return None
+            hit_line = bisect.bisect_right(self._byte_starts, pos) - 1
+            hit_col = len(mm[self._byte_starts[hit_line] : pos].decode("utf-8", "replace"))
+            return hit_line, hit_col
+
+        return self._read(_find)
+
+    def close(self):
+        pass  # 読むたびに閉じているので、手放すものはない
+
+
+# ==========================================
+# 一覧表示（Treeview / Listbox）の差分更新
+# ==========================================
+def diff_row_span(old_rows, new_rows):
+    """先頭・末尾の一致部分を除いた変更範囲を返す。
+
+    戻り値: (p, old_end, new_end)  old_rows[p:old_end] を new_rows[p:new_end] に置き換えればよい
+    """
+    n_old, n_new = len(old_rows), len(new_rows)
+    limit = min(n_old, n_new)
+    p = 0
+    while p < limit and old_rows[p] == new_rows[p]:
+        p += 1
+    q = 0
+    while q < limit - p and old_rows[n_old - 1 - q] == new_rows[n_new - 1 - q]:
+        q += 1
+    return p, n_old - q, n_new - q
+
+
+class TreeRows:
+    """Treeview に表示中の行（values のタプル）を覚えておき、変わった行だけを更新する。"""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.iids = []
+        self.rows = []
+
+    def clear(self):
+        if self.iids:
+            self.tree.delete(*self.iids)
+        self.iids = []
+        self.rows = []
+
+    def sync(self, rows):
+        rows = [tuple(r) for r in rows]
+        p, old_end, new_end = diff_row_span(self.rows, rows)
+        n_common = min(old_end, new_end) - p
+        # 同じ位置の行は values の書き換えだけ（選択・スクロール位置を保つ）
+        for k in range(p, p + n_common):
+            self.tree.item(self.iids[k], values=rows[k])
+        if old_end - p > n_common:
+            self.tree.delete(*self.iids[p + n_common : old_end])
+        inserted = [
+            self.tree.insert("", k, values=rows[k]) for k in range(p + n_common, new_end)
+        ]
+        self.iids[p + n_common : old_end] = inserted
+        self.rows = rows
+
+
+class ListboxRows:
+    """Listbox 版の TreeRows（行の書き換えは delete + insert）。"""
+
+    def __init__(self, listbox):
+        self.listbox = listbox
+        self.rows = []
+
+    def sync(self, rows):
+        rows = list(rows)
+        p, old_end, new_end = diff_row_span(self.rows, rows)
+        if old_end > p:
+            self.listbox.delete(p, old_end - 1)
+        if new_end > p:
+            self.listbox.insert(p, *rows[p:new_end])
+        self.rows = rows
+
+
+# ==========================================
+# Tab3 クリップボード監視
+# ==========================================
+CLIPBOARD_SIGNATURE_EDGE = 4096  # 変化の簡易判定に使う先頭/末尾の文字数
+CLIPBOARD_BACKOFF = 1.5  # 変化がないときの監視間隔の伸び率
+
+
+class PyperclipClipboardBackend:
+    """pyperclip で読む（変更通知なし）。Linux では paste() のたびに xclip/xsel が起動する。"""
+
+    name = "pyperclip"
+    min_interval = 1.0
+    max_interval = 5.0
+
+    def change_token(self):
+        return None
+
+    def paste(self) -> str:
+        return pyperclip.paste() or ""
+
+
+class WindowsClipboardBackend(PyperclipClipboardBackend):
+    """GetClipboardSequenceNumber（変更回数）が変わったときだけ中身を読む。"""
+
+    name = "win32"
+    min_interval = 0.3
+    max_interval = 2.0
+
+    def __init__(self):
+        import ctypes
+
+        self._seq = ctypes.windll.user32.GetClipboardSequenceNumber
+
+    def change_token(self):
+        return self._seq()
+
+
+class FakeClipboardBackend:
+    """動作確認用：set_text() で内容を差し替える。"""
+
+    name = "fake"
+    min_interval = 0.05
+    max_interval = 0.2
+
+    def __init__(self, text: str = ""):
+        self._text = text
+        self._count = 0
+        self.paste_count = 0
+
+    def set_text(self, text: str):
+        self._text = text
+        self._count += 1
+
+    def change_token(self):
+        return self._count
+
+    def paste(self) -> str:
+        self.paste_count += 1
+        return self._text
+
+
+def make_clipboard_backend():
+    if sys.platform == "win32":
+        try:
+            return WindowsClipboardBackend()
+        except Exception:
+            pass
+    return PyperclipClipboardBackend()
+
+
+class ClipboardWatcher:
+    """クリップボードの変化を検出して on_change(text) を呼ぶ。
+
+    - バックエンドが変更回数を返せる場合は、それが変わったときだけ中身を読む
+    - 中身は (長さ, 先頭/末尾の digest) で比べ、同じなら前回の文字列と直接比較する
+      （SHA256 は変化したと判断した内容だけに計算する）
+    - 変化がない間は監視間隔を max_interval まで伸ばし、変化があれば min_interval に戻す
+    """
+
+    def __init__(self, backend, on_change):
+        self.backend = backend
+        self.on_change = on_change
+        self.interval = backend.min_interval
+        self.last_hash = None
+        self._last_token = None
+        self._last_signature = None
+        self._last_text = None
+        self._stop = threading.Event()
+        self._poll_lock = threading.Lock()  # poll() は同時に1つだけ（前回の状態を共有するため）
+        self._thread = None
+
+    @staticmethod
+    def signature(text: str):
+        edge = CLIPBOARD_SIGNATURE_EDGE
+        h = hashlib.blake2b(digest_size=16)
+        h.update(text[:edge].encode("utf-8", "ignore"))
+        h.update(text[-edge:].encode("utf-8", "ignore"))
+        return len(text), h.digest()
+
+    def prime(self, text=None):
+        """現在の内容を「取り込み済み」として記録する（監視開始直後に取り込まないため）。"""
+        with self._poll_lock:
+            try:
+                self._last_token = self.backend.change_token()
+                if text is None:
+                    text = self.backend.paste()
+            except Exception:
+                return
+            self._remember(text)
+
+    def _remember(self, text: str):
+        self._last_text = text
+        self._last_signature = self.signature(text)
+        self.last_hash = hashlib.sha256(text.encode("utf-8", "ignore")).hexdigest() if text else None
+
+    def poll(self):
+        """1回分の確認。新しい内容なら on_change を呼んで True を返す。"""
+        token = self.backend.change_token()
+        if token is not None and token == self._last_token:
+            return False
+        content = self.backend.paste()
+        self._last_token = token
+        if not content:
+            return False
+        sig = self.signature(content)
+        if sig == self._last_signature and content == self._last_text:
+            return False
+        self._last_text = content
+        self._last_signature = sig
+        chash = hashlib.sha256(content.encode("utf-8", "ignore")).hexdigest()
+        # 空白だけの内容は取り込まず、直前に取り込んだ内容のハッシュも更新しない
+        if chash == self.last_hash or not content.strip():
+            return False
+        self.last_hash = chash
+        self.on_change(content)
+        return True
+
+    def _run(self, stop: threading.Event):
+        # stop はこのスレッド専用（start() し直しても、古いスレッドは自分の stop を見て終わる）
+        interval = self.backend.min_interval
+        while True:
+            changed = False
+            with self._poll_lock:
+                # 停止後に古いスレッドが読み込まないよう、止まったかどうかはロックの中で見る
+                if stop.is_set():
+                    return
+                try:
+                    changed = self.poll()
+                except Exception:
+                    pass
+            if changed:
+                interval = self.backend.min_interval
+            else:
+                interval = min(self.backend.max_interval, interval * CLIPBOARD_BACKOFF)
+            self.interval = interval
+            stop.wait(interval)
+
+    def start(self):
+        self.stop()
+        self._stop = threading.Event()
+        self.interval = self.backend.min_interval
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+# ==========================================
+# Tab3 スタック（ディスク上の追記型ジャーナル）
+# ==========================================
+APP_DATA_DIR = os.path.join(os.environ.get("APPDATA") or os.path.expanduser("~"), "yomitoku_workflow")
+MERGE_STACK_DIR = os.path.join(APP_DATA_DIR, "merge_stack")
+MERGE_JOURNAL_NAME = "journal.jsonl"
+MERGE_LAST_RESET_DIR = "last_reset"
+MERGE_COMPACT_MIN_BYTES = 4 * 1024 * 1024  # 不要になった本文がこれを超えたら圧縮を検討
+
+
+def merge_item_label(text: str) -> str:
+    """スタック項目の一覧表示用の1行（先頭80文字）。"""
+    # 改行の置換は先頭だけで足りる（\r\n→1文字なので 162文字あれば80文字を超える）
+    one = text[:162].replace("\r\n", "\n").replace("\n", " ")
+    return f"{one[:80]}{'...' if len(one) > 80 or len(text) > 162 else ''}"
+
+
+class MergeStackStore:
+    """Tab3 のスタック。本文は追記専用のデータファイルに1回だけ書き、操作はジャーナルに記録する。
+
+    journal.jsonl（1行1レコード）:
+      {"op": "open", "blob": "items-<世代>.dat"}  先頭行。本文の格納先
+      {"op": "append", "id", "off", "len", "sha256", "label"}
+      {"op": "edit", "id", "off", "len", "sha256", "label"}  本文は新たに追記する
+      {"op": "move", "from", "to"} / {"op": "delete", "at": [...]} / {"op": "clear"}
+    メモリに持つのは順序・位置・一覧表示用ラベルだけで、本文は必要なときに読む。
+    不要な本文やレコードが増えたら、生きている項目だけで書き直す（compact）。
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self.journal_path = os.path.join(root_dir, MERGE_JOURNAL_NAME)
+        self._order = []  # id の並び
+        self._items = {}  # id -> {"off", "len", "sha256", "label"}
+        self._next_id = 0
+        self._records = 0
+        self._dead_bytes = 0
+        self.blob_name = None
+        self.recovered = 0
+        if os.path.exists(self.journal_path):
+            self._replay()
+        if self.blob_name is None or not os.path.exists(self.blob_path):
+            self._rewrite([])
+        else:
+            self.maybe_compact()
+
+    @property
+    def blob_path(self) -> str:
+        return os.path.join(self.root_dir, self.blob_name)
+
+    # ---- 読み込み ----
+    def _replay(self):
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最後の行などは無視する
+                    continue
+                try:
+                    self._apply(rec)
+                except (KeyError, IndexError, TypeError):
+                    continue
+                self._records += 1
+        self.recovered = len(self._order)
+
+    def _apply(self, rec: dict):
+        op = rec.get("op")
+        if op == "open":
+            self.blob_name = rec["blob"]
+        elif op == "append":
+            self._items[rec["id"]] = self._meta(rec)
+            self._order.append(rec["id"])
+            self._next_id = max(self._next_id, rec["id"] + 1)
+        elif op == "edit":
+            self._dead_bytes += self._items[rec["id"]]["len"]
+            self._items[rec["id"]] = self._meta(rec)
+        elif op == "move":
+            self._order.insert(rec["to"], self._order.pop(rec["from"]))
+        elif op == "delete":
+            for i in sorted(rec["at"], reverse=True):
+                self._dead_bytes += self._items.pop(self._order.pop(i))["len"]
+        elif op == "clear":
+            self._dead_bytes += sum(m["len"] for m in self._items.values())
+            self._order = []
+            self._items = {}
+
+    @staticmethod
+    def _meta(rec: dict) -> dict:
+        return {"off": rec["off"], "len": rec["len"], "sha256": rec["sha256"], "label": rec["label"]}
+
+    # ---- 参照 ----
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, idx: int) -> str:
+        m = self._items[self._order[idx]]
+        with open(self.blob_path, "rb") as f:
+            f.seek(m["off"])
+            return f.read(m["len"]).decode("utf-8")
+
+    def __iter__(self):
+        with open(self.blob_path, "rb") as f:
+            for item_id in list(self._order):
+                m = self._items[item_id]
+                f.seek(m["off"])
+                yield f.read(m["len"]).decode("utf-8")
+
+    def labels(self) -> list:
+        return [self._items[i]["label"] for i in self._order]
+
+    # ---- 変更（すべてジャーナルへ追記） ----
+    def _log(self, rec: dict):
+        with open(self.journal_path, "a", encoding="utf-8", newline="\n") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += 1
+        self._apply(rec)
+
+    def _store(self, text: str) -> dict:
+        data = text.encode("utf-8")
+        with open(self.blob_path, "ab") as f:
+            off = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return {"off": off, "len": len(data), "sha256": hashlib.sha256(data).hexdigest(), "label": merge_item_label(text)}
+
+    def append(self, text: str):
+        rec = dict(self._store(text), op="append", id=self._next_id)
+        self._log(rec)
+        self.maybe_compact()
+
+    def set(self, idx: int, text: str):
+        rec = dict(self._store(text), op="edit", id=self._order[idx])
+        self._log(rec)
+        self.maybe_compact()
+
+    def move(self, src: int, dst: int):
+        self._log({"op": "move", "from": src, "to": dst})
+        self.maybe_compact()
+
+    def delete(self, indices):
+        at = sorted({i for i in indices if 0 <= i < len(self._order)})
+        if at:
+            self._log({"op": "delete", "at": at})
+            self.maybe_compact()
+
+    def clear(self):
+        """スタックを空にする。直前の内容は last_reset/ に1世代だけ残す。"""
+        backup = os.path.join(self.root_dir, MERGE_LAST_RESET_DIR)
+        if self._order:
+            if os.path.isdir(backup):
+                for name in os.listdir(backup):
+                    os.remove(os.path.join(backup, name))
+            else:
+                os.makedirs(backup)
+            self.compact()
+            os.replace(self.journal_path, os.path.join(backup, MERGE_JOURNAL_NAME))
+            os.replace(self.blob_path, os.path.join(backup, self.blob_name))
+        self._order = []
+        self._items = {}
+        self._dead_bytes = 0
+        self._rewrite([])
+
+    # ---- 圧縮 ----
+    def maybe_compact(self):
+        live_bytes = sum(m["len"] for m in self._items.values())
+        if self._dead_bytes > max(MERGE_COMPACT_MIN_BYTES, live_bytes) or self._records > 4 * len(self._order) + 256:
+            self.compact()
+
+    def compact(self):
+        """生きている項目だけで本文ファイルとジャーナルを書き直す。"""
+        self._rewrite(self._order)
+
+    def _rewrite(self, order):
+        old_blob = self.blob_path if self.blob_name else None
+        gen = int(time.time() * 1000)
+        new_name = f"items-{gen}.dat"
+        while new_name == self.blob_name or os.path.exists(os.path.join(self.root_dir, new_name)):
+            gen += 1
+            new_name = f"items-{gen}.dat"
+        new_blob = os.path.join(self.root_dir, new_name)
+
+        recs = [{"op": "open", "blob": new_name}]
+        items = {}
+        with open(new_blob, "wb") as out:
+            src = open(old_blob, "rb") if order else None
+            try:
+                for new_id, item_id in enumerate(order):
+                    m = self._items[item_id]
+                    src.seek(m["off"])
+                    data = src.read(m["len"])
+                    meta = dict(m, off=out.tell())
+                    out.write(data)
+                    items[new_id] = meta
+                    recs.append(dict(meta, op="append", id=new_id))
+            finally:
+                if src is not None:
+                    src.close()
+            out.flush()
+            os.fsync(out.fileno())
+
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+            for rec in recs:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # ジャーナルの置き換えが確定点（ここより前に落ちても旧ファイルで復元できる）
+        os.replace(tmp, self.journal_path)
+
+        self.blob_name = new_name
+        self._items = items
+        self._order = list(range(len(order)))
+        self._next_id = len(order)
+        self._records = len(recs)
+        self._dead_bytes = 0
+        if old_blob and os.path.exists(old_blob):
+            try:
+                os.remove(old_blob)
+            except OSError:
+                pass
+
+
+# ==========================================
+# チャンクの JSONL バッチ（一括校正の受け渡し）
+# ==========================================
+CHUNK_BATCH_FORMATS = {
+    "OpenAI Batch API（chat/completions）": "openai",
+    "Anthropic Message Batches API": "anthropic",
+}
+CHUNK_BATCH_DEFAULT_MODELS = {"openai": "gpt-4o-mini", "anthropic": "claude-sonnet-4-5"}
+# 出力トークン数の指定（チャンクの推定トークンの2倍、最低1024）の上限。既定モデルの出力上限に合わせる
+CHUNK_BATCH_MAX_TOKENS = {"openai": 16384, "anthropic": 32000}
+CHUNK_BATCH_META_SUFFIX = ".chunks.jsonl"
+CHUNK_BATCH_PROMPT = (
+    "次の Markdown は書籍を OCR した本文の一部です。OCR の誤認識・誤字脱字だけを直してください。"
+    "文章の言い換え・要約はせず、見出し・改行・画像リンク・HTML タグはそのまま残し、"
+    "直した Markdown 本文だけを返してください（説明やコードブロックの囲みは付けない）。"
+)
+
+
+def chunk_batch_id(order: int, sha256: str) -> str:
+    """バッチ内でチャンクを識別する custom_id（順番 + 元テキストのハッシュ先頭）。"""
+    return f"chunk-{order:04d}-{sha256[:12]}"
+
+
+def chunk_batch_meta(order: int, name: str, text: str) -> dict:
+    """チャンクの情報（順番・名前・ハッシュ・大きさ）。本文はリクエストの方に入れる。"""
+    data = text.encode("utf-8")
+    sha = hashlib.sha256(data).hexdigest()
+    return {
+        "custom_id": chunk_batch_id(order, sha),
+        "order": order,
+        "name": name,
+        "sha256": sha,
+        "bytes": len(data),
+        "chars": len(text),
+        "tokens": estimate_tokens_ja(text),
+    }
+
+
+def chunk_batch_request(meta: dict, text: str, fmt: str, model: str) -> dict:
+    """1チャンク分の Batch API リクエスト（そのままアップロードできる形）。"""
+    if fmt not in CHUNK_BATCH_MAX_TOKENS:
+        raise ValueError(f"不明なバッチ形式です: {fmt}")
+    max_tokens = min(CHUNK_BATCH_MAX_TOKENS[fmt], max(1024, meta["tokens"] * 2))
+    if fmt == "openai":
+        return {
+            "custom_id": meta["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "max_completion_tokens": max_tokens,
+                "messages": [{"role": "system", "content": CHUNK_BATCH_PROMPT}, {"role": "user", "content": text}],
+            },
+        }
+    return {
+        "custom_id": meta["custom_id"],
+        "params": {
+            "model": model,
+            "max_tokens": max_tokens,
+            "system": CHUNK_BATCH_PROMPT,
+            "messages": [{"role": "user", "content": text}],
+        },
+    }
+
+
+def chunk_batch_source(rec: dict):
+    """書き出したバッチの1行から (custom_id, 元のチャンク本文) を取り出す（本文が読めなければ None）。"""
+    if "text" in rec:
+        # 以前の形式（custom_id + text）
+        return rec.get("custom_id"), rec["text"]
+    request = rec.get("body") or rec.get("params") or {}
+    messages = request.get("messages") or []
+    content = messages[-1].get("content") if messages and isinstance(messages[-1], dict) else None
+    return rec.get("custom_id"), content if isinstance(content, str) else None
+
+
+def chunk_batch_meta_path(batch_path: str) -> str:
+    return os.path.splitext(batch_path)[0] + CHUNK_BATCH_META_SUFFIX
+
+
+def write_chunk_batch(path: str, items, fmt: str = "openai", model=None) -> int:
+    """items: (name, text) の列。1行1チャンクの Batch API リクエスト（JSONL）に書き出し、件数を返す。
+
+    順番・名前・ハッシュなどは横に置く <名前>.chunks.jsonl に書く（リクエストには余計な項目を入れない）。
+    """
+    model = model or CHUNK_BATCH_DEFAULT_MODELS[fmt]
+    n = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as f, open(
+        chunk_batch_meta_path(path), "w", encoding="utf-8", newline="\n"
+    ) as meta_f:
+        for order, (name, text) in enumerate(items):
+            meta = chunk_batch_meta(order, name, text)
+            f.write(json.dumps(chunk_batch_request(meta, text, fmt, model), ensure_ascii=False) + "\n")
+            meta_f.write(json.dumps(meta, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+def batch_result_text(rec: dict):
+    """返ってきた1行から (custom_id, 校正後テキスト, 元の sha256) を取り出す。
+
+    OpenAI / Anthropic の Batch 出力の形のほか、custom_id + text の形にも対応する。
+    テキストが取り出せない行は text=None。
+    """
+    cid = rec.get("custom_id") or rec.get("id")
+    text = rec.get("text")
+    if text is None and isinstance(rec.get("response"), dict):
+        # OpenAI: {"response": {"body": {"choices": [{"message": {"content": ...}}]}}}
+        try:
+            text = rec["response"]["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            text = None
+    if text is None and isinstance(rec.get("result"), dict):
+        # Anthropic: {"result": {"type": "succeeded", "message": {"content": [{"type": "text", "text": ...}]}}}
+        try:
+            if rec["result"].get("type") == "succeeded":
+                text = "".join(
+                    b.get("text", "") for b in rec["result"]["message"]["content"] if b.get("type") == "text"
+                )
+        except (KeyError, TypeError):
+            text = None
+    return cid, text, rec.get("sha256")
+
+
+def batch_result_truncated(rec: dict) -> bool:
+    """出力トークンの上限で途中までになった応答か（OpenAI: finish_reason=length / Anthropic: stop_reason=max_tokens）。"""
+    try:
+        if rec["response"]["body"]["choices"][0].get("finish_reason") == "length":
+            return True
+    except (KeyError, IndexError, TypeError, AttributeError):
+        pass
+    try:
+        return rec["result"]["message"].get("stop_reason") == "max_tokens"
+    except (KeyError, TypeError, AttributeError):
+        return False
+
+
+def index_jsonl_by_id(path: str) -> dict:
+    """JSONL を1回走査して custom_id -> 行の先頭バイト位置 を作る（本文はメモリに残さない）。"""
+    index = {}
+    with open(path, "rb") as f:
+        pos = f.tell()
+        for line in iter(f.readline, b""):
+            if line.strip():
+                try:
+                    cid = batch_result_text(json.loads(line))[0]
+                except ValueError:
+                    cid = None
+                if cid:
+                    index[cid] = pos
+            pos = f.tell()
+    return index
+
+
+def _load_chunk_batch_meta(batch_path: str) -> dict:
+    """custom_id -> チャンクの情報（横の .chunks.jsonl がなければ空）。"""
+    metas = {}
+    try:
+        with open(chunk_batch_meta_path(batch_path), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    meta = json.loads(line)
+                    metas[meta.get("custom_id")] = meta
+    except (OSError, ValueError):
+        pass
+    return metas
+
+
+def merge_chunk_batch(batch_path: str, results_path: str, out_path: str, progress=None) -> dict:
+    """書き出したバッチの順に、校正結果（なければ元のテキスト）を1つの Markdown へ書き出す。
+
+    校正結果は custom_id で対応付け、元の sha256 を持っている行はそれも照合する。
+    出力の上限で途中までになった応答は使わない（後ろが欠けた本文でチャンクを置き換えないため）。
+    """
+    index = index_jsonl_by_id(results_path)
+    metas = _load_chunk_batch_meta(batch_path)
+    stats = {"chunks": 0, "corrected": [], "kept": [], "rejected": [], "truncated": [], "unknown": 0}
+    seen = set()
+    tmp_path = out_path + ".part"
+    try:
+        with open(batch_path, "r", encoding="utf-8") as src, open(results_path, "rb") as res, open(
+            tmp_path, "w", encoding="utf-8", newline=""
+        ) as out:
+            for line in src:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                cid, text = chunk_batch_source(rec)
+                if not cid or text is None:
+                    raise ValueError(f"バッチの{stats['chunks'] + 1}行目からチャンクの本文を読めません: {batch_path}")
+                sha = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                name = metas.get(cid, {}).get("name") or rec.get("name") or cid
+                stats["chunks"] += 1
+                if progress is not None:
+                    progress.report(f"結合中... {stats['chunks']}件")
+                if cid in index:
+                    seen.add(cid)
+                    res.seek(index[cid])
+                    result = json.loads(res.readline())
+                    _, new_text, echoed_sha = batch_result_text(result)
+                    if batch_result_truncated(result):
+                        stats["truncated"].append(name)
+                    elif new_text is None or (echoed_sha and echoed_sha != sha):
+                        stats["rejected"].append(name)
+                    else:
+                        text = new_text
+                        stats["corrected"].append(name)
+                else:
+                    stats["kept"].append(name)
+                out.write(text)
+                if text and not text.endswith("\n"):
+                    out.write("\n")
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    stats["unknown"] = len(set(index) - seen)
+    return stats
+
+
+def run_local_batch_stub(batch_path: str, out_path: str, transform=None) -> int:
+    """外部サービスの代わりにローカルで応答を作る（動作確認用）。transform 未指定なら本文をそのまま返す。
+
+    結果はバッチと同じ API の出力の形（OpenAI: response.body.choices / Anthropic: result.message.content）。
+    """
+    n = 0
+    with open(batch_path, "r", encoding="utf-8") as src, open(out_path, "w", encoding="utf-8", newline="\n") as out:
+        for line in src:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            cid, text = chunk_batch_source(rec)
+            text = transform(text) if transform is not None else text
+            if "body" in rec:
+                result = {
+                    "custom_id": cid,
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                            ]
+                        },
+                    },
+                }
+            elif "params" in rec:
+                message = {"role": "assistant", "content": [{"type": "text", "text": text}], "stop_reason": "end_turn"}
+                result = {"custom_id": cid, "result": {"type": "succeeded", "message": message}}
+            else:
+                result = {"custom_id": cid, "sha256": rec.get("sha256"), "text": text}
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+# ==========================================
+# Tab4 EPUB：章ごとの XHTML 分割と目次
+# ==========================================
+EPUB_SPLIT_LABELS = {
+    "見出しレベル1（#）ごと": 1,
+    "見出しレベル2（##）まで": 2,
+    "見出しレベル3（###）まで": 3,
+    "Tab2-2の本文構造ルールの章ごと": "split2",
+    "分けない（1ファイル・従来）": 0,
+}
+EPUB_DEFAULT_MAX_KB = 300  # 1つの XHTML に入れる Markdown の目安上限
+EPUB_TOC_DEPTH = 3  # 目次に載せる見出しの深さ
+_MD_HEADING_RE = re.compile(r"^(#{1,6})\s")
+_MD_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_NON_SPACE_RE = re.compile(r"\S")
+_HTML_HEADING_RE = re.compile(r"<h([1-6])>(.*?)</h\1>", re.S)
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_HTML_BR_RE = re.compile(r"<br\s*/?>", re.I)
+
+
+def markdown_heading_offsets(md_text: str, max_level: int) -> list:
+    """レベル max_level 以下の見出し行の開始オフセット（コードブロック内は除く）。"""
+    offsets = []
+    pos = 0
+    end = len(md_text)
+    in_fence = False
+    while pos < end:
+        # 行のリストを作らずに1行ずつ見る（大きな本でもメモリを増やさない）
+        nl = md_text.find("\n", pos)
+        line_end = end if nl < 0 else nl + 1
+        line = md_text[pos:line_end]
+        if _MD_FENCE_RE.match(line):
+            in_fence = not in_fence
+        elif not in_fence:
+            m = _MD_HEADING_RE.match(line)
+            if m and len(m.group(1)) <= max_level:
+                offsets.append(pos)
+        pos = line_end
+    return offsets
+
+
+def split_markdown_spans(md_text: str, offsets) -> list:
+    """offsets で区切った (開始, 終了) のリスト。空白だけの断片は直前の断片に含める。"""
+    bounds = sorted({0, *[o for o in offsets if 0 < o < len(md_text)], len(md_text)})
+    spans = []
+    for a, b in zip(bounds, bounds[1:]):
+        if spans and not _NON_SPACE_RE.search(md_text, a, b):
+            spans[-1] = (spans[-1][0], b)
+        else:
+            spans.append((a, b))
+    return spans or [(0, len(md_text))]
+
+
+def cap_markdown_span(md_text: str, start: int, end: int, max_bytes: int) -> list:
+    """max_bytes（UTF-8）を超える断片を、コードブロック外の空行で詰め込み分割した (開始, 終了) のリスト。"""
+    if not max_bytes or len(md_text[start:end].encode("utf-8")) <= max_bytes:
+        return [(start, end)]
+    spans = []
+    cur_start = start
+    cur_bytes = 0
+    prev_blank = False
+    in_fence = False
+    pos = start
+    while pos < end:
+        nl = md_text.find("\n", pos, end)
+        line_end = end if nl < 0 else nl + 1
+        line = md_text[pos:line_end]
+        if _MD_FENCE_RE.match(line):
+            in_fence = not in_fence
+        n = len(line.encode("utf-8"))
+        # 空行の直後（段落・表・リストの切れ目）でだけ区切る
+        if pos > cur_start and cur_bytes + n > max_bytes and not in_fence and prev_blank:
+            spans.append((cur_start, pos))
+            cur_start, cur_bytes = pos, 0
+        cur_bytes += n
+        prev_blank = not line.strip()
+        pos = line_end
+    spans.append((cur_start, end))
+    return spans
+
+
+def add_heading_ids(html: str, id_prefix: str):
+    """<hN> に id を付け、(レベル, 見出し文字列, id) の一覧も返す。"""
+    headings = []
+
+    def _sub(m):
+        level = int(m.group(1))
+        hid = f"{id_prefix}-h{len(headings) + 1}"
+        text = html_lib.unescape(_HTML_TAG_RE.sub("", _HTML_BR_RE.sub(" ", m.group(2)))).strip()
+        headings.append((level, text, hid))
+        return f'<h{level} id="{hid}">{m.group(2)}</h{level}>'
+
+    return _HTML_HEADING_RE.sub(_sub, html), headings
+
+
+EPUB_MD_EXTENSIONS = ("tables", "fenced_code")
+EPUB_RENDER_CACHE_DIR = os.path.join(APP_DATA_DIR, "render_cache")
+EPUB_RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+EPUB_RENDER_PARALLEL_MIN = 8  # キャッシュにない章がこの数以上なら、スレッドプールで並行して変換する
+EPUB_RENDER_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+
+def render_markdown_fragment(md_text: str, extensions=EPUB_MD_EXTENSIONS) -> str:
+    """1章分の Markdown → HTML 断片。"""
+    return markdown_lib.markdown(md_text, extensions=list(extensions))
+
+
+class MarkdownRenderCache:
+    """変換済み HTML 断片のディスクキャッシュ（キーは Markdown 本文・拡張・markdown のバージョンのハッシュ）。"""
+
+    def __init__(self, root_dir: str, extensions=EPUB_MD_EXTENSIONS):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        version = getattr(markdown_lib, "__version__", "")
+        self._salt = f"markdown={version};ext={','.join(extensions)};".encode("utf-8")
+
+    def key(self, md_text: str) -> str:
+        h = hashlib.sha256(self._salt)
+        h.update(md_text.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_dir, key[:2], key + ".html")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                html = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)  # 古いものから捨てるため、使った時刻を更新
+        except OSError:
+            pass
+        return html
+
+    def put(self, key: str, html: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            f.write(html)
+        os.replace(tmp, path)
+
+    def prune(self, max_bytes: int = EPUB_RENDER_CACHE_MAX_BYTES):
+        """合計が max_bytes を超えたら、最後に使った時刻が古いものから消す。"""
+        prune_cache_dir(self.root_dir, max_bytes)
+
+
+def build_toc_tree(entries) -> list:
+    """(レベル, タイトル, href, uid) の並びを入れ子の [タイトル, href, uid, 子リスト] にする。"""
+    root = []
+    stack = [(0, root)]
+    for level, title, href, uid in entries:
+        while stack[-1][0] >= level:
+            stack.pop()
+        node = [title, href, uid, []]
+        stack[-1][1].append(node)
+        stack.append((level, node[3]))
+    return root
+
+
+# ==========================================
+# EPUB の差分パッケージング
+# ==========================================
+EPUB_MANIFEST_SUFFIX = ".manifest.json"  # 出力EPUBの横に置く、エントリごとのハッシュ一覧
+EPUB_ZIP_LEVEL = 6
+_ZIP_LOCAL = struct.Struct("<IHHHHHIIIHH")
+_ZIP_CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+_ZIP_END = struct.Struct("<IHHHHIIH")
+_ZIP_UTF8 = 0x800
+
+
+def epub_metadata_entries(book, skip) -> list:
+    """EpubBook から、skip に含まれない (エントリ名, 中身) を取り出す（OPF / nav / NCX / 表紙ページなど）。
+
+    本文や画像は書き出し済みで、book 側には空の中身だけが残っている前提。
+    """
+    buf = io.BytesIO()
+    epub.write_epub(buf, book, {"compresslevel": 0, "raise_exceptions": True})
+    with zipfile.ZipFile(buf) as zf:
+        return [(info.filename, zf.read(info)) for info in zf.infolist() if info.filename not in skip]
+
+
+def _zip_dos_time(date_time) -> tuple:
+    y, mo, d, h, mi, s = date_time[:6]
+    return (h << 11) | (mi << 5) | (s // 2), ((max(y, 1980) - 1980) << 9) | (mo << 5) | d
+
+
+def _load_epub_manifest(epub_path: str) -> dict:
+    """前回の出力と食い違わない場合だけ、前回のエントリハッシュを返す。"""
+    try:
+        with open(epub_path + EPUB_MANIFEST_SUFFIX, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        st = os.stat(epub_path)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("size") != st.st_size or data.get("mtime_ns") != st.st_mtime_ns:
+        return {}  # EPUB が外部で差し替えられた
+    entries = data.get("entries")
+    return entries if isinstance(entries, dict) else {}
+
+
+class EpubPackWriter:
+    """EPUB(zip) をエントリごとに順に書き出す。前回と同じ中身のエントリは圧縮済みデータをそのまま写す。
+
+    mimetype は先頭・無圧縮・拡張フィールドなしで書く（EPUB OCF の決まり）。
+    書き出しは .part に行い、close() で置き換える。手元に持つのは書き出し中の1エントリと
+    中央ディレクトリ用の小さな情報だけなので、本の長さによらずメモリはほぼ一定。
+    """
+
+    def __init__(self, out_path: str, progress=None):
+        self.out_path = out_path
+        self.tmp_path = out_path + ".part"
+        self._progress = progress
+        self._prev = _load_epub_manifest(out_path)
+        self._old = None
+        self._old_fp = None
+        if self._prev:
+            try:
+                self._old = zipfile.ZipFile(out_path)
+                self._old_fp = open(out_path, "rb")
+            except (OSError, zipfile.BadZipFile):
+                self._close_old()
+                self._prev = {}
+        self._now = _zip_dos_time(time.localtime())
+        self._hashes = {}
+        self._central = []
+        self.stats = {"entries": 0, "copied": 0, "written": 0, "copied_bytes": 0}
+        self._out = open(self.tmp_path, "wb")
+        self.add("mimetype", b"application/epub+zip")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._hashes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+    def add(self, name: str, data: bytes):
+        self._add(name, hashlib.sha256(data).hexdigest(), len(data), lambda: iter((data,)))
+
+    def add_file(self, name: str, path: str):
+        """ファイルをブロックごとに読んで追加する（画像などを丸ごとメモリに載せない）。"""
+        h = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+                size += len(block)
+
+        def _blocks():
+            with open(path, "rb") as f:
+                yield from iter(lambda: f.read(1024 * 1024), b"")
+
+        self._add(name, h.hexdigest(), size, _blocks)
+
+    def _add(self, name: str, sha: str, size: int, blocks):
+        if self._progress is not None:
+            self._progress.check()
+        if name in self._hashes:
+            raise ValueError(f"EPUB内のファイル名が重複しています: {name}")
+        self._hashes[name] = sha
+        self.stats["entries"] += 1
+        if self._copy_previous(name, sha, size):
+            return
+
+        name_b = name.encode("utf-8")
+        offset = self._out.tell()
+        method = zipfile.ZIP_STORED if name == "mimetype" else zipfile.ZIP_DEFLATED
+        dos_time, dos_date = self._now
+        # CRC と圧縮後サイズは書き終えてから見出しに書き戻す
+        self._out.write(_ZIP_LOCAL.pack(0x04034B50, 20, _ZIP_UTF8, method, dos_time, dos_date,
+                                        0, 0, size, len(name_b), 0))
+        self._out.write(name_b)
+        crc = 0
+        csize = 0
+        comp = zlib.compressobj(EPUB_ZIP_LEVEL, zlib.DEFLATED, -15) if method == zipfile.ZIP_DEFLATED else None
+        for block in blocks():
+            crc = zlib.crc32(block, crc)
+            if comp is not None:
+                block = comp.compress(block)
+            self._out.write(block)
+            csize += len(block)
+        if comp is not None:
+            tail = comp.flush()
+            self._out.write(tail)
+            csize += len(tail)
+        end = self._out.tell()
+        self._out.seek(offset + 14)
+        self._out.write(struct.pack("<II", crc, csize))
+        self._out.seek(end)
+        self._central.append((name_b, method, dos_time, dos_date, crc, csize, size, offset))
+        self.stats["written"] += 1
+
+    def _copy_previous(self, name: str, sha: str, size: int) -> bool:
+        """前回の EPUB に同じ中身があれば、圧縮済みデータを再圧縮せずにコピーする。"""
+        if self._old is None or name == "mimetype" or self._prev.get(name) != sha:
+            return False
+        try:
+            info = self._old.getinfo(name)
+        except KeyError:
+            return False
+        if info.file_size != size or info.flag_bits & 0x1:
+            return False
+
+        fp = self._old_fp
+        fp.seek(info.header_offset)
+        fields = _ZIP_LOCAL.unpack(fp.read(_ZIP_LOCAL.size))
+        fp.seek(info.header_offset + _ZIP_LOCAL.size + fields[9] + fields[10])
+        name_b = name.encode("utf-8")
+        offset = self._out.tell()
+        dos_time, dos_date = _zip_dos_time(info.date_time)
+        self._out.write(_ZIP_LOCAL.pack(0x04034B50, 20, _ZIP_UTF8, info.compress_type, dos_time, dos_date,
+                                        info.CRC, info.compress_size, size, len(name_b), 0))
+        self._out.write(name_b)
+        remaining = info.compress_size
+        while remaining:
+            block = fp.read(min(remaining, 1024 * 1024))
+            if not block:
+                raise OSError(f"前回のEPUBが途中で切れています: {name}")
+            self._out.write(block)
+            remaining -= len(block)
+        self._central.append((name_b, info.compress_type, dos_time, dos_date, info.CRC,
+                              info.compress_size, size, offset))
+        self.stats["copied"] += 1
+        self.stats["copied_bytes"] += info.compress_size
+        return True
+
+    def close(self) -> dict:
+        out = self._out
+        cd_start = out.tell()
+        for name_b, method, dos_time, dos_date, crc, csize, usize, offset in self._central:
+            out.write(_ZIP_CENTRAL.pack(0x02014B50, 20, 20, _ZIP_UTF8, method, dos_time, dos_date,
+                                        crc, csize, usize, len(name_b), 0, 0, 0, 0, 0, offset))
+            out.write(name_b)
+        cd_end = out.tell()
+        if cd_end >= 0xFFFFFFFF or len(self._central) >= 0xFFFF:
+            self.abort()
+            raise OSError("EPUBが大きすぎます（4GB / 65535エントリまで）")
+        out.write(_ZIP_END.pack(0x06054B50, 0, 0, len(self._central), len(self._central),
+                                cd_end - cd_start, cd_start, 0))
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+        self._close_old()
+        os.replace(self.tmp_path, self.out_path)
+
+        st = os.stat(self.out_path)
+        manifest = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "entries": self._hashes}
+        try:
+            with open(self.out_path + EPUB_MANIFEST_SUFFIX + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(self.out_path + EPUB_MANIFEST_SUFFIX + ".tmp", self.out_path + EPUB_MANIFEST_SUFFIX)
+        except OSError:
+            pass  # 次回は全体を書き直すだけ
+        return self.stats
+
+    def abort(self):
+        try:
+            self._out.close()
+        except OSError:
+            pass
+        self._close_old()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def _close_old(self):
+        for f in (self._old, self._old_fp):
+            if f is not None:
+                f.close()
+        self._old = None
+        self._old_fp = None
+
+
+# ==========================================
+# EPUB の画像（表紙・図版）の最適化
+# ==========================================
+# 表示名 → (PIL の形式名, 拡張子, メディアタイプ)。None は元の画像をそのまま使う
+EPUB_IMAGE_FORMATS = {
+    "JPEG": ("JPEG", ".jpg", "image/jpeg"),
+    "WebP": ("WEBP", ".webp", "image/webp"),
+    "そのまま": None,
+}
+EPUB_IMAGE_MAX_SIDE = {"cover": 2560, "figure": 1600}  # 長辺の上限px（表紙は Kindle 推奨の 1600x2560 に合わせる）
+EPUB_IMAGE_DEFAULT_QUALITY = 80
+EPUB_IMAGE_MIN_QUALITY = 50  # 容量の上限に収めるとき、ここまでは画質を下げる（それでも超えたら縮小する）
+EPUB_IMAGE_DEFAULT_BUDGET_MB = 30  # 本全体の画像の合計上限（0 で上限なし）
+EPUB_IMAGE_CACHE_DIR = os.path.join(APP_DATA_DIR, "image_cache")
+EPUB_IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+_MD_IMAGE_RE = re.compile(r"!\[[^\]]*\]\(\s*(?:<([^>\n]+)>|([^)\"'\n]+?))(?:\s+[\"'][^)\n]*)?\s*\)")
+_HTML_IMG_SRC_RE = re.compile(r"(<img\b[^>]*?\bsrc\s*=\s*)([\"'])(.*?)\2", re.I | re.S)
+_HTML_IMG_TAG_RE = re.compile(r"<img\b[^>]*>", re.I)
+_HTML_ALT_RE = re.compile(r"\balt\s*=\s*([\"'])(.*?)\1", re.I | re.S)
+
+
+def markdown_image_refs(md_text: str) -> list:
+    """Markdown の画像（![...](...) と <img src>）の参照先を、出てきた順に重複なしで返す。"""
+    refs = []
+    seen = set()
+    for m in itertools.chain(_MD_IMAGE_RE.finditer(md_text), _HTML_IMG_SRC_RE.finditer(md_text)):
+        ref = (m.group(1) or m.group(2)) if m.re is _MD_IMAGE_RE else m.group(3)
+        if ref not in seen:
+            seen.add(ref)
+            refs.append(ref)
+    return refs
+
+
+def local_image_path(ref: str, base_dir: str, confine: bool = False):
+    """画像の参照先をローカルファイルのパスにする（URL やファイルがないものは None）。
+
+    confine=True では、シンボリックリンクや ../ を解決した先が base_dir の外になるもの（絶対パスを含む）も None。
+    """
+    ref = html_lib.unescape(ref).strip()
+    if not ref or (re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*:", ref) and not re.match(r"^[a-zA-Z]:[\\/]", ref)):
+        return None  # http: / data: など（Windows のドライブ名は除く）
+    path = os.path.join(base_dir, urllib.parse.unquote(ref.split("#", 1)[0].split("?", 1)[0]))
+    if confine:
+        root = os.path.realpath(base_dir)
+        path = os.path.realpath(path)
+        try:
+            if os.path.commonpath([root, path]) != root:
+                return None
+        except ValueError:  # Windows で別のドライブ
+            return None
+    return path if os.path.isfile(path) else None
+
+
+def rewrite_img_src(html: str, src_map: dict) -> str:
+    """<img src> を src_map（元の参照先 → EPUB 内のパス）で置き換える。
+
+    src_map の値が None の画像（読み込めず EPUB に入れなかったもの）は、タグごと alt の文字に置き換える
+    （残すと EPUB 内にないファイルを指すことになり、epubcheck で弾かれる）。
+    """
+    if not src_map:
+        return html
+
+    def _sub_src(m):
+        new = src_map.get(html_lib.unescape(m.group(3)))
+        return m.group(0) if new is None else f"{m.group(1)}{m.group(2)}{new}{m.group(2)}"
+
+    def _sub_tag(m):
+        src = _HTML_IMG_SRC_RE.match(m.group(0))
+        if src is None:
+            return m.group(0)
+        ref = html_lib.unescape(src.group(3))
+        if ref in src_map and src_map[ref] is None:
+            alt = _HTML_ALT_RE.search(m.group(0))
+            return alt.group(2) if alt else ""
+        return _HTML_IMG_SRC_RE.sub(_sub_src, m.group(0))
+
+    return _HTML_IMG_TAG_RE.sub(_sub_tag, html)
+
+
+def prune_cache_dir(root_dir: str, max_bytes: int):
+    """root_dir/xx/ 以下のキャッシュの合計が max_bytes を超えたら、最後に使った時刻が古いものから消す。"""
+    files = []
+    total = 0
+    for sub in os.scandir(root_dir):
+        if not sub.is_dir():
+            continue
+        for e in os.scandir(sub.path):
+            st = e.stat()
+            files.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+    for _, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
+
+
+def optimize_image(src_path: str, pil_format: str, max_side: int, quality: int) -> bytes:
+    """長辺を max_side 以下に縮小し、pil_format で再圧縮する（EXIF・ICC などのメタデータは書かない）。"""
+    with Image.open(src_path) as im:
+        im = ImageOps.exif_transpose(im)  # 向きだけは EXIF に従って画素に反映してから捨てる
+        if im.mode in ("RGBA", "LA", "P"):
+            # 透過は白地に合成（JPEG は透過を持てない。スキャン画像なら白で問題ない）
+            im = im.convert("RGBA")
+            bg = Image.new("RGB", im.size, (255, 255, 255))
+            bg.paste(im, mask=im.getchannel("A"))
+            im = bg
+        elif im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")  # グレースケール（L）はそのまま残すと小さくなる
+        if max(im.size) > max_side:
+            im = im.copy()
+            im.thumbnail((max_side, max_side), Image.LANCZOS)
+        im.info = {}
+        buf = io.BytesIO()
+        if pil_format == "JPEG":
+            im.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            im.save(buf, pil_format, quality=quality, method=4)
+        return buf.getvalue()
+
+
+class ImageOptimizeCache:
+    """最適化した画像のディスクキャッシュ（キーは元画像のハッシュと変換条件）。"""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    @staticmethod
+    def key(src_sha: str, pil_format: str, max_side: int, quality: int) -> str:
+        return hashlib.sha256(f"{src_sha};{pil_format};{max_side};{quality}".encode("ascii")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root_dir, key[:2], key + ".img")
+
+    def get(self, key: str):
+        """キャッシュ済みならそのファイルのパスを返す。"""
+        path = self.path(key)
+        try:
+            os.utime(path)  # 古いものから捨てるため、使った時刻を更新
+        except OSError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class EpubImagePipeline:
+    """表紙・図版をリーダー向けの大きさに縮小・再圧縮し、本全体の合計を容量の上限に収める。
+
+    変換はスレッドプールで行い（Pillow は縮小・圧縮中に GIL を手放す）、結果は元画像の
+    ハッシュと変換条件をキーにディスクへキャッシュする。上限を超えたら画質を
+    EPUB_IMAGE_MIN_QUALITY まで 10 ずつ下げ、それでも超えたら長辺を 0.8 倍ずつ縮める。
+    """
+
+    MAX_ROUNDS = 8
+
+    def __init__(self, format_label: str, quality: int, budget_bytes: int, cache_dir: str = EPUB_IMAGE_CACHE_DIR):
+        self.spec = EPUB_IMAGE_FORMATS.get(format_label, EPUB_IMAGE_FORMATS["JPEG"])
+        self.quality = max(EPUB_IMAGE_MIN_QUALITY, min(100, int(quality)))
+        self.budget_bytes = max(0, int(budget_bytes))
+        self.cache_dir = cache_dir
+
+    def run(self, sources: list, progress=None):
+        """sources: [(元画像のパス, "cover" / "figure")]。
+
+        戻り値: ([(EPUB に入れるファイルのパス, 拡張子, メディアタイプ, 元画像のハッシュ) または None], 統計)
+        None は開けなかった画像（呼び出し側で省く）。
+        """
+        stats = {"images": len(sources), "source_bytes": 0, "bytes": 0, "quality": self.quality,
+                 "scale": 1.0, "over_budget": False, "failed": 0}
+        if not sources:
+            return [], stats
+        workers = max(1, min(4, os.cpu_count() or 1))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            shas = list(pool.map(file_sha256, [p for p, _ in sources]))
+            stats["source_bytes"] = sum(os.path.getsize(p) for p, _ in sources)
+            if self.spec is None:
+                out = []
+                for (path, _), sha in zip(sources, shas):
+                    ext = os.path.splitext(path)[1].lower() or ".png"
+                    out.append((path, ext, mimetypes.guess_type("x" + ext)[0] or "image/png", sha))
+                stats.update(bytes=stats["source_bytes"], quality=None)
+                return out, stats
+
+            cache = ImageOptimizeCache(self.cache_dir)
+            pil_format, ext, media_type = self.spec
+            quality, scale = self.quality, 1.0
+            for _ in range(self.MAX_ROUNDS):
+                futures = [
+                    pool.submit(self._one, cache, path, sha, pil_format,
+                                max(64, int(EPUB_IMAGE_MAX_SIDE[kind] * scale)), quality)
+                    for (path, kind), sha in zip(sources, shas)
+                ]
+                paths = []
+                try:
+                    for i, fut in enumerate(futures, start=1):
+                        paths.append(fut.result())
+                        if progress is not None:
+                            progress.report(
+                                f"画像を最適化中... {i}/{len(sources)}（画質 {quality}）",
+                                done=i, total=len(sources), unit="枚",
+                            )
+                except TaskCancelled:
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+                total = sum(os.path.getsize(p) for p in paths if p)
+                if not self.budget_bytes or total <= self.budget_bytes:
+                    break
+                if quality > EPUB_IMAGE_MIN_QUALITY:
+                    quality = max(EPUB_IMAGE_MIN_QUALITY, quality - 10)
+                else:
+                    scale *= 0.8
+            else:
+                stats["over_budget"] = True
+
+        try:
+            prune_cache_dir(self.cache_dir, EPUB_IMAGE_CACHE_MAX_BYTES)
+        except OSError:
+            pass
+        stats.update(bytes=total, quality=quality, scale=scale, failed=sum(1 for p in paths if not p))
+        return [(p, ext, media_type, sha) if p else None for p, sha in zip(paths, shas)], stats
+
+    @staticmethod
+    def _one(cache, path, sha, pil_format, max_side, quality):
+        key = cache.key(sha, pil_format, max_side, quality)
+        cached = cache.get(key)
+        if cached:
+            return cached
+        try:
+            data = optimize_image(path, pil_format, max_side, quality)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None  # 壊れた画像・Pillow が読めない形式・画素数が多すぎる画像
+        return cache.put(key, data)
+
+
+class OcrEpubStream:
+    """OCR の途中経過から下書き EPUB を作る（Tab1 の「OCRと同時にEPUBも作る」）。
+
+    ページが届くたびに、それまでのテキスト全体から Tab2-2 の本文構造ルールで章を求め直し、
+    閉じた章（最後の章以外）を先に HTML 化してキャッシュしておく。目次の「# 1」などで
+    本文開始位置が後から変わっても、最後の EPUB は output.md を Tab4 で作ったものと同じになる。
+    checkpoint_pages ページごとに途中経過の EPUB も書き出す。
+
+    OCR スレッドは増えた分のテキストを積むだけで、全体をつなぐのも章の割り出しも1本のワーカー
+    スレッドで行う。章の割り出しは最新のテキストで1回待っていれば足りるので、まだ始まっていない
+    ものがあれば新しくは頼まない（OCR が速いときは途中のページを飛ばして求め直す）。
+    """
+
+    def __init__(self, app, md_path: str, out_epub_path: str, title: str, author: str, compiled: dict,
+                 images_pipeline, checkpoint_pages: int = 0):
+        self.app = app
+        self.md_path = md_path
+        self.out_epub_path = out_epub_path
+        self.title = title
+        self.author = author
+        self.compiled = compiled
+        self.images_pipeline = images_pipeline
+        self.checkpoint_pages = max(0, int(checkpoint_pages))
+        self.max_bytes = EPUB_DEFAULT_MAX_KB * 1024
+        self.checkpoints = 0
+        try:
+            self._cache = MarkdownRenderCache(EPUB_RENDER_CACHE_DIR)
+        except OSError:
+            self._cache = None
+        self._submitted = set()  # HTML 化した章の (開始, 終了)。テキストは追記だけなので範囲が同じなら中身も同じ
+        self._parts = []  # OCR スレッドから届いたテキスト（つなぐのはワーカー側）
+        self._lock = threading.Lock()
+        self._plan_pending = False
+        self._checkpoint_future = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def add_page(self, text: str, pages_done: int):
+        """OCR スレッドから、前回から増えた分の Markdown を渡す（すぐ戻る）。"""
+        with self._lock:
+            self._parts.append(text)
+            count = len(self._parts)
+            submit_plan = not self._plan_pending
+            self._plan_pending = True
+        if submit_plan:
+            self._executor.submit(self._plan)
+        if self.checkpoint_pages and pages_done % self.checkpoint_pages == 0:
+            # 前の途中経過をまだ書いている間は、次のチェックポイントまで見送る
+            if self._checkpoint_future is None or self._checkpoint_future.done():
+                self._checkpoint_future = self._executor.submit(self._checkpoint, count, pages_done)
+
+    def finish(self, md_text: str) -> dict:
+        """最後の EPUB を作って統計を返す（先に頼んだ変換・途中経過が終わるのを待つ）。"""
+        return self._executor.submit(self._build, md_text).result()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _text(self, count=None) -> str:
+        with self._lock:
+            parts = self._parts[:count]
+        return "".join(parts)
+
+    def _plan(self):
+        """その時点までのテキストで章を求め直し、閉じた章を HTML 化する（ワーカースレッド）。"""
+        with self._lock:
+            self._plan_pending = False
+        md_text = self._text()
+        try:
+            spans = self.app._epub_split_chapters(md_text, "split2", self.max_bytes, self.compiled, quiet=True)
+        except Exception as e:
+            self.app.log(f"[WARN] 章の割り出しに失敗しました: {e}")
+            return
+        for a, b in spans[:-1]:
+            if (a, b) not in self._submitted:
+                self._submitted.add((a, b))
+                self._prerender(md_text[a:b])
+
+    def _prerender(self, chapter_md: str):
+        if self._cache is None:
+            return
+        key = self._cache.key(chapter_md)
+        if key in self._cache:
+            return
+        try:
+            self._cache.put(key, render_markdown_fragment(chapter_md))
+        except Exception as e:
+            self.app.log(f"[WARN] 章の先行変換に失敗しました: {e}")
+
+    def _checkpoint(self, count: int, pages_done: int):
+        try:
+            stats = self._build(self._text(count))
+        except Exception as e:
+            self.app.log(f"[WARN] 途中経過EPUBの書き出しに失敗しました: {e}")
+            return
+        self.checkpoints += 1
+        self.app.log(f"途中経過EPUB（{pages_done}ページ / {stats['chapters']}章）: {self.out_epub_path}")
+
+    def _build(self, md_text: str) -> dict:
+        return self.app._epub_build(
+            self.md_path, md_text, self.out_epub_path, self.title, self.author, "split2",
+            self.max_bytes, self.compiled, self.images_pipeline,
+        )
+
+
+# ==========================================
+# Tab2-2 ルビ行判定（コンパイル済み正規表現）
+# ==========================================
+_SPLIT2_TAG_RE = re.compile(r"<[^>]+>")
+_SPLIT2_ANY_KANJI_RE = re.compile(r"[\u4e00-\u9fff]")
+_SPLIT2_BASE_KANJI_RE = re.compile(r"[一-龠々]{2,}")
+_SPLIT2_KANA_RE = re.compile(r"[ぁ-ゖァ-ヶー]+")
+_SPLIT2_KANA_SPACE_RE = re.compile(r"[ぁ-ゖァ-ヶー ]+")
+_SPLIT2_MULTI_SPACE_RE = re.compile(r"\s{2,}")
+
+# 安全分割の出力（結合順・マニフェスト）と、検証時の読み込みブロックサイズ
+SPLIT2_ORDER_NAME = "_ORDER.txt"
+SPLIT2_MANIFEST_NAME = "_MANIFEST.json"
+SPLIT2_VERIFY_BLOCK_SIZE = 1024 * 1024
+
+# 本文構造ルール（教材シリーズごと）
+#  - first_chapter  : 「第1章」の候補になる行頭パターン
+#  - chapter        : 章境界になる行頭パターン（group1=章番号）
+#  - body_keyword   : 本文第1章の直後 body_keyword_window 文字以内に現れる目印（任意）
+#  - toc / index    : 目次見出し・索引見出し（行頭、任意）
+#  - index_after_chapter : この章番号の開始より後ろの索引見出しだけを採用（None なら最後の章の後ろ）
+#  ※ 名前付きグループは内部で使うため、各パターンでは使わない
+SPLIT2_STRUCTURE_RULESETS = {
+    "放送大学（15章）": {
+        "first_chapter": r"#\s+1(?:<br>|\s|$)",
+        "chapter": r"(?:#\s*)?(\d+)(?:<br>|\s+#)",
+        "body_keyword": r"《.*(?:ポイント|目標).*》",
+        "body_keyword_window": 1000,
+        "toc": r"#\s+目次",
+        "index": r"#\s+人名索引.*",
+        "index_after_chapter": 15,
+        "front_name": "00_前書き・目次.md",
+        "chapter_name": "{num:02d}_第{num}章.md",
+        "index_name": "16_索引・その他.md",
+    },
+    "汎用（# 数字 の章見出し）": {
+        "first_chapter": r"#\s+1(?:<br>|\s|$)",
+        "chapter": r"(?:#\s*)?(\d+)(?:<br>|\s+#)",
+        "body_keyword": None,
+        "body_keyword_window": 1000,
+        "toc": r"#+\s*(?:目次|もくじ|CONTENTS|Contents)",
+        "index": r"#+\s*(?:人名索引|事項索引|索引).*",
+        "index_after_chapter": None,
+        "front_name": "00_前書き・目次.md",
+        "chapter_name": "{num:02d}_第{num}章.md",
+        "index_name": "99_索引・その他.md",
+    },
+}
+SPLIT2_DEFAULT_RULESET = "放送大学（15章）"
+
+
+def compile_split2_rules(rules: dict) -> dict:
+    """構造ルールを、1回の finditer で章・目次・索引の境界を拾う結合パターンに変換する。
+
+    本文開始の目印（body_keyword）は結合パターンに入れず、第1章の候補ごとに直後の窓の中だけを探す
+    （全文で拾うと、行末まで伸びた目印が窓からはみ出したり、索引行の `.*` に飲まれたりして従来と食い違う）。
+    """
+    line_alts = []
+    for key in ("toc", "index"):
+        if rules.get(key):
+            line_alts.append(f"(?P<{key}>{rules[key]})")
+    # 章見出しは先読みで行頭位置だけを拾い、判定は元パターンをその位置で match する
+    # （見出しパターンが次の行まで食い込んでも、目次/索引の行頭を取りこぼさないため）
+    heads = [rules[key] for key in ("first_chapter", "chapter") if rules.get(key)]
+    if heads:
+        line_alts.append("(?P<heading>(?=" + "|".join(f"(?:{h})" for h in heads) + "))")
+    return {
+        "rules": rules,
+        "scan": re.compile("(?m)^(?:" + "|".join(line_alts) + ")") if line_alts else None,
+        "keyword": re.compile(rules["body_keyword"]) if rules.get("body_keyword") else None,
+        "first_chapter": re.compile(rules["first_chapter"]) if rules.get("first_chapter") else None,
+        "chapter": re.compile(rules["chapter"]) if rules.get("chapter") else None,
+    }
+
+
+# 行分類（_split2_classify_lines の戻り値）
+SPLIT2_LINE_OTHER = 0  # 非空行（漢字2字以上なし・ルビ候補でもない）
+SPLIT2_LINE_BLANK = 1  # タグ除去後に空
+SPLIT2_LINE_KANJI = 2  # 漢字2字以上を含む（ルビの対応先になりうる本文行）
+SPLIT2_LINE_RUBY = 3  # ルビ候補行（かなのみ／<small> 等）
+
+# ==========================================
+# ワークフロー（入力が変わった段階だけ再実行する OCR → 分割 → 結合 → EPUB）
+# ==========================================
+WORKFLOW_STATE_PATH = os.path.join(APP_DATA_DIR, "workflow", "state.json")
+WORKFLOW_MAX_WORKERS = 3  # 依存のない段階（下書きEPUBと分割など）を同時に動かす数
+WORKFLOW_FRESH = "最新"
+WORKFLOW_RERUN = "再実行"
+WORKFLOW_UPSTREAM = "上流しだい"  # 上流を作り直した結果、入力が同じなら実行しない
+# 作るもの（表示名 -> 段階名。None はすべて）
+WORKFLOW_TARGET_LABELS = {
+    "EPUB（結合MDから）": "book",
+    "結合MD": "merge",
+    "分割": "split",
+    "下書きEPUB（OCR結果から）": "draft",
+    "OCR": "ocr",
+    "すべて": None,
+}
+
+
+class ArtifactStore:
+    """成果物（ファイル・フォルダ）の内容ハッシュと、段階ごとの前回実行の記録を持つ。
+
+    state.json:
+      {"files": {path: [size, mtime_ns, sha256]},  サイズと更新時刻が同じならハッシュを再計算しない
+       "stages": {key: {"inputs": {名前: ハッシュ}, "outputs": {path: ハッシュ}, "time": ...}}}
+    """
+
+    # フォルダのハッシュに含めないファイル（分割のマニフェストは作成日時を持つため、中身が同じでも毎回変わる）
+    DIGEST_SKIP_NAMES = (SPLIT2_MANIFEST_NAME, SPLIT2_ORDER_NAME)
+
+    def __init__(self, path: str = WORKFLOW_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = {}
+        self._stages = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._files = data.get("files", {})
+            self._stages = data.get("stages", {})
+        except (OSError, ValueError):
+            pass
+
+    def digest(self, path: str) -> str:
+        """ファイルは内容の SHA256、フォルダは中のファイル（相対パスと内容）をまとめたもの。無ければ空文字。"""
+        if os.path.isdir(path):
+            h = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if root == path and name in self.DIGEST_SKIP_NAMES:
+                        continue
+                    p = os.path.join(root, name)
+                    h.update(os.path.relpath(p, path).replace(os.sep, "/").encode("utf-8") + b"\0")
+                    h.update(self.digest(p).encode("ascii") + b"\n")
+            return "dir:" + h.hexdigest()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return ""
+        key = os.path.abspath(path)
+        with self._lock:
+            memo = self._files.get(key)
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        sha = file_sha256(path)
+        with self._lock:
+            self._files[key] = [st.st_size, st.st_mtime_ns, sha]
+        return sha
+
+    def record(self, key: str):
+        with self._lock:
+            return self._stages.get(key)
+
+    def set_record(self, key: str, inputs: dict, outputs: dict):
+        with self._lock:
+            self._stages[key] = {"inputs": inputs, "outputs": outputs, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    def save(self):
+        # 同時に動く段階（下書きEPUBと分割など）から呼ばれるので、書き込みと置き換えまでロックの中で行う
+        with self._lock:
+            # 消えたファイルのハッシュは持ち越さない
+            self._files = {p: m for p, m in self._files.items() if os.path.exists(p)}
+            data = json.dumps({"files": self._files, "stages": self._stages}, ensure_ascii=False)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+
+
+class WorkflowStage:
+    """ワークフローの1段階。
+
+    inputs は固定の入力ファイル、deps は上流の段階名（その成果物が入力になる）、params は結果に効く設定
+    （JSON にできる値）。run(progress, upstream) は作った成果物のパスを返す（分割フォルダのように
+    実行ごとに名前が変わるものがあるため）。None なら outputs をそのまま成果物とする。
+    """
+
+    def __init__(self, name, label, run, key, deps=(), inputs=(), outputs=(), params=None):
+        self.name = name
+        self.label = label
+        self.run = run
+        self.key = key  # 記録のキー（出力先フォルダごとに分ける）
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+
+class WorkflowRunner:
+    """段階を依存順に実行し、入力（ファイル内容と設定）が前回と同じ段階は飛ばす。
+
+    成果物が消えていれば作り直すが、成果物を手で直しただけ（校正など）では作り直さない
+    （直した内容は下流の入力として扱われ、下流だけが再実行される）。
+    """
+
+    def __init__(self, stages: list, store: ArtifactStore, log=None):
+        self.stages = {s.name: s for s in stages}
+        self.order = [s.name for s in stages]  # 依存順に並んでいること
+        self.store = store
+        self.log = log or (lambda msg: None)
+
+    def closure(self, target) -> list:
+        """target（None なら全段階）と、その上流の段階名を依存順に返す。"""
+        if target is None:
+            return list(self.order)
+        need = set()
+        todo = [target]
+        while todo:
+            name = todo.pop()
+            if name not in need:
+                need.add(name)
+                todo.extend(self.stages[name].deps)
+        return [n for n in self.order if n in need]
+
+    def _outputs_of(self, stage, done: dict) -> list:
+        if stage.name in done:
+            return done[stage.name]
+        rec = self.store.record(stage.key)
+        return list(rec["outputs"]) if rec else list(stage.outputs)
+
+    def _inputs(self, stage, done: dict) -> dict:
+        inputs = {"params": hashlib.sha256(
+            json.dumps(stage.params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()}
+        for p in stage.inputs:
+            inputs[p] = self.store.digest(p)
+        # 上流の成果物はパスではなく「段階名と何番目か」で持つ（分割フォルダのように実行ごとに名前が
+        # 変わっても、中身が同じなら下流の入力は変わらない）
+        for dep in stage.deps:
+            for i, p in enumerate(self._outputs_of(self.stages[dep], done)):
+                inputs[f"@{dep}/{i}"] = self.store.digest(p)
+        return inputs
+
+    def _input_name(self, key: str) -> str:
+        if key.startswith("@"):
+            dep = key[1:].split("/", 1)[0]
+            if dep in self.stages:
+                return self.stages[dep].label
+        return os.path.basename(key)
+
+    def _judge(self, stage, inputs: dict):
+        """(判定, 理由) を返す。判定は WORKFLOW_FRESH か WORKFLOW_RERUN。"""
+        rec = self.store.record(stage.key)
+        if rec is None:
+            return WORKFLOW_RERUN, "前回の記録なし"
+        prev = rec.get("inputs", {})
+        if inputs.get("params") != prev.get("params"):
+            return WORKFLOW_RERUN, "設定が変わった"
+        changed = [p for p in inputs if p != "params" and inputs[p] != prev.get(p)]
+        if changed:
+            names = list(dict.fromkeys(self._input_name(p) + ("（なし）" if not inputs[p] else "") for p in changed))
+            return WORKFLOW_RERUN, "入力が変わった: " + ", ".join(names[:5]) + (" ..." if len(names) > 5 else "")
+        missing = [p for p in rec.get("outputs", {}) if not os.path.exists(p)]
+        if missing:
+            return WORKFLOW_RERUN, "成果物がない: " + ", ".join(os.path.basename(p) for p in missing[:5])
+        return WORKFLOW_FRESH, f"前回 {rec.get('time', '')}"
+
+    def plan(self, target=None) -> list:
+        """ドライラン。[(段階, 判定, 理由)] を依存順に返す（何も実行しない）。"""
+        rows = []
+        verdicts = {}
+        for name in self.closure(target):
+            stage = self.stages[name]
+            verdict, reason = self._judge(stage, self._inputs(stage, {}))
+            upstream = [d for d in stage.deps if verdicts[d] != WORKFLOW_FRESH]
+            if verdict == WORKFLOW_FRESH and upstream:
+                verdict = WORKFLOW_UPSTREAM
+                reason = "上流を再実行: " + ", ".join(self.stages[d].label for d in upstream)
+            verdicts[name] = verdict
+            rows.append((stage, verdict, reason))
+        return rows
+
+    def run(self, target, progress, on_stage=None) -> list:
+        """依存の済んだ段階から同時に実行する。on_stage(段階, 判定, 理由) はワーカースレッドから呼ばれる。"""
+        names = self.closure(target)
+        done = {}  # 段階名 -> 成果物のパス
+        rows = {}
+        error = None
+        pending = list(names)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKFLOW_MAX_WORKERS) as pool:
+            while pending or running:
+                if error is None:
+                    for name in [n for n in pending if all(d in done for d in self.stages[n].deps)]:
+                        pending.remove(name)
+                        running[pool.submit(self._run_stage, self.stages[name], done, progress, on_stage)] = name
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    try:
+                        done[name], rows[name] = fut.result()
+                    except Exception as e:
+                        # 失敗したら新しい段階は始めず、実行中のものが終わるのを待つ
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return [rows[n] for n in names]
+
+    def _run_stage(self, stage, done: dict, progress, on_stage):
+        progress.check()
+        inputs = self._inputs(stage, done)
+        verdict, reason = self._judge(stage, inputs)
+        if verdict == WORKFLOW_FRESH:
+            self.log(f"[ワークフロー] {stage.label}: 最新のため省略")
+            row = (stage, verdict, reason)
+            if on_stage is not None:
+                on_stage(*row)
+            return self._outputs_of(stage, {}), row
+
+        if on_stage is not None:
+            on_stage(stage, "実行中", reason)
+        self.log(f"[ワークフロー] {stage.label}: 実行（{reason}）")
+        sub = TaskProgress(lambda text, *counts: progress.report(f"{stage.label}: {text}", False, *counts))
+        sub.cancel_event = progress.cancel_event
+        upstream = {d: done[d] for d in stage.deps}
+        outputs = stage.run(sub, upstream)
+        if outputs is None:
+            outputs = list(stage.outputs)
+        digests = {p: self.store.digest(p) for p in outputs}
+        rec = self.store.record(stage.key)
+        same = rec is not None and list(rec.get("outputs", {}).values()) == list(digests.values())
+        self.store.set_record(stage.key, inputs, digests)
+        self.store.save()
+        if same:
+            # 成果物が前回と同じなら、下流は入力が変わらないので再実行されない
+            reason += "（成果物は前回と同じ）"
+        row = (stage, WORKFLOW_RERUN, reason)
+        if on_stage is not None:
+            on_stage(*row)
+        return outputs, row
+
+
 # ==========================================
 # ビジュアルクロップダイアログ
 # ==========================================
@@ -345,6 +2718,9 @@ class VisualCropDialog(tk.Toplevel):
 # メインアプリケーション
 # ==========================================
 class UnifiedYomitokuApp:
+    # EPUB に Markdown のフォルダの外（../ や絶対パス）の画像も入れるか
+    EPUB_IMAGES_OUTSIDE_FOLDER = True
+
     def __init__(self, root):
         self.root = root
         self.root.title("Yomitoku OCR & EPUB Workflow 統合ツール v5.9")
@@ -369,6 +2745,9 @@ class UnifiedYomitokuApp:
         self.tab_control.add(self.tab_epub, text="4. EPUB化")
         self.tab_control.add(self.tab_tools, text="5. その他")
 
+        # 分割・結合・EPUB・OCR などの重い処理は共通のジョブ管理で実行する（タブごとに1本ずつ同時に動ける）
+        self.jobs = JobManager(lambda fn: self.root.after(0, fn))
+
         self.create_menu()
         self.init_tab_ocr()
         self.init_tab_split()
@@ -382,6 +2761,7 @@ class UnifiedYomitokuApp:
 
         self._split_preview_params = None
         self._last_split_preview_plan = None
+        self._split_plan_cache = SplitPlanCache()
 
     def safe_showinfo(self, title, message):
         if threading.current_thread() is threading.main_thread():
@@ -395,6 +2775,37 @@ class UnifiedYomitokuApp:
         else:
             self.root.after(0, lambda: messagebox.showerror(title, message))
 
+    def _start_text_task(self, title: str, work, on_done, status_label, on_error=None) -> bool:
+        """work(progress) をジョブとして実行し、結果を Tk スレッドの on_done(result) へ戻す。
+
+        実行中は status_label に進捗を表示し、cancel_text_task(status_label) でキャンセルできる。
+        同じ status_label の処理（同じタブの処理）は同時に1本だけ。
+        """
+
+        def _event(ev):
+            if ev.kind == "progress":
+                status_label.config(text=ev.text, foreground="gray")
+            elif ev.state == JOB_CANCELLED:
+                status_label.config(text="キャンセルしました", foreground="gray")
+                self.log(f"{title}をキャンセルしました。")
+
+        def _error(e):
+            status_label.config(text="失敗", foreground="gray")
+            if on_error is not None:
+                on_error(e)
+            else:
+                self.safe_showerror("エラー", f"{title}に失敗しました:\n{e}")
+
+        job = self.jobs.submit(title, work, on_done, _error, _event, slot=status_label)
+        if job is None:
+            self.safe_showerror("実行中", "このタブの処理を実行中です。完了するか『キャンセル』してから再実行してください。")
+            return False
+        status_label.config(text=f"{title}...", foreground="gray")
+        return True
+
+    def cancel_text_task(self, status_label):
+        self.jobs.cancel_slot(status_label)
+
     def create_menu(self):
         menubar = tk.Menu(self.root)
         help_menu = tk.Menu(menubar, tearoff=0)
@@ -421,7 +2832,8 @@ class UnifiedYomitokuApp:
             "  (6) 『OCR実行』で処理開始\n\n"
             "■ 出力\n"
             "  output.md（本文 + ページ画像リンク）\n"
-            "  assets/（各ページ画像）\n\n"
+            "  assets/（各ページ画像）\n"
+            "  output.epub（『OCRと同時に下書きEPUBも作る』をオンにした場合。途中経過も指定ページごとに上書き）\n\n"
             "■ 補足\n"
             "  ・CUDAメモリ不足などの場合、CPUへ切替して続行する場合があります。\n"
             "  ・暗号化（パスワード保護）PDFの疑いがある場合はエラー表示します。\n\n"
@@ -433,7 +2845,12 @@ class UnifiedYomitokuApp:
             "■ 主な項目\n"
             "  ・分割数：例）16\n"
             "  ・見出しレベル(1-6)：^#{1,N}\\s の見出しを「分割の境界」として扱います。\n"
-            "    - 例）1なら『# 』のみを境界にするため、OCRで###が大量に混ざっても影響を受けにくいです。\n\n"
+            "    - 例）1なら『# 』のみを境界にするため、OCRで###が大量に混ざっても影響を受けにくいです。\n"
+            "  ・分割方法：\n"
+            "    - ブロック数で均等（従来）：見出しブロック数を分割数で等分します。\n"
+            "    - サイズ均等：分割数以内で、最大のファイルサイズが最小になる見出し位置で区切ります。\n"
+            "    - 上限Bytes／上限トークン（推定）：1ファイルが上限値以下になる最小ファイル数で区切ります。\n"
+            "      （見出し間が上限より大きい場合は分割できず、『上限超過』として集計表示します）\n\n"
             "■ テスト（サイズ確認）\n"
             "  ・『テスト（サイズ確認）』はファイル書き出しをせず、\n"
             "    分割後の各ファイルの想定サイズ/行数/文字数/既存ファイル有無を一覧表示します。\n"
@@ -478,6 +2895,9 @@ class UnifiedYomitokuApp:
         self.log_text.pack(fill="both", expand=True)
 
     def log(self, message):
+        if threading.current_thread() is not threading.main_thread():
+            self.root.after(0, lambda: self.log(message))
+            return
         if not self.log_text.winfo_exists():
             return
         self.log_text.insert(tk.END, message + "\n")
@@ -537,10 +2957,25 @@ class UnifiedYomitokuApp:
         ttk.Entry(row5, textvariable=self.bottom_crop_var, width=6).pack(side="left", padx=5)
         ttk.Button(row5, text="ビジュアル範囲指定", command=self.open_visual_crop_dialog).pack(side="left", padx=10)
 
+        row5b = ttk.Frame(frm)
+        row5b.pack(fill="x", pady=5)
+        self.ocr_stream_epub_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            row5b, text="OCRと同時に下書きEPUBも作る（Tab2-2の本文構造ルールで章分け / 画像はTab4の設定）",
+            variable=self.ocr_stream_epub_var,
+        ).pack(side="left")
+        ttk.Label(row5b, text="途中経過:").pack(side="left", padx=(10, 0))
+        self.ocr_epub_checkpoint_var = tk.IntVar(value=20)
+        ttk.Spinbox(row5b, from_=0, to=500, increment=5, textvariable=self.ocr_epub_checkpoint_var, width=5).pack(
+            side="left", padx=5
+        )
+        ttk.Label(row5b, text="ページごと（0で最後だけ）").pack(side="left")
+
         row6 = ttk.Frame(frm)
         row6.pack(fill="x", pady=10)
         self.btn_run_ocr = ttk.Button(row6, text="OCR実行", command=self.run_ocr_thread)
         self.btn_run_ocr.pack(side="left", padx=5)
+        ttk.Button(row6, text="停止", command=lambda: self.jobs.cancel_slot(self.lbl_status)).pack(side="left")
 
         self.progress_var = tk.DoubleVar(value=0.0)
         self.progress_bar = ttk.Progressbar(row6, variable=self.progress_var, maximum=100)
@@ -549,8 +2984,8 @@ class UnifiedYomitokuApp:
         self.lbl_status.pack(side="left")
 
         self.analyzer = None
-        self.ocr_thread = None
-        self.stop_event = threading.Event()
+        # Tab1 の OCR とワークフローの OCR 段階は、解析器・進捗バー・出力先（assets）を共有するので1本ずつ
+        self.ocr_lock = threading.Lock()
 
     def select_pdf(self):
         p = filedialog.askopenfilename(filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")])
@@ -587,23 +3022,41 @@ class UnifiedYomitokuApp:
         VisualCropDialog(self.root, pdf_path, poppler_path, self.top_crop_var.get(), self.bottom_crop_var.get(), cb)
 
     def run_ocr_thread(self):
-        if self.ocr_thread and self.ocr_thread.is_alive():
-            self.safe_showerror("実行中", "OCR処理が実行中です。")
+        if self.jobs.active(self.lbl_status) or self.ocr_lock.locked():
+            self.safe_showerror("実行中", "OCR処理が実行中です（Tab1 またはワークフロー）。")
             return
 
-        self.stop_event.clear()
+        def _work(progress):
+            ok = self.process_ocr(progress=progress)
+            if progress.cancel_event.is_set():
+                raise TaskCancelled()
+            return ok
+
+        # 進捗は process_ocr が Tab1 のバーに出す。キャンセルはページごとにこのジョブの cancel_event で見る
+        self.jobs.submit("OCR", _work, slot=self.lbl_status)
         self.btn_run_ocr.config(state="disabled")
         self.lbl_status.config(text="準備中...")
 
-        self.ocr_thread = threading.Thread(target=self.process_ocr)
-        self.ocr_thread.daemon = True
-        self.ocr_thread.start()
-
     def update_ocr_progress(self, pct, text):
         self.progress_var.set(pct)
         self.lbl_status.config(text=text)
 
-    def process_ocr(self):
+    def process_ocr(self, stream_epub=None, notify: bool = True, progress=None) -> bool:
+        """Tab1 の設定で OCR して output.md / cover.png を書き出す（ワーカースレッドで呼ぶ）。
+
+        stream_epub が None なら Tab1 のチェックに従う。progress があればページ数を報告し、
+        その cancel_event でページごとに止まる（停止はこの実行だけに効く）。最後まで書き出せたら True を返す。
+        別の OCR（Tab1 / ワークフロー）が実行中なら RuntimeError。
+        """
+        if not self.ocr_lock.acquire(blocking=False):
+            raise RuntimeError("OCR処理が実行中です（Tab1 またはワークフロー）。")
+        try:
+            return self._process_ocr(stream_epub, notify, progress)
+        finally:
+            self.ocr_lock.release()
+
+    def _process_ocr(self, stream_epub, notify: bool, progress) -> bool:
+        stop_event = progress.cancel_event if progress is not None else threading.Event()
         pdf_path = self.pdf_path_var.get()
         poppler_path = self.poppler_path_var.get()
         out_dir = self.output_dir_var.get()
@@ -611,23 +3064,31 @@ class UnifiedYomitokuApp:
         end_page = self.page_end_var.get()
         top_pct = self.top_crop_var.get()
         bottom_pct = self.bottom_crop_var.get()
+        if stream_epub is None:
+            stream_epub = bool(self.ocr_stream_epub_var.get())
+        try:
+            epub_checkpoint_pages = max(0, int(self.ocr_epub_checkpoint_var.get()))
+        except Exception:
+            epub_checkpoint_pages = 0
 
         if not pdf_path or not os.path.exists(pdf_path):
             self.root.after(0, lambda: self.safe_showerror("エラー", "PDFファイルを指定してください"))
             self.root.after(0, lambda: self.btn_run_ocr.config(state="normal"))
-            return
+            return False
         if not poppler_path or not os.path.exists(poppler_path):
             self.root.after(0, lambda: self.safe_showerror("エラー", "Popplerパスを指定してください"))
             self.root.after(0, lambda: self.btn_run_ocr.config(state="normal"))
-            return
+            return False
         if not out_dir:
             self.root.after(0, lambda: self.safe_showerror("エラー", "出力先フォルダを指定してください"))
             self.root.after(0, lambda: self.btn_run_ocr.config(state="normal"))
-            return
+            return False
 
         os.makedirs(out_dir, exist_ok=True)
 
         md_out_path = os.path.join(out_dir, "output.md")
+        epub_out_path = os.path.join(out_dir, "output.epub")
+        epub_stream = None
 
         # 旧仕様との互換のため assets フォルダは残すが、クロップ画像（作業用）の残骸は必ず消す
         assets_dir = os.path.join(out_dir, "assets")
@@ -672,6 +3133,9 @@ class UnifiedYomitokuApp:
             戻り値: (results, cv2_img_bgr)
             """
             if cv2 is None or np is None:
+                if isinstance(self.analyzer, StubDocumentAnalyzer):
+                    # スタブは画像の大きさしか見ないので PIL のまま渡す
+                    return self.analyzer(pil_img), None
                 raise RuntimeError("opencv-python / numpy が読み込めません")
             rgb = np.array(pil_img)
             if rgb.ndim == 2:
@@ -945,6 +3409,7 @@ class UnifiedYomitokuApp:
             md = _separate_ruby_lines(md, ruby_tokens)
             return md
 
+        ok = False
         try:
             try:
                 info = pdfinfo_from_path(pdf_path, poppler_path=poppler_path)
@@ -954,7 +3419,7 @@ class UnifiedYomitokuApp:
                     _safe_after(lambda: self.safe_showerror("PDFエラー", "PDFがパスワード保護されている可能性があります。解除してから再試行してください。"))
                 else:
                     _safe_after(lambda: self.safe_showerror("PDFエラー", f"PDF情報取得に失敗しました:\n{e}"))
-                return
+                return False
 
             if start_page < 1:
                 start_page = 1
@@ -983,6 +3448,21 @@ class UnifiedYomitokuApp:
             pages_to_process = end_page - start_page + 1
             md_lines = []
             md_lines.append(f"\n\n")
+            streamed_lines = 0  # 下書き EPUB に渡し済みの md_lines の数
+
+            if stream_epub:
+                # 閉じた章から先に HTML 化し、途中経過の EPUB も書き出す（OCR 完了時にすぐ EPUB ができる）
+                epub_stream = OcrEpubStream(
+                    self,
+                    md_out_path,
+                    epub_out_path,
+                    os.path.splitext(os.path.basename(pdf_path))[0],
+                    self.epub_author_var.get(),
+                    self._split2_get_rules(),
+                    self._epub_image_pipeline_from_ui(),
+                    epub_checkpoint_pages,
+                )
+                self.log(f"【出力】EPUB（下書き）: {os.path.basename(epub_out_path)}")
 
             # ---- 表紙（無加工）を保存：クロップ前画像を表紙に使う（方針2） ----
             cover_path = os.path.join(out_dir, "cover.png")
@@ -1007,11 +3487,19 @@ class UnifiedYomitokuApp:
                     self.log(f"[WARN] 表紙画像の事前抽出に失敗しました: {e}")
 
             for idx, p in enumerate(range(start_page, end_page + 1), start=1):
-                if self.stop_event.is_set():
+                if stop_event.is_set():
                     self.log("停止要求を受け取りました。")
                     break
 
                 pct = (idx / max(1, pages_to_process)) * 100.0
+                if progress is not None:
+                    try:
+                        progress.report(
+                            f"OCR中... {idx}/{pages_to_process}", done=idx - 1, total=pages_to_process, unit="ページ"
+                        )
+                    except TaskCancelled:
+                        # 次のページの前で止まる
+                        stop_event.set()
                 _safe_after(lambda pct=pct, idx=idx, total=pages_to_process: self.update_ocr_progress(pct, f"OCR中... {idx}/{total}"))
 
                 try:
@@ -1082,6 +3570,9 @@ class UnifiedYomitokuApp:
                 # ---- まとめ出力 ----
                 md_lines.append("\n\n")  # ページ区切り（ページ番号は出力しない）
                 md_lines.append(page_md.rstrip() + "\n")
+                if epub_stream is not None:
+                    epub_stream.add_page("".join(md_lines[streamed_lines:]), idx)
+                    streamed_lines = len(md_lines)
 
                 del imgs
                 del img
@@ -1091,11 +3582,32 @@ class UnifiedYomitokuApp:
                     pass
                 gc.collect()
 
+            if progress is not None and not stop_event.is_set():
+                try:
+                    # ページごとの報告は間引かれるので、最後の件数をここで確定させる
+                    progress.report(
+                        "Markdownを書き出し中...", force=True,
+                        done=pages_to_process, total=pages_to_process, unit="ページ",
+                    )
+                except TaskCancelled:
+                    stop_event.set()
+
             try:
                 with open(md_out_path, "w", encoding="utf-8") as f:
                     f.writelines(md_lines)
                 self.log(f"Markdownを書き出しました: {md_out_path}")
-                _safe_after(lambda: self.safe_showinfo("完了", f"OCRが完了しました。\n{md_out_path}"))
+                done_msg = f"OCRが完了しました。\n{md_out_path}"
+                if epub_stream is not None:
+                    _safe_after(lambda: self.update_ocr_progress(100.0, "EPUBを仕上げ中..."))
+                    try:
+                        self._epub_log_stats(epub_stream.finish("".join(md_lines)))
+                        self.log(f"EPUB作成: {epub_out_path}")
+                        done_msg += f"\n{epub_out_path}"
+                    except Exception as e:
+                        self.log(f"[ERROR] EPUB作成失敗: {e}")
+                ok = not stop_event.is_set()
+                if notify:
+                    _safe_after(lambda: self.safe_showinfo("完了", done_msg))
             except Exception as e:
                 self.log(f"[ERROR] Markdown書き出し失敗: {e}")
                 _safe_after(lambda: self.safe_showerror("エラー", f"Markdownの書き出しに失敗しました:\n{e}"))
@@ -1104,6 +3616,8 @@ class UnifiedYomitokuApp:
             self.log("【致命的エラー】\n" + traceback.format_exc())
             _safe_after(lambda: self.safe_showerror("致命的エラー", f"OCR処理中にエラーが発生しました:\n{e}"))
         finally:
+            if epub_stream is not None:
+                epub_stream.close()
             # クロップ画像（assetsフォルダ）を必ず消す
             try:
                 _clear_dir_files(assets_dir)
@@ -1111,6 +3625,7 @@ class UnifiedYomitokuApp:
                 pass
             _safe_after(lambda: self.btn_run_ocr.config(state="normal"))
             _safe_after(lambda: self.update_ocr_progress(0.0, "待機中"))
+        return ok
 
     # ==========================================
     # Tab 2: MD分割（テスト + ダブルクリックプレビュー + JSON書き出し）
@@ -1136,6 +3651,21 @@ class UnifiedYomitokuApp:
         self.split_header_level_var = tk.IntVar(value=1)
         ttk.Spinbox(row2, from_=1, to=6, textvariable=self.split_header_level_var, width=6).pack(side="left", padx=5)
 
+        row2b = ttk.Frame(frm)
+        row2b.pack(fill="x", pady=5)
+        ttk.Label(row2b, text="分割方法:").pack(side="left")
+        self.split_mode_var = tk.StringVar(value=list(SPLIT_MODE_LABELS.keys())[0])
+        ttk.Combobox(
+            row2b,
+            textvariable=self.split_mode_var,
+            values=list(SPLIT_MODE_LABELS.keys()),
+            state="readonly",
+            width=30,
+        ).pack(side="left", padx=5)
+        ttk.Label(row2b, text="上限値（上限指定時のみ）:").pack(side="left", padx=(20, 0))
+        self.split_limit_var = tk.IntVar(value=60000)
+        ttk.Entry(row2b, textvariable=self.split_limit_var, width=10).pack(side="left", padx=5)
+
         row3 = ttk.Frame(frm)
         row3.pack(fill="x", pady=5)
         ttk.Label(row3, text="出力先(任意):").pack(side="left")
@@ -1148,6 +3678,10 @@ class UnifiedYomitokuApp:
         ttk.Button(row4, text="テスト（サイズ確認）", command=self.run_split_preview).pack(side="left", padx=5)
         ttk.Button(row4, text="分割実行", command=self.run_split).pack(side="left", padx=5)
         ttk.Button(row4, text="JSON書き出し", command=self.export_split_preview_json).pack(side="left", padx=5)
+        ttk.Button(row4, text="チャンクJSONL書き出し", command=self.export_split_chunk_batch).pack(side="left")
+        ttk.Button(row4, text="キャンセル", command=lambda: self.cancel_text_task(self.lbl_split_status)).pack(
+            side="left", padx=5
+        )
 
         self.lbl_split_status = ttk.Label(row4, text="")
         self.lbl_split_status.pack(side="left", padx=10)
@@ -1155,8 +3689,9 @@ class UnifiedYomitokuApp:
         preview_frame = ttk.LabelFrame(frm, text="分割テスト結果（書き出しなし） ※ダブルクリックで内容プレビュー")
         preview_frame.pack(fill="both", expand=True, pady=(5, 0))
 
-        columns = ("no", "name", "kb", "bytes", "lines", "chars", "blocks", "exists")
+        columns = ("no", "name", "kb", "bytes", "lines", "chars", "tokens", "blocks", "exists")
         self.split_preview_tree = ttk.Treeview(preview_frame, columns=columns, show="headings", height=10)
+        self._split_preview_rows = TreeRows(self.split_preview_tree)
 
         self.split_preview_tree.heading("no", text="No")
         self.split_preview_tree.heading("name", text="出力ファイル名")
@@ -1164,6 +3699,7 @@ class UnifiedYomitokuApp:
         self.split_preview_tree.heading("bytes", text="Bytes")
         self.split_preview_tree.heading("lines", text="行数")
         self.split_preview_tree.heading("chars", text="文字数")
+        self.split_preview_tree.heading("tokens", text="推定トークン")
         self.split_preview_tree.heading("blocks", text="ブロック数")
         self.split_preview_tree.heading("exists", text="既存")
 
@@ -1173,6 +3709,7 @@ class UnifiedYomitokuApp:
         self.split_preview_tree.column("bytes", width=110, anchor="e")
         self.split_preview_tree.column("lines", width=80, anchor="e")
         self.split_preview_tree.column("chars", width=90, anchor="e")
+        self.split_preview_tree.column("tokens", width=90, anchor="e")
         self.split_preview_tree.column("blocks", width=90, anchor="e")
         self.split_preview_tree.column("exists", width=60, anchor="center")
 
@@ -1198,8 +3735,7 @@ class UnifiedYomitokuApp:
 
     def _clear_split_preview(self):
         try:
-            for item in self.split_preview_tree.get_children():
-                self.split_preview_tree.delete(item)
+            self._split_preview_rows.clear()
         except Exception:
             pass
         try:
@@ -1220,52 +3756,82 @@ class UnifiedYomitokuApp:
             out_dir = None
 
         try:
-            plan = self.build_split_plan(src_path, split_num, header_level, out_dir, include_text=False)
+            mode, limit = self._get_split_partition_params()
+        except Exception as e:
+            self.safe_showerror("エラー", str(e))
+            return
+
+        def _work(progress):
+            return self.build_split_plan(
+                src_path, split_num, header_level, out_dir, include_text=False, mode=mode, max_size=limit,
+                progress=progress,
+            )
+
+        def _done(plan):
             self.update_split_preview(plan)
             self.lbl_split_status.config(text="テスト完了")
 
-            self._split_preview_params = (src_path, split_num, header_level, out_dir)
+            self._split_preview_params = (src_path, split_num, header_level, out_dir, mode, limit)
             self._last_split_preview_plan = plan
 
-        except Exception as e:
+        def _error(e):
             self.safe_showerror("エラー", str(e))
             self.lbl_split_status.config(text="テスト失敗")
             self._split_preview_params = None
             self._last_split_preview_plan = None
 
+        self._start_text_task("テスト中", _work, _done, self.lbl_split_status, on_error=_error)
+
+    def _get_split_partition_params(self):
+        """Tab2-1の分割方法（内部キー）と上限値を返す。上限値は上限指定モード以外では None。"""
+        mode = SPLIT_MODE_LABELS.get(self.split_mode_var.get(), "blocks")
+        limit = None
+        if mode in ("max_bytes", "max_tokens"):
+            try:
+                limit = int(self.split_limit_var.get())
+            except Exception:
+                limit = 0
+            if limit <= 0:
+                raise ValueError("上限値には1以上の整数を指定してください")
+        return mode, limit
+
     def update_split_preview(self, plan):
-        self._clear_split_preview()
         if not plan:
+            self._clear_split_preview()
             self.lbl_split_preview_summary.config(text="分割案が生成されませんでした。", foreground="gray")
             return
 
         sizes = []
         exists_count = 0
         total_bytes = 0
+        max_tokens = 0
+        rows = []
 
         for it in plan:
             b = int(it.get("bytes", 0))
             kb = b / 1024.0
             total_bytes += b
             sizes.append(b)
+            max_tokens = max(max_tokens, int(it.get("tokens", 0)))
             exists = "YES" if it.get("exists", False) else ""
             if exists:
                 exists_count += 1
 
-            self.split_preview_tree.insert(
-                "",
-                "end",
-                values=(
+            rows.append(
+                (
                     it.get("index", ""),
                     it.get("name", ""),
                     f"{kb:,.1f}",
                     f"{b:,}",
                     f"{int(it.get('lines', 0)):,}",
                     f"{int(it.get('chars', 0)):,}",
+                    f"{int(it.get('tokens', 0)):,}",
                     f"{int(it.get('blocks', 0)):,}",
                     exists,
-                ),
+                )
             )
+        # 前回表示との差分だけを反映（同じ分割案の再テストなら何も書き換えない）
+        self._split_preview_rows.sync(rows)
 
         min_b = min(sizes) if sizes else 0
         max_b = max(sizes) if sizes else 0
@@ -1273,13 +3839,68 @@ class UnifiedYomitokuApp:
 
         msg = (
             f"件数={len(plan)} / 合計={total_bytes/1024.0:,.1f} KB / "
-            f"最小={min_b/1024.0:,.1f} KB / 平均={avg_b/1024.0:,.1f} KB / 最大={max_b/1024.0:,.1f} KB"
+            f"最小={min_b/1024.0:,.1f} KB / 平均={avg_b/1024.0:,.1f} KB / 最大={max_b/1024.0:,.1f} KB / "
+            f"最大推定トークン={max_tokens:,}"
         )
+        oversize = [it for it in plan if it.get("oversize")]
+        if oversize:
+            msg += f" / 上限超過={len(oversize)}件（見出し間が上限より大きいため分割不可）"
         if exists_count > 0:
             msg += f" / 既存ファイル={exists_count}件（上書き確認あり）"
 
         self.lbl_split_preview_summary.config(text=msg, foreground="black")
 
+    def _ask_chunk_batch_path(self, src_path: str):
+        initialdir = None
+        base_name = "chunks.batch.jsonl"
+        if src_path and os.path.exists(src_path):
+            base_name = f"{os.path.splitext(os.path.basename(src_path))[0]}.batch.jsonl"
+            initialdir = os.path.dirname(src_path)
+        return filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            filetypes=[("JSONL", "*.jsonl"), ("All files", "*.*")],
+            initialfile=base_name,
+            initialdir=initialdir,
+        )
+
+    def _chunk_batch_settings(self):
+        """Tab5 で選んだバッチ形式とモデル名。"""
+        fmt = CHUNK_BATCH_FORMATS.get(self.chunk_batch_format_var.get(), "openai")
+        model = self.chunk_batch_model_var.get().strip() or CHUNK_BATCH_DEFAULT_MODELS[fmt]
+        return fmt, model
+
+    def _on_chunk_batch_format(self, _event=None):
+        # モデル名が別の形式の既定のままなら、選んだ形式の既定に替える
+        fmt = CHUNK_BATCH_FORMATS.get(self.chunk_batch_format_var.get(), "openai")
+        if self.chunk_batch_model_var.get().strip() in ("", *CHUNK_BATCH_DEFAULT_MODELS.values()):
+            self.chunk_batch_model_var.set(CHUNK_BATCH_DEFAULT_MODELS[fmt])
+
+    def export_split_chunk_batch(self):
+        """テスト結果の分割案どおりに、全チャンクを1つの JSONL バッチへ書き出す。"""
+        params = self._split_preview_params
+        if not params:
+            self.safe_showerror("エラー", "分割テスト結果がありません。先に「テスト（サイズ確認）」を実行してください。")
+            return
+        src_path, split_num, header_level, out_dir, mode, limit = params
+        save_path = self._ask_chunk_batch_path(src_path)
+        if not save_path:
+            return
+        fmt, model = self._chunk_batch_settings()
+
+        def _work(progress):
+            plan = self.build_split_plan(
+                src_path, split_num, header_level, out_dir, include_text=True, mode=mode, max_size=limit,
+                progress=progress,
+            )
+            return write_chunk_batch(save_path, ((it["name"], it["text"]) for it in plan), fmt, model)
+
+        def _done(n):
+            self.lbl_split_status.config(text="JSONL書き出し完了")
+            self.log(f"チャンクJSONL（{fmt} / {model}）: {save_path}（{n}件）")
+            self.safe_showinfo("完了", f"{n}件のチャンクを書き出しました。\n{save_path}")
+
+        self._start_text_task("JSONL書き出し", _work, _done, self.lbl_split_status)
+
     def export_split_preview_json(self):
         if not self._last_split_preview_plan:
             self.safe_showerror("エラー", "分割テスト結果がありません。先に「テスト（サイズ確認）」を実行してください。")
@@ -1307,34 +3928,62 @@ class UnifiedYomitokuApp:
 
         params = self._split_preview_params
         if params:
-            src_path_p, split_num_p, header_level_p, out_dir_p = params
+            src_path_p, split_num_p, header_level_p, out_dir_p, mode_p, limit_p = params
         else:
             src_path_p = src_path
             split_num_p = self.split_count_var.get()
             header_level_p = self.split_header_level_var.get()
             out_dir_p = (self.split_output_dir_var.get().strip() or None)
+            mode_p, limit_p = SPLIT_MODE_LABELS.get(self.split_mode_var.get(), "blocks"), None
+
+        # テスト後に入力MDが変更されていれば、キャッシュ経由で分割案を作り直してから書き出す
+        plan = self._last_split_preview_plan
+        source_sha256 = None
+        if params:
+            try:
+                plan = self.build_split_plan(
+                    src_path_p, split_num_p, header_level_p, out_dir_p, include_text=False, mode=mode_p, max_size=limit_p
+                )
+                file_key = self._split_plan_cache.file_key()
+                source_sha256 = file_key[3] if file_key else None
+                if [(it["start"], it["end"]) for it in plan] != [
+                    (it.get("start"), it.get("end")) for it in self._last_split_preview_plan
+                ]:
+                    self.log("【Info】入力MDが変更されていたため、分割案を作り直して書き出します。")
+                    self.update_split_preview(plan)
+                self._last_split_preview_plan = plan
+            except Exception as e:
+                self.safe_showerror("エラー", f"分割案の再確認に失敗しました:\n{e}")
+                return
 
         payload = {
             "type": "md_split_preview",
             "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
             "source_md": src_path_p,
+            "source_sha256": source_sha256,
             "split_count": int(split_num_p),
             "header_level": int(header_level_p),
+            "mode": mode_p,
+            "max_size": limit_p,
             "output_dir": out_dir_p,
             "rows": [],
         }
 
-        for it in self._last_split_preview_plan:
+        for it in plan:
             payload["rows"].append(
                 {
                     "index": int(it.get("index", 0)),
                     "name": it.get("name"),
                     "path": it.get("path"),
+                    "start": int(it.get("start", 0)),
+                    "end": int(it.get("end", 0)),
                     "bytes": int(it.get("bytes", 0)),
                     "lines": int(it.get("lines", 0)),
                     "chars": int(it.get("chars", 0)),
+                    "tokens": int(it.get("tokens", 0)),
                     "blocks": int(it.get("blocks", 0)),
                     "exists": bool(it.get("exists", False)),
+                    "oversize": bool(it.get("oversize", False)),
                 }
             )
 
@@ -1370,14 +4019,21 @@ class UnifiedYomitokuApp:
             out_dir = self.split_output_dir_var.get().strip()
             if out_dir == "":
                 out_dir = None
-            params = (src_path, split_num, header_level, out_dir)
+            try:
+                mode, limit = self._get_split_partition_params()
+            except Exception as e:
+                self.safe_showerror("エラー", str(e))
+                return
+            params = (src_path, split_num, header_level, out_dir, mode, limit)
         else:
             params = self._split_preview_params
 
-        src_path, split_num, header_level, out_dir = params
+        src_path, split_num, header_level, out_dir, mode, limit = params
 
         try:
-            plan_text = self.build_split_plan(src_path, split_num, header_level, out_dir, include_text=True)
+            plan_text = self.build_split_plan(
+                src_path, split_num, header_level, out_dir, include_text=True, mode=mode, max_size=limit
+            )
             target = None
             for it in plan_text:
                 if int(it.get("index", -1)) == idx:
@@ -1408,15 +4064,30 @@ class UnifiedYomitokuApp:
             out_dir = None
 
         try:
-            self.split_markdown_file(src_path, split_num, header_level, out_dir)
-            self.lbl_split_status.config(text="分割完了")
+            mode, limit = self._get_split_partition_params()
         except Exception as e:
             self.safe_showerror("エラー", str(e))
-            self.lbl_split_status.config(text="分割失敗")
-
-    def build_split_plan(self, src_path, split_num, header_level=6, output_dir=None, include_text=False):
-        with open(src_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+            return
+        self.split_markdown_file(src_path, split_num, header_level, out_dir, mode=mode, max_size=limit)
+
+    def build_split_plan(
+        self, src_path, split_num, header_level=6, output_dir=None, include_text=False, mode="blocks", max_size=None,
+        progress=None,
+    ):
+        """見出し境界のブロック列から分割案を作る。
+
+        mode:
+          - "blocks"     : ブロック数で均等（従来）
+          - "balanced"   : split_num 個以下で最大チャンク（Bytes）を最小化
+          - "max_bytes"  : 1チャンク max_size Bytes 以下（最小ファイル数）
+          - "max_tokens" : 1チャンク max_size 推定トークン以下（最小ファイル数）
+        progress: TaskProgress（バックグラウンド実行時の進捗報告・キャンセル確認）
+        """
+        if progress is not None:
+            progress.report(f"読み込み中... {os.path.basename(src_path)}", force=True)
+        index, file_key = self._split_plan_cache.get_index(src_path)
+        if progress is not None:
+            progress.report(f"分割案を計算中... {format_bytes(index._bytes[-1])}", force=True)
 
         try:
             header_level = int(header_level)
@@ -1424,23 +4095,6 @@ class UnifiedYomitokuApp:
             header_level = 6
         header_level = max(1, min(6, header_level))
 
-        header_pattern = re.compile(r"^#{1," + str(header_level) + r"}\s")
-
-        blocks = []
-        current_block = []
-        for line in lines:
-            if header_pattern.match(line) and current_block:
-                blocks.append("".join(current_block))
-                current_block = []
-            current_block.append(line)
-        if current_block:
-            blocks.append("".join(current_block))
-
-        if len(blocks) < split_num:
-            blocks = ["".join(lines)]
-
-        blocks_per_file = math.ceil(len(blocks) / split_num)
-
         src_dir, base_name = os.path.split(src_path)
         name_root, ext = os.path.splitext(base_name)
 
@@ -1452,66 +4106,143 @@ class UnifiedYomitokuApp:
         else:
             dir_name = src_dir
 
+        cache_key = (file_key, int(split_num), header_level, dir_name, mode, max_size)
+        cached = self._split_plan_cache.get_plan(cache_key)
+        if cached is None:
+            cached = self._build_split_plan_from_index(
+                index, split_num, header_level, dir_name, name_root, ext, mode, max_size
+            )
+            self._split_plan_cache.put_plan(cache_key, cached)
+
         plan = []
-        for i in range(split_num):
-            chunk_blocks = blocks[i * blocks_per_file : (i + 1) * blocks_per_file]
-            if not chunk_blocks:
+        for row in cached:
+            item = dict(row)
+            # 既存ファイルの有無はディスクの状態なので毎回確認する
+            item["exists"] = os.path.exists(item["path"])
+            if include_text:
+                item["text"] = index.text[item["start"]:item["end"]]
+            plan.append(item)
+        return plan
+
+    def _build_split_plan_from_index(self, index, split_num, header_level, dir_name, name_root, ext, mode, max_size):
+        bounds = index.block_bounds(header_level)
+        n_blocks = max(0, len(bounds) - 1)
+
+        if mode == "blocks":
+            if n_blocks < split_num:
+                bounds = [0, index.length]
+                n_blocks = 1
+            blocks_per_file = math.ceil(n_blocks / split_num)
+            group_starts = list(range(0, n_blocks, blocks_per_file))[:split_num]
+        else:
+            block_metrics = [index.measure(bounds[k], bounds[k + 1]) for k in range(n_blocks)]
+            if mode == "balanced":
+                group_starts = partition_min_max([m[0] for m in block_metrics], split_num)
+            elif mode == "max_bytes":
+                group_starts = partition_by_budget([m[0] for m in block_metrics], max_size)
+            elif mode == "max_tokens":
+                group_starts = partition_by_budget([m[3] for m in block_metrics], max_size)
+            else:
+                raise ValueError(f"不明な分割方法です: {mode}")
+
+        plan = []
+        group_ends = group_starts[1:] + [n_blocks]
+        for i, (g0, g1) in enumerate(zip(group_starts, group_ends)):
+            if g1 <= g0:
                 break
 
-            text = "".join(chunk_blocks)
+            start = bounds[g0]
+            end = bounds[g1]
             out_name = f"{name_root}_{i+1:02}{ext}"
             out_path = os.path.join(dir_name, out_name)
 
-            b = len(text.encode("utf-8"))
-            item = {
-                "index": i + 1,
-                "name": out_name,
-                "path": out_path,
-                "bytes": b,
-                "lines": text.count("\n") + 1 if text else 0,
-                "chars": len(text),
-                "blocks": len(chunk_blocks),
-                "exists": os.path.exists(out_path),
-            }
-            if include_text:
-                item["text"] = text
-            plan.append(item)
+            b, n_lines, chars, tokens = index.measure(start, end)
+            oversize = False
+            if mode == "max_bytes":
+                oversize = b > max_size
+            elif mode == "max_tokens":
+                oversize = tokens > max_size
+            plan.append(
+                {
+                    "index": i + 1,
+                    "name": out_name,
+                    "path": out_path,
+                    "start": start,
+                    "end": end,
+                    "bytes": b,
+                    "lines": n_lines,
+                    "chars": chars,
+                    "tokens": tokens,
+                    "blocks": g1 - g0,
+                    "exists": False,
+                    "oversize": oversize,
+                }
+            )
 
         return plan
 
-    def split_markdown_file(self, src_path, split_num, header_level=6, output_dir=None):
-        plan = self.build_split_plan(src_path, split_num, header_level, output_dir, include_text=True)
+    def split_markdown_file(self, src_path, split_num, header_level=6, output_dir=None, mode="blocks", max_size=None):
+        """分割案の作成 → 上書き確認（UIスレッド） → 書き出し、をバックグラウンド処理で行う。"""
 
-        if not plan:
-            raise RuntimeError("分割案が生成できませんでした。入力内容を確認してください。")
-
-        existing = [it["path"] for it in plan if it.get("exists", False)]
-        if existing:
-            preview = "\n".join(os.path.basename(p) for p in existing[:10])
-            if len(existing) > 10:
-                preview += "\n..."
-            msg = "以下のファイルが既に存在します。\n上書きして分割しますか？\n\n" + preview
-            res = messagebox.askyesno("上書き確認", msg)
-            if not res:
-                self.log("分割を中止しました（上書き確認でキャンセル）。")
-                return
+        def _error(e):
+            self.safe_showerror("エラー", str(e))
+            self.lbl_split_status.config(text="分割失敗")
 
-        for it in plan:
-            out_path = it["path"]
-            text = it.get("text", "")
-            with open(out_path, "w", encoding="utf-8") as f:
-                f.write(text)
-            self.log(f"  -> 作成: {os.path.basename(out_path)}")
+        def _plan_work(progress):
+            return self.build_split_plan(
+                src_path, split_num, header_level, output_dir, include_text=True, mode=mode, max_size=max_size,
+                progress=progress,
+            )
 
-        try:
-            preview_plan = self.build_split_plan(src_path, split_num, header_level, output_dir, include_text=False)
-            self.update_split_preview(preview_plan)
-            self._last_split_preview_plan = preview_plan
-            self._split_preview_params = (src_path, split_num, header_level, output_dir)
-        except Exception:
-            pass
+        def _write_work(plan, progress):
+            total = len(plan)
+            written = 0
+            for i, it in enumerate(plan, start=1):
+                progress.report(f"書き出し中... {i}/{total}  {format_bytes(written)}", done=written, unit="bytes")
+                out_path = it["path"]
+                text = it.get("text", "")
+                with open(out_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                written += int(it.get("bytes", 0))
+                self.log(f"  -> 作成: {os.path.basename(out_path)}")
+            return plan
+
+        def _written(plan):
+            try:
+                preview_plan = self.build_split_plan(
+                    src_path, split_num, header_level, output_dir, include_text=False, mode=mode, max_size=max_size
+                )
+                self.update_split_preview(preview_plan)
+                self._last_split_preview_plan = preview_plan
+                self._split_preview_params = (src_path, split_num, header_level, output_dir, mode, max_size)
+            except Exception:
+                pass
+
+            self.lbl_split_status.config(text="分割完了")
+            self.safe_showinfo("完了", f"分割しました。\n出力先: {os.path.dirname(plan[0]['path'])}")
+
+        def _planned(plan):
+            if not plan:
+                _error(RuntimeError("分割案が生成できませんでした。入力内容を確認してください。"))
+                return
+
+            existing = [it["path"] for it in plan if it.get("exists", False)]
+            if existing:
+                preview = "\n".join(os.path.basename(p) for p in existing[:10])
+                if len(existing) > 10:
+                    preview += "\n..."
+                msg = "以下のファイルが既に存在します。\n上書きして分割しますか？\n\n" + preview
+                res = messagebox.askyesno("上書き確認", msg)
+                if not res:
+                    self.log("分割を中止しました（上書き確認でキャンセル）。")
+                    self.lbl_split_status.config(text="中止しました")
+                    return
+
+            self._start_text_task(
+                "分割中", lambda progress: _write_work(plan, progress), _written, self.lbl_split_status, on_error=_error
+            )
 
-        self.safe_showinfo("完了", f"分割しました。\n出力先: {os.path.dirname(plan[0]['path'])}")
+        self._start_text_task("分割案を作成中", _plan_work, _planned, self.lbl_split_status, on_error=_error)
 
     # ==========================================
     # Tab 3: MD結合（v14風）
@@ -1519,8 +4250,8 @@ class UnifiedYomitokuApp:
     # ==========================================
     # Tab 2-2: MD分割その2（split_appv01_001 組み込み版）
     #  - 目次誤分割対策（本文開始以降のみ章見出し抽出）
-    #  - _ORDER.txt による結合順マニフェスト
-    #  - ディスク再構成で完全一致検証（SHA256）
+    #  - _ORDER.txt による結合順 + _MANIFEST.json（チャンク別SHA256/位置/サイズ）
+    #  - ディスク再構成で完全一致検証（チャンク別SHA256・ブロック単位の読み直し）
     #  - テスト（プレビュー） + 行ダブルクリックで内容確認
     # ==========================================
     def init_tab_split2(self):
@@ -1555,9 +4286,15 @@ class UnifiedYomitokuApp:
         # ★追加：選択を結合ボタン
         self.btn_split2_merge = ttk.Button(row2, text="選択を結合", command=self.merge_split2_selected_items)
         self.btn_split2_merge.pack(side="left", padx=5)
+        ttk.Button(row2, text="元に戻す", command=self.undo_split2_merge).pack(side="left")
+        ttk.Button(row2, text="やり直す", command=self.redo_split2_merge).pack(side="left", padx=(5, 0))
 
         self.btn_split2_run = ttk.Button(row2, text="安全に分割を実行する", command=self.run_split2)
         self.btn_split2_run.pack(side="left", padx=(8, 0))
+        ttk.Button(row2, text="チャンクJSONL書き出し", command=self.export_split2_chunk_batch).pack(side="left", padx=(5, 0))
+        ttk.Button(row2, text="キャンセル", command=lambda: self.cancel_text_task(self.lbl_split2_status)).pack(
+            side="left", padx=(5, 0)
+        )
         self.lbl_split2_status = ttk.Label(row2, text="待機中", foreground="gray")
         self.lbl_split2_status.pack(side="left", padx=(12, 0))
 
@@ -1570,6 +4307,23 @@ class UnifiedYomitokuApp:
             text="ルビ行（小さい文字）を当該漢字の近くへ寄せる（括弧優先／難しければ直前に残す）",
             variable=self.split2_move_ruby_var
         ).pack(anchor="w")
+        rules_row = ttk.Frame(opt)
+        rules_row.pack(anchor="w", pady=(0, 4))
+        ttk.Label(rules_row, text="本文構造ルール:").pack(side="left")
+        self.split2_rules_var = tk.StringVar(value=SPLIT2_DEFAULT_RULESET)
+        ttk.Combobox(
+            rules_row,
+            textvariable=self.split2_rules_var,
+            values=list(SPLIT2_STRUCTURE_RULESETS.keys()),
+            state="readonly",
+            width=28,
+        ).pack(side="left", padx=5)
+        self.split2_incremental_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            opt,
+            text="差分のみ出力（前回の分割結果のマニフェストと比較し、内容が変わったチャンクだけ書き出す）",
+            variable=self.split2_incremental_var
+        ).pack(anchor="w")
 
         # プレビュー一覧
         preview_frame = ttk.Frame(frm)
@@ -1577,6 +4331,7 @@ class UnifiedYomitokuApp:
 
         cols = ("no", "name", "kb", "bytes", "lines", "chars", "tag", "exists")
         self.split2_preview_tree = ttk.Treeview(preview_frame, columns=cols, show="headings", height=14)
+        self._split2_preview_rows = TreeRows(self.split2_preview_tree)
         self.split2_preview_tree.heading("no", text="No")
         self.split2_preview_tree.heading("name", text="ファイル名（予定）")
         self.split2_preview_tree.heading("kb", text="KB")
@@ -1602,12 +4357,15 @@ class UnifiedYomitokuApp:
 
         # ダブルクリックで内容確認
         self.split2_preview_tree.bind("<Double-Button-1>", self.on_split2_preview_double_click)
+        self.split2_preview_tree.bind("<Control-z>", self.undo_split2_merge)
+        self.split2_preview_tree.bind("<Control-y>", self.redo_split2_merge)
 
         self.lbl_split2_preview_summary = ttk.Label(frm, text="（テスト結果はここに集計表示）", foreground="gray")
         self.lbl_split2_preview_summary.pack(anchor="w", pady=(6, 0))
 
         # 内部：プレビュー文脈
         self._split2_preview_ctx = None
+        self._split2_compiled_rules = {}
 
     def select_split2_input_md(self):
         p = filedialog.askopenfilename(filetypes=[("Markdown", "*.md"), ("Text", "*.txt"), ("All files", "*.*")])
@@ -1617,11 +4375,236 @@ class UnifiedYomitokuApp:
     def _split2_sha256_text(self, s: str) -> str:
         return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+    def _split2_write_chunks(self, output_dir: str, plan: list, chunks: list, prev_run=None, progress=None):
+        """チャンクを書き出し、同時にチャンク別/全体の SHA256 を計算する。
+
+        prev_run=(前回の実行フォルダ, マニフェスト) を渡すと、同名かつ同じハッシュのチャンクは
+        書き出さず、前回のファイルを参照する（差分のみ出力）。前回のファイルが記録後に書き換えられて
+        いれば（前回のフォルダで校正した場合など）参照せず、このフォルダに書き出す。
+
+        戻り値: (entries, combined_sha256, combined_bytes)
+          entries はマニフェストの chunks 要素（path は内部用）
+        """
+        split_root = os.path.dirname(output_dir)
+        run_name = os.path.basename(output_dir)
+        prev_by_name = {}
+        if prev_run is not None:
+            prev_dir, prev_manifest = prev_run
+            for pe in prev_manifest.get("chunks", []):
+                prev_by_name[pe.get("name")] = dict(pe, file=pe.get("file") or f"{os.path.basename(prev_dir)}/{pe.get('name')}")
+
+        entries = []
+        combined = hashlib.sha256()
+        byte_offset = 0
+        char_offset = 0
+        for i, it in enumerate(plan):
+            if progress is not None:
+                progress.report(
+                    f"書き出し中... {i + 1}/{len(plan)}  {format_bytes(byte_offset)}", done=byte_offset, unit="bytes"
+                )
+            chunk = chunks[i]
+            data = chunk.encode("utf-8")
+            sha = hashlib.sha256(data).hexdigest()
+            prev = prev_by_name.get(it["name"])
+            prev_path = None
+            if prev is not None and prev.get("sha256") == sha:
+                prev_path = os.path.join(split_root, *prev["file"].split("/"))
+                if not self._split2_file_matches(prev_path, len(data), sha):
+                    prev_path = None
+            if prev_path is not None:
+                written = False
+                rel_file = prev["file"]
+                out_path = prev_path
+            else:
+                written = True
+                rel_file = f"{run_name}/{it['name']}"
+                out_path = os.path.join(output_dir, it["name"])
+                with open(out_path, "wb") as f:
+                    f.write(data)
+            combined.update(data)
+            entries.append(
+                {
+                    "order": i,
+                    "name": it["name"],
+                    "tag": it.get("tag", ""),
+                    "path": out_path,
+                    "file": rel_file,
+                    "written": written,
+                    "src_start": int(it["start"]),
+                    "src_end": int(it["end"]),
+                    "char_offset": char_offset,
+                    "chars": len(chunk),
+                    "byte_offset": byte_offset,
+                    "bytes": len(data),
+                    "sha256": sha,
+                }
+            )
+            byte_offset += len(data)
+            char_offset += len(chunk)
+
+            # 表示用メタ（実行後のプレビューで利用）
+            it["index"] = i
+            it["path"] = out_path
+            it["exists"] = "✓" if written else "="
+            b, n_lines, chars, kb = self._split2_compute_metrics(chunk)
+            it["bytes"] = b
+            it["lines"] = n_lines
+            it["chars"] = chars
+            it["kb"] = kb
+        return entries, combined.hexdigest(), byte_offset
+
+    def _split2_file_matches(self, path: str, size: int, sha: str) -> bool:
+        """path が今も size バイト・SHA256 が sha のままか（サイズが違えば読まずに False）。"""
+        try:
+            if os.path.getsize(path) != size:
+                return False
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(block)
+        except OSError:
+            return False
+        return h.hexdigest() == sha
+
+    def _split2_find_previous_run(self, split_root: str, src_path: str, exclude_dir: str):
+        """split_output_safe 配下から、同じ入力MDの直近のマニフェストを探す。
+
+        戻り値: (実行フォルダ, マニフェスト dict) / 見つからなければ None
+        """
+        if not os.path.isdir(split_root):
+            return None
+        src_abs = os.path.abspath(src_path)
+        for name in sorted(os.listdir(split_root), reverse=True):
+            run_dir = os.path.join(split_root, name)
+            if os.path.abspath(run_dir) == os.path.abspath(exclude_dir):
+                continue
+            manifest_path = os.path.join(run_dir, SPLIT2_MANIFEST_NAME)
+            if not os.path.isfile(manifest_path):
+                continue
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except Exception:
+                continue
+            if os.path.abspath(manifest.get("source_md") or "") == src_abs:
+                return run_dir, manifest
+        return None
+
+    def _split2_diff_runs(self, entries: list, prev_manifest: dict) -> dict:
+        """前回マニフェストとの差分（変更/追加/削除されたチャンク）を返す。"""
+        prev_names = [pe.get("name") for pe in prev_manifest.get("chunks", [])]
+        new_names = set(e["name"] for e in entries)
+        prev_set = set(prev_names)
+        return {
+            "changed": [e["name"] for e in entries if e["written"] and e["name"] in prev_set],
+            "added": [e["name"] for e in entries if e["written"] and e["name"] not in prev_set],
+            "removed": [n for n in prev_names if n not in new_names],
+        }
+
+    def _split2_write_manifest(
+        self, output_dir, src_path, full_content, source_sha, move_ruby, entries, combined_sha, combined_bytes,
+        base_run=None, changes=None,
+    ) -> str:
+        """_ORDER.txt と同じフォルダに、チャンク別のハッシュ・位置・サイズを JSON で残す。
+
+        差分のみ出力のときは、比較元の実行フォルダ名（base_run）と差分（changes）も記録する。
+        各チャンクの file は split_output_safe からの相対パスで、変更のないチャンクは前回のファイルを指す。
+        """
+        payload = {
+            "type": "split2_manifest",
+            "version": 1,
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "source_md": src_path,
+            "source_sha256": source_sha,
+            "source_chars": len(full_content),
+            "ruby_move": bool(move_ruby),
+            "combined_sha256": combined_sha,
+            "combined_bytes": combined_bytes,
+            "base_run": base_run,
+            "changes": changes,
+            "chunks": [{k: v for k, v in e.items() if k != "path"} for e in entries],
+        }
+        manifest_path = os.path.join(output_dir, SPLIT2_MANIFEST_NAME)
+        with open(manifest_path, "w", encoding="utf-8", newline="") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        return manifest_path
+
+    def _split2_verify_written(self, entries: list, chunks: list, progress=None):
+        """書き出したファイルをブロック単位で読み直し、チャンクごとの SHA256/サイズを照合する。
+
+        戻り値: (ok, reconstructed_sha256, mismatch)
+          mismatch は最初の不一致について
+          {offset, name, chunk_offset, expected, actual}（一致時は None）
+        """
+        combined = hashlib.sha256()
+        total = sum(e["bytes"] for e in entries)
+        done = 0
+        for e in entries:
+            h = hashlib.sha256()
+            size = 0
+            try:
+                with open(e["path"], "rb") as f:
+                    while True:
+                        block = f.read(SPLIT2_VERIFY_BLOCK_SIZE)
+                        if not block:
+                            break
+                        h.update(block)
+                        combined.update(block)
+                        size += len(block)
+                        if progress is not None:
+                            progress.report(
+                                f"検証中... {format_bytes(done + size)} / {format_bytes(total)}",
+                                done=done + size, total=total, unit="bytes",
+                            )
+            except OSError:
+                size = -1
+            if size != e["bytes"] or h.hexdigest() != e["sha256"]:
+                return False, combined.hexdigest(), self._split2_locate_mismatch(e, chunks[e["order"]])
+            done += size
+        return True, combined.hexdigest(), None
+
+    def _split2_locate_mismatch(self, entry: dict, chunk: str) -> dict:
+        """期待チャンクとディスク上のファイルをブロック単位で比較し、最初の不一致位置を求める。"""
+        expected = chunk.encode("utf-8")
+        bs = SPLIT2_VERIFY_BLOCK_SIZE
+        byte_pos = 0
+        actual_window = b""
+        try:
+            with open(entry["path"], "rb") as f:
+                while True:
+                    block = f.read(bs)
+                    exp_block = expected[byte_pos : byte_pos + len(block)] if block else b""
+                    if block and block == exp_block:
+                        byte_pos += len(block)
+                        continue
+                    # ブロック内で最初に異なるバイトを探す
+                    n = min(len(block), len(exp_block))
+                    k = 0
+                    while k < n and block[k] == exp_block[k]:
+                        k += 1
+                    byte_pos += k
+                    break
+                f.seek(max(0, byte_pos - 120))
+                actual_window = f.read(240)
+        except OSError:
+            byte_pos = 0
+
+        chunk_offset = len(expected[:byte_pos].decode("utf-8", "ignore"))
+        a0 = max(0, chunk_offset - 40)
+        return {
+            "offset": entry["char_offset"] + chunk_offset,
+            "name": entry["name"],
+            "path": entry["path"],
+            "chunk_offset": chunk_offset,
+            "expected": chunk[a0 : chunk_offset + 40],
+            "actual": actual_window.decode("utf-8", "replace"),
+        }
+
 
     def _split2_strip_html_tags(self, s: str) -> str:
         # ルビ候補行の判定で <small> 等のタグを無視するため
         try:
-            return re.sub(r"<[^>]+>", "", s)
+            return _SPLIT2_TAG_RE.sub("", s)
         except Exception:
             return s
 
@@ -1634,21 +4617,25 @@ class UnifiedYomitokuApp:
           - <small> / font-size 指定が残っている入力
         """
         txt = self._split2_strip_html_tags(raw_line).strip()
+        return self._split2_ruby_candidate_from_text(txt, raw_line)
+
+    def _split2_ruby_candidate_from_text(self, txt: str, raw_line: str) -> str:
+        """タグ除去・strip 済みの txt からルビ候補を判定する（_split2_get_ruby_candidate_line の本体）。"""
         if not txt:
             return ""
         # 漢字が混ざっているならルビとはみなさない
-        if re.search(r"[\u4e00-\u9fff]", txt):
+        if _SPLIT2_ANY_KANJI_RE.search(txt):
             return ""
 
         # かなだけ（独立行）
-        if len(txt) <= 24 and re.fullmatch(r"[ぁ-ゖァ-ヶー]+", txt):
+        if len(txt) <= 24 and _SPLIT2_KANA_RE.fullmatch(txt):
             return txt
 
         # かな＋スペース（複数語の読みが連なる）
         norm = txt.replace("\u3000", " ").strip()
-        if " " in norm and len(norm) <= 120 and re.fullmatch(r"[ぁ-ゖァ-ヶー ]+", norm):
+        if " " in norm and len(norm) <= 120 and _SPLIT2_KANA_SPACE_RE.fullmatch(norm):
             # 連続スペースは詰める
-            norm = re.sub(r"\s{2,}", " ", norm).strip()
+            norm = _SPLIT2_MULTI_SPACE_RE.sub(" ", norm).strip()
             # スペース区切りが1つも無い（=単語1つ）なら上の分岐で拾う想定
             if len(norm) >= 3:
                 return norm
@@ -1656,12 +4643,38 @@ class UnifiedYomitokuApp:
         raw_low = raw_line.lower()
         # タグ/スタイルで小さい文字が明示されている場合は、やや長めでも許容
         if ("<small" in raw_low) or ("font-size" in raw_low):
-            if len(norm) <= 200 and re.fullmatch(r"[ぁ-ゖァ-ヶー ]+", norm):
-                norm = re.sub(r"\s{2,}", " ", norm).strip()
+            if len(norm) <= 200 and _SPLIT2_KANA_SPACE_RE.fullmatch(norm):
+                norm = _SPLIT2_MULTI_SPACE_RE.sub(" ", norm).strip()
                 return norm
 
         return ""
 
+    def _split2_classify_lines(self, lines: list):
+        """各行のタグ除去と分類を1回だけ行う。
+
+        戻り値: (classes, ruby_text)
+          classes   : 行ごとの SPLIT2_LINE_* を並べた bytearray
+          ruby_text : ルビ候補行 index -> ルビ文字列
+        """
+        classes = bytearray(len(lines))
+        ruby_text = {}
+        tag_sub = _SPLIT2_TAG_RE.sub
+        any_kanji = _SPLIT2_ANY_KANJI_RE.search
+        base_kanji = _SPLIT2_BASE_KANJI_RE.search
+        for i, raw in enumerate(lines):
+            txt = (tag_sub("", raw) if "<" in raw else raw).strip()
+            if not txt:
+                classes[i] = SPLIT2_LINE_BLANK
+                continue
+            if not any_kanji(txt):
+                cand = self._split2_ruby_candidate_from_text(txt, raw)
+                if cand:
+                    classes[i] = SPLIT2_LINE_RUBY
+                    ruby_text[i] = cand
+                    continue
+            classes[i] = SPLIT2_LINE_KANJI if base_kanji(txt) else SPLIT2_LINE_OTHER
+        return classes, ruby_text
+
     def _split2_build_ruby_info(self, full_content: str) -> dict:
         """full_content 全体から『ルビ行 → 対応する本文行』の対応を推定して返す。"""
         lines = full_content.splitlines(keepends=True)
@@ -1671,29 +4684,28 @@ class UnifiedYomitokuApp:
             offsets.append(pos)
             pos += len(ln)
 
+        classes, cand_text = self._split2_classify_lines(lines)
+
         ruby_line_set = set()
         ruby_to_base = {}
         ruby_text = {}
 
         n = len(lines)
-        for i in range(n):
-            raw = lines[i]
-            cand = self._split2_get_ruby_candidate_line(raw)
-            if not cand:
-                continue
+        for i, cand in cand_text.items():
             # 直後（最大数行）を走査して、対応する本文行（= 漢字を含む行）を探す
             # 空行だけでなく、見出しやかな文が挟まって距離が離れるケースを救済する
+            # ルビは基本的に漢字の読みなので、本文行に漢字が無い場合は除外（誤検出抑制）
             j = i + 1
             found = None
             max_nonempty_seek = 8  # 非空行として数える上限（大きすぎると誤結合が増える）
             seen_nonempty = 0
             while j < n and seen_nonempty < max_nonempty_seek:
-                s = self._split2_strip_html_tags(lines[j]).strip()
-                if s == "":
+                c = classes[j]
+                if c == SPLIT2_LINE_BLANK:
                     j += 1
                     continue
                 seen_nonempty += 1
-                if re.search(r"[一-龠々]{2,}", s):
+                if c == SPLIT2_LINE_KANJI:
                     found = j
                     break
                 j += 1
@@ -1701,21 +4713,24 @@ class UnifiedYomitokuApp:
             if found is None:
                 continue
 
-            base_txt = self._split2_strip_html_tags(lines[found]).strip()
-            # ルビは基本的に漢字の読みなので、本文行に漢字が無い場合は除外（誤検出抑制）
-            if not re.search(r"[一-龠々]{2,}", base_txt):
-                continue
-
             ruby_line_set.add(i)
             ruby_to_base[i] = found
             ruby_text[i] = cand
 
+        # 本文行オフセット順に並べた (base_i, ruby_i)。チャンク範囲は bisect で切り出す
+        ruby_by_base = sorted(ruby_to_base.items(), key=lambda kv: (offsets[kv[1]], kv[0]))
+        ruby_by_base = [(base_i, ruby_i) for ruby_i, base_i in ruby_by_base]
+        ruby_base_offsets = array("q", [offsets[base_i] for base_i, _ in ruby_by_base])
+
         return {
             "lines": lines,
-            "offsets": offsets,
+            "line_classes": classes,
+            "offsets": array("q", offsets),
             "ruby_line_set": ruby_line_set,
             "ruby_to_base": ruby_to_base,
             "ruby_text": ruby_text,
+            "ruby_by_base": ruby_by_base,
+            "ruby_base_offsets": ruby_base_offsets,
         }
 
     def _split2_compute_metrics(self, text: str):
@@ -1734,25 +4749,23 @@ class UnifiedYomitokuApp:
         ※ split2 ではスライス位置を維持する必要がないため、内容を安全側に寄せて整形する。
         """
         lines = ruby_info["lines"]
+        line_classes = ruby_info["line_classes"]
         offsets = ruby_info["offsets"]
         ruby_line_set = ruby_info["ruby_line_set"]
-        ruby_to_base = ruby_info["ruby_to_base"]
         ruby_text = ruby_info["ruby_text"]
 
         # チャンク範囲に入る行を取り出す（ルビ行は落とす）
+        # 行オフセットは昇順なので、範囲の先頭/末尾行は二分探索で求める（全行走査しない）
         out_lines = []
         orig_to_outpos = {}
-        skip_next_blank = False
-
-        for i, ln in enumerate(lines):
-            off = offsets[i]
-            if off < start:
-                continue
-            if off >= end:
-                break
+        skip_next_blank = False
 
+        i0 = bisect.bisect_left(offsets, start)
+        i1 = bisect.bisect_left(offsets, end)
+        for i in range(i0, i1):
+            ln = lines[i]
             if skip_next_blank:
-                if self._split2_strip_html_tags(ln).strip() == "":
+                if line_classes[i] == SPLIT2_LINE_BLANK:
                     skip_next_blank = False
                     continue
                 skip_next_blank = False
@@ -1765,12 +4778,13 @@ class UnifiedYomitokuApp:
             orig_to_outpos[i] = len(out_lines)
             out_lines.append(ln)
 
-        # base行ごとにルビを集約
+        # base行ごとにルビを集約（本文行オフセット順の索引から、このチャンク分だけ取り出す）
         base_to_rubies = {}
-        for ruby_i, base_i in ruby_to_base.items():
-            base_off = offsets[base_i]
-            if not (start <= base_off < end):
-                continue
+        ruby_by_base = ruby_info["ruby_by_base"]
+        base_offsets = ruby_info["ruby_base_offsets"]
+        k0 = bisect.bisect_left(base_offsets, start)
+        k1 = bisect.bisect_left(base_offsets, end)
+        for base_i, ruby_i in ruby_by_base[k0:k1]:
             t = ruby_text.get(ruby_i, "").strip()
             if not t:
                 continue
@@ -1860,23 +4874,27 @@ class UnifiedYomitokuApp:
             return raw_line, False
         return new_raw, True
 
-    def _split2_build_chunks_text(self, full_content: str, plan: list, move_ruby: bool):
+    def _split2_build_chunks_text(self, full_content: str, plan: list, move_ruby: bool, progress=None):
         """planに従ってチャンク文字列を作る。move_ruby=Trueならルビを先頭に集約した版を返す。"""
         if not move_ruby:
             chunks = [full_content[int(it["start"]):int(it["end"])] for it in plan]
             return chunks, "".join(chunks), None
 
+        if progress is not None:
+            progress.report("ルビ行を解析中...", force=True)
         ruby_info = self._split2_build_ruby_info(full_content)
         chunks = []
-        for it in plan:
+        for i, it in enumerate(plan):
+            if progress is not None:
+                progress.report(f"ルビを集約中... {i + 1}/{len(plan)}")
             start = int(it["start"])
             end = int(it["end"])
             chunks.append(self._split2_transform_chunk_ruby_to_header(full_content, start, end, ruby_info))
         return chunks, "".join(chunks), ruby_info
 
-    def _split2_prepare_split2_ctx(self, ctx: dict, full_content: str, plan: list, move_ruby: bool):
+    def _split2_prepare_split2_ctx(self, ctx: dict, full_content: str, plan: list, move_ruby: bool, progress=None):
         """プレビュー/実行で共通：planのメトリクス更新と chunks/combined の生成。"""
-        chunks, combined, ruby_info = self._split2_build_chunks_text(full_content, plan, move_ruby)
+        chunks, combined, ruby_info = self._split2_build_chunks_text(full_content, plan, move_ruby, progress)
         for i, it in enumerate(plan):
             if i >= len(chunks):
                 break
@@ -1888,52 +4906,168 @@ class UnifiedYomitokuApp:
 
         ctx["plan"] = plan
         ctx["chunks"] = chunks
-        ctx["combined"] = combined
         ctx["ruby_move"] = move_ruby
         ctx["ruby_info"] = ruby_info
+        # 結合の取り消し/やり直し用（チャンク文字列ごと保持するので再計算不要）
+        ctx["undo_stack"] = []
+        ctx["redo_stack"] = []
         return chunks, combined, ruby_info
 
-    def _split2_find_body_start_pos(self, full_content: str) -> int:
+    def _split2_chunk_text(self, ctx: dict, start: int, end: int) -> str:
+        """ctx の ruby_info を使って1チャンク分だけ文字列を作る。"""
+        full_content = ctx["full_content"]
+        if not ctx.get("ruby_move"):
+            return full_content[start:end]
+        return self._split2_transform_chunk_ruby_to_header(full_content, start, end, ctx["ruby_info"])
+
+    def _split2_merge_range(self, ctx: dict, start_idx: int, end_idx: int) -> dict:
+        """plan[start_idx..end_idx] を1つに結合する。再計算するのは結合後のチャンクだけ。"""
+        op = self._split2_build_merge_op(ctx, start_idx, end_idx)
+        self._split2_apply_merge_op(ctx, op)
+        return op
+
+    def _split2_build_merge_op(self, ctx: dict, start_idx: int, end_idx: int) -> dict:
+        """結合操作（結合後のチャンクと取り消し用の情報）を作る。ctx は変更しない。"""
+        plan = ctx["plan"]
+        chunks = ctx["chunks"]
+
+        first_item = plan[start_idx]
+        last_item = plan[end_idx]
+        new_start = int(first_item["start"])
+        new_end = int(last_item["end"])
+
+        chunk = self._split2_chunk_text(ctx, new_start, new_end)
+        b, n_lines, chars, kb = self._split2_compute_metrics(chunk)
+
+        # 新しいアイテムを作成（ファイル名は先頭のものを引き継ぐ）
+        merged_item = {
+            "index": start_idx,
+            "name": first_item["name"],  # 名前は先頭を採用
+            "path": first_item["path"],  # パスも先頭ベース（ただし実行時にディレクトリ変わる可能性あり）
+            "start": new_start,
+            "end": new_end,
+            "bytes": b,
+            "lines": n_lines,
+            "chars": chars,
+            "kb": kb,
+            "tag": first_item["tag"] + " (merged)",
+            "exists": ""
+        }
+
+        op = {
+            "index": start_idx,
+            "removed_items": plan[start_idx : end_idx + 1],
+            "removed_chunks": chunks[start_idx : end_idx + 1],
+            "merged_item": merged_item,
+            "merged_chunk": chunk,
+        }
+        return op
+
+    def _split2_apply_merge_op(self, ctx: dict, op: dict):
+        i = op["index"]
+        n = len(op["removed_items"])
+        ctx["plan"][i : i + n] = [op["merged_item"]]
+        ctx["chunks"][i : i + n] = [op["merged_chunk"]]
+
+    def _split2_revert_merge_op(self, ctx: dict, op: dict):
+        i = op["index"]
+        ctx["plan"][i : i + 1] = list(op["removed_items"])
+        ctx["chunks"][i : i + 1] = list(op["removed_chunks"])
+
+    def _split2_get_rules(self, name=None) -> dict:
+        """構造ルール名（未指定ならTab2-2の選択）から、コンパイル済みルールを返す。"""
+        if name is None:
+            try:
+                name = self.split2_rules_var.get()
+            except Exception:
+                name = SPLIT2_DEFAULT_RULESET
+        if name not in SPLIT2_STRUCTURE_RULESETS:
+            name = SPLIT2_DEFAULT_RULESET
+        cache = self._split2_compiled_rules
+        if name not in cache:
+            cache[name] = compile_split2_rules(SPLIT2_STRUCTURE_RULESETS[name])
+            cache[name]["name"] = name
+        return cache[name]
+
+    def _split2_scan_structure(self, full_content: str, compiled: dict) -> dict:
+        """結合パターン1回の走査で、章/第1章候補/目次/索引の位置を集める（スライスコピーなし）。"""
+        events = {"first_chapter": [], "chapter": [], "toc": [], "index": []}
+        scan = compiled["scan"]
+        if scan is None:
+            return events
+        first_re = compiled["first_chapter"]
+        chapter_re = compiled["chapter"]
+        has_heading = "heading" in scan.groupindex
+        other_kinds = [k for k in ("toc", "index") if k in scan.groupindex]
+        first_end = -1
+        for m in scan.finditer(full_content):
+            pos = m.start()
+            if has_heading and m.group("heading") is not None:
+                # 従来の finditer と同じく、直前のマッチと重なる候補は採らない
+                m1 = first_re.match(full_content, pos) if first_re else None
+                if m1 and pos >= first_end:
+                    events["first_chapter"].append((pos, m1.end()))
+                    first_end = m1.end()
+                mc = chapter_re.match(full_content, pos) if chapter_re else None
+                if mc:
+                    try:
+                        events["chapter"].append((pos, mc.end(), int(mc.group(1))))
+                    except Exception:
+                        continue
+                continue
+            for kind in other_kinds:
+                if m.group(kind) is not None:
+                    events[kind].append((pos, m.end()))
+                    break
+        return events
+
+    def _split2_find_body_start_pos(self, full_content: str, events=None, compiled=None, quiet: bool = False) -> int:
         """
         目次内にも「# 1<br>」等の見出しが出るため、
         本文の第1章開始位置（= 直後に《ポイント》などが来る # 1...）を
         優先的に探し、目次部分での誤分割を防ぐ。
         """
-        # 候補となる「# 1」をすべて列挙する
-        # (?m)^ ... 行頭マッチ, (?:<br>|\s|$) ... 直後は改行タグor空白or行末
-        chapter1_pattern = re.compile(r'(?m)^#\s+1(?:<br>|\s|$)')
-        candidates = list(chapter1_pattern.finditer(full_content))
+        if compiled is None:
+            compiled = self._split2_get_rules()
+        if events is None:
+            events = self._split2_scan_structure(full_content, compiled)
+        rules = compiled["rules"]
+
+        # 候補となる「# 1」をすべて列挙済み（(開始, 終了)）
+        candidates = events["first_chapter"]
 
         if not candidates:
             return 0
 
         # --- 判定ロジック1: 「# 1」の直後(1000文字以内)に《ポイント》や《目標》があるか確認 ---
         # output.mdでは「# 1...」の数行後に「《ポイント》」がある
-        keyword_pattern = re.compile(r'《.*(?:ポイント|目標).*》')
-
-        for m in candidates:
-            # マッチした箇所の後ろ1000文字を取得してチェック
-            snippet = full_content[m.end():m.end()+1000]
-            if keyword_pattern.search(snippet):
-                self.log(f"本文開始位置をキーワード検出で特定しました: {m.start()}")
-                return m.start()
+        keyword_re = compiled["keyword"]
+        if keyword_re is not None:
+            window = int(rules.get("body_keyword_window") or 1000)
+            for c_start, c_end in candidates:
+                # pos / endpos で窓を区切って探す（切り出した snippet を探すのと同じ結果で、コピーはしない）
+                if keyword_re.search(full_content, c_end, c_end + window):
+                    if not quiet:
+                        self.log(f"本文開始位置をキーワード検出で特定しました: {c_start}")
+                    return c_start
 
         # --- 判定ロジック2: 「# 目次」セクションより後ろにある最初の「# 1」を採用 ---
-        toc_match = re.search(r'(?m)^#\s+目次', full_content)
-        if toc_match:
-            toc_end_pos = toc_match.end()
-            for m in candidates:
-                if m.start() > toc_end_pos:
-                    self.log(f"目次セクション後の最初の第1章を採用しました: {m.start()}")
-                    return m.start()
+        if events["toc"]:
+            toc_end_pos = events["toc"][0][1]
+            for c_start, _ in candidates:
+                if c_start > toc_end_pos:
+                    if not quiet:
+                        self.log(f"目次セクション後の最初の第1章を採用しました: {c_start}")
+                    return c_start
 
         # --- 判定ロジック3: 候補が複数ある場合、2つ目を本文とみなす（従来のヒューリスティック） ---
         if len(candidates) >= 2:
-            self.log(f"複数の第1章候補が見つかったため、2つ目を採用します: {candidates[1].start()}")
-            return candidates[1].start()
+            if not quiet:
+                self.log(f"複数の第1章候補が見つかったため、2つ目を採用します: {candidates[1][0]}")
+            return candidates[1][0]
 
         # 候補が1つしかなければそれを返す
-        return candidates[0].start()
+        return candidates[0][0]
 
     def _split2_read_full(self, input_path: str) -> str:
         with open(input_path, "r", encoding="utf-8", newline="") as f:
@@ -1953,7 +5087,7 @@ class UnifiedYomitokuApp:
                 return new_name
             counter += 1
 
-    def _split2_build_plan(self, input_path: str, output_dir, full_content: str):
+    def _split2_build_plan(self, input_path: str, output_dir, full_content: str, compiled=None, quiet: bool = False):
         """
         plan item:
           {
@@ -1961,44 +5095,49 @@ class UnifiedYomitokuApp:
             bytes, lines, chars, kb, tag, exists
           }
         """
+        if compiled is None:
+            compiled = self._split2_get_rules()
+        rules = compiled["rules"]
+        events = self._split2_scan_structure(full_content, compiled)
+
         total_length = len(full_content)
-        body_start_pos = self._split2_find_body_start_pos(full_content)
+        body_start_pos = self._split2_find_body_start_pos(full_content, events=events, compiled=compiled, quiet=quiet)
 
         cut_points = [0, total_length, body_start_pos]
 
-        # 修正: 先頭の#が任意、かつ数字の後に <br> または # が続くパターンも許容する
-        chapter_pattern = re.compile(r'(?m)^(?:#\s*)?(\d+)(?:<br>|\s+#)')
-        chapter_matches = list(chapter_pattern.finditer(full_content, body_start_pos))
+        # 本文開始以降の章見出し（先頭の#が任意、数字の後に <br> または # が続くもの）
+        # 従来の finditer と同じく、直前の章見出しマッチと重なるものは除く
+        chapter_matches = []
+        last_end = body_start_pos
+        for pos, end, num in events["chapter"]:
+            if pos >= last_end:
+                chapter_matches.append((pos, num))
+                last_end = end
 
         chapter_map = {}
-        for m in chapter_matches:
-            pos = m.start()
-            try:
-                num = int(m.group(1))
-            except Exception:
-                continue
+        for pos, num in chapter_matches:
             cut_points.append(pos)
             chapter_map[pos] = num
 
-        # 第15章と索引の境界（「# 人名索引」等）
+        # 最終章と索引の境界（「# 人名索引」等）
         idx_split_pos = -1
-        start_pos_15 = -1
-        for m in chapter_matches:
-            try:
-                if int(m.group(1)) == 15:
-                    start_pos_15 = m.start()
+        after_num = rules.get("index_after_chapter")
+        index_from = -1
+        if after_num is None:
+            if chapter_matches:
+                index_from = chapter_matches[-1][0]
+        else:
+            for pos, num in chapter_matches:
+                if num == after_num:
+                    index_from = pos
                     break
-            except Exception:
-                continue
 
-        if start_pos_15 != -1:
-            search_area = full_content[start_pos_15:]
-            index_pattern = re.compile(r'(?m)^#\s+人名索引.*')
-            index_match = index_pattern.search(search_area)
-            if index_match:
-                absolute_idx_pos = start_pos_15 + index_match.start()
-                cut_points.append(absolute_idx_pos)
-                idx_split_pos = absolute_idx_pos
+        if index_from != -1:
+            for pos, _ in events["index"]:
+                if pos >= index_from:
+                    cut_points.append(pos)
+                    idx_split_pos = pos
+                    break
 
         cut_points = sorted(set([p for p in cut_points if 0 <= p <= total_length]))
 
@@ -2010,15 +5149,15 @@ class UnifiedYomitokuApp:
             chunk = full_content[start:end]
 
             if start == 0:
-                filename = "00_前書き・目次.md"
+                filename = rules["front_name"]
                 tag = "front"
             elif idx_split_pos != -1 and start == idx_split_pos:
-                filename = "16_索引・その他.md"
+                filename = rules["index_name"]
                 tag = "index"
             else:
                 if start in chapter_map:
                     c_num = chapter_map[start]
-                    filename = f"{c_num:02d}_第{c_num}章.md"
+                    filename = rules["chapter_name"].format(num=c_num)
                     tag = f"chapter {c_num}"
                 else:
                     filename = f"unknown_{start}.md"
@@ -2055,23 +5194,16 @@ class UnifiedYomitokuApp:
         return plan
 
     def _split2_update_preview(self, plan, summary_text: str = ""):
-        try:
-            for item in self.split2_preview_tree.get_children():
-                self.split2_preview_tree.delete(item)
-        except Exception:
-            pass
-
         total_bytes = 0
         total_chars = 0
+        rows = []
         for i, it in enumerate(plan):
             # インデックスの再採番（結合後に番号が飛ぶのを防ぐため）
             it["index"] = i
             total_bytes += int(it.get("bytes", 0))
             total_chars += int(it.get("chars", 0))
-            self.split2_preview_tree.insert(
-                "",
-                "end",
-                values=(
+            rows.append(
+                (
                     it.get("index", 0),
                     it.get("name", ""),
                     f"{it.get('kb', 0.0):.1f}",
@@ -2080,42 +5212,67 @@ class UnifiedYomitokuApp:
                     it.get("chars", 0),
                     it.get("tag", ""),
                     it.get("exists", ""),
-                ),
+                )
             )
+        # 結合・取り消しでは、結合した行の削除と後続行の番号の書き換えだけになる
+        self._split2_preview_rows.sync(rows)
 
         if not summary_text:
             summary_text = f"分割数: {len(plan)} / 合計Bytes(UTF-8): {total_bytes:,} / 合計文字数: {total_chars:,}"
 
         self.lbl_split2_preview_summary.config(text=summary_text)
 
+    def export_split2_chunk_batch(self):
+        """プレビュー中のチャンク（手動結合・ルビ集約を反映済み）を JSONL バッチへ書き出す。"""
+        ctx = self._split2_preview_ctx
+        if not ctx or not isinstance(ctx.get("chunks"), list):
+            self.safe_showerror("エラー", "先に「テスト（プレビュー）」を実行してください")
+            return
+        save_path = self._ask_chunk_batch_path(ctx.get("src_path", ""))
+        if not save_path:
+            return
+        items = [(it["name"], chunk) for it, chunk in zip(ctx["plan"], ctx["chunks"])]
+        fmt, model = self._chunk_batch_settings()
+        try:
+            n = write_chunk_batch(save_path, items, fmt, model)
+        except Exception as e:
+            self.safe_showerror("エラー", f"書き出しに失敗しました:\n{e}")
+            return
+        self.log(f"チャンクJSONL（{fmt} / {model}）: {save_path}（{n}件）")
+        self.safe_showinfo("完了", f"{n}件のチャンクを書き出しました。\n{save_path}")
+
     def run_split2_preview(self):
         src_path = self.split2_input_md_var.get().strip()
         if not src_path or not os.path.exists(src_path):
             self.safe_showerror("エラー", "入力MDファイルを指定してください")
             return
 
+        move_ruby = False
         try:
-            self.lbl_split2_status.config(text="テスト中...", foreground="gray")
-            self.root.update()
+            move_ruby = bool(self.split2_move_ruby_var.get())
+        except Exception:
+            move_ruby = False
+        compiled = self._split2_get_rules()
 
+        def _work(progress):
+            progress.report(f"読み込み中... {os.path.basename(src_path)}", force=True)
             full_content = self._split2_read_full(src_path)
-            plan = self._split2_build_plan(src_path, None, full_content)
-
-            move_ruby = False
-            try:
-                move_ruby = bool(self.split2_move_ruby_var.get())
-            except Exception:
-                move_ruby = False
+            progress.check()
+            plan = self._split2_build_plan(src_path, None, full_content, compiled=compiled)
 
             ctx = {
                 "src_path": src_path,
                 "full_content": full_content,
                 "plan": plan,
                 "output_dir": None,
+                "rules_name": compiled["name"],
             }
-            chunks, combined, ruby_info = self._split2_prepare_split2_ctx(ctx, full_content, plan, move_ruby)
+            self._split2_prepare_split2_ctx(ctx, full_content, plan, move_ruby, progress)
+            return ctx
 
+        def _done(ctx):
             self._split2_preview_ctx = ctx
+            plan = ctx["plan"]
 
             summary = f"テストOK: 分割数 {len(plan)}（未出力）"
             if move_ruby:
@@ -2123,10 +5280,11 @@ class UnifiedYomitokuApp:
             self._split2_update_preview(plan, summary_text=summary)
             self.lbl_split2_status.config(text="テスト完了", foreground="gray")
 
-        except Exception as e:
-            self.lbl_split2_status.config(text="失敗", foreground="gray")
+        def _error(e):
             self.safe_showerror("エラー", f"テストに失敗しました:\n{e}")
 
+        self._start_text_task("テスト中", _work, _done, self.lbl_split2_status, on_error=_error)
+
     def merge_split2_selected_items(self):
         if not self._split2_preview_ctx:
             return
@@ -2169,49 +5327,59 @@ class UnifiedYomitokuApp:
         if start_idx < 0 or end_idx >= len(plan):
             return
 
-        # 結合処理
-        first_item = plan[start_idx]
-        last_item = plan[end_idx]
-
-        new_start = first_item["start"]
-        new_end = last_item["end"]
-        
-        chunk = full_content[new_start:new_end]
-        b = len(chunk.encode("utf-8"))
-        n_lines = 0 if chunk == "" else chunk.count("\n") + 1
-        chars = len(chunk)
-        kb = b / 1024.0
-
-        # 新しいアイテムを作成（ファイル名は先頭のものを引き継ぐ）
-        merged_item = {
-            "index": start_idx,
-            "name": first_item["name"],  # 名前は先頭を採用
-            "path": first_item["path"],  # パスも先頭ベース（ただし実行時にディレクトリ変わる可能性あり）
-            "start": new_start,
-            "end": new_end,
-            "bytes": b,
-            "lines": n_lines,
-            "chars": chars,
-            "kb": kb,
-            "tag": first_item["tag"] + " (merged)",
-            "exists": ""
-        }
-
-        # planリストを更新（対象範囲を削除して1つ挿入）
-        # popを後ろから行うとズレないが、スライス代入が簡単
-        # plan[start_idx : end_idx+1] = [merged_item]
-        
-        # Pythonのスライス代入で一括置換
-        plan[start_idx : end_idx + 1] = [merged_item]
-        # プレビュー更新（ここでインデックス再番も行われる）
         move_ruby = False
         try:
             move_ruby = bool(self.split2_move_ruby_var.get())
         except Exception:
             move_ruby = bool(ctx.get("ruby_move", False))
-        self._split2_prepare_split2_ctx(ctx, full_content, plan, move_ruby)
-        self._split2_update_preview(plan)
-        self.lbl_split2_status.config(text="結合しました（未保存）", foreground="blue")
+        rebuild = bool(ctx.get("ruby_move", False)) != move_ruby or not isinstance(ctx.get("chunks"), list)
+
+        def _work(progress):
+            if rebuild:
+                # ルビ近接の設定が変わった場合だけは全チャンクを作り直す（取り消し履歴もリセット）
+                work_ctx = dict(ctx)
+                work_plan = [dict(it) for it in plan]
+                self._split2_prepare_split2_ctx(work_ctx, full_content, work_plan, move_ruby, progress)
+            else:
+                work_ctx = ctx
+            progress.report("結合中...", force=True)
+            return work_ctx, self._split2_build_merge_op(work_ctx, start_idx, end_idx)
+
+        def _done(result):
+            work_ctx, op = result
+            if self._split2_preview_ctx is not ctx:
+                return
+            if work_ctx is not ctx:
+                self._split2_preview_ctx = work_ctx
+            self._split2_apply_merge_op(work_ctx, op)
+            work_ctx["undo_stack"].append(op)
+            work_ctx["redo_stack"] = []
+
+            # プレビュー更新（ここでインデックス再番も行われる）
+            self._split2_update_preview(work_ctx["plan"])
+            self.lbl_split2_status.config(text="結合しました（未保存）", foreground="blue")
+
+        self._start_text_task("結合中", _work, _done, self.lbl_split2_status)
+
+    def undo_split2_merge(self, event=None):
+        ctx = self._split2_preview_ctx
+        if not ctx or not ctx.get("undo_stack") or self.jobs.active(self.lbl_split2_status):
+            return
+        op = ctx["undo_stack"].pop()
+        self._split2_revert_merge_op(ctx, op)
+        ctx["redo_stack"].append(op)
+        self._split2_update_preview(ctx["plan"])
+        self.lbl_split2_status.config(text="結合を取り消しました（未保存）", foreground="blue")
+
+    def redo_split2_merge(self, event=None):
+        ctx = self._split2_preview_ctx
+        if not ctx or not ctx.get("redo_stack") or self.jobs.active(self.lbl_split2_status):
+            return
+        op = ctx["redo_stack"].pop()
+        self._split2_apply_merge_op(ctx, op)
+        ctx["undo_stack"].append(op)
+        self._split2_update_preview(ctx["plan"])
+        self.lbl_split2_status.config(text="結合をやり直しました（未保存）", foreground="blue")
 
     def on_split2_preview_double_click(self, event=None):
         if not self._split2_preview_ctx:
@@ -2242,6 +5410,11 @@ class UnifiedYomitokuApp:
             start = int(it.get("start", 0))
             end = int(it.get("end", 0))
             chunk = None
+            if ctx.get("output_dir") and it.get("exists") in ("✓", "=") and os.path.isfile(it.get("path", "")):
+                # 実行後は書き出し済み（検証済み）のファイルを mmap で表示する
+                title = f"2-2プレビュー: {it.get('name', '')}  (bytes={int(it.get('bytes', 0)):,})"
+                self._open_merge_text_viewer(title, path=it["path"])
+                return
             if isinstance(ctx.get('chunks'), list) and idx < len(ctx.get('chunks')):
                 chunk = ctx['chunks'][idx]
             else:
@@ -2253,137 +5426,233 @@ class UnifiedYomitokuApp:
         except Exception as e:
             self.safe_showerror("エラー", f"内容表示に失敗しました:\n{e}")
 
+    def _split2_execute(
+        self, src_path, output_dir, split_root, compiled, move_ruby, incremental, preview_ctx, progress
+    ):
+        """output_dir に分割を書き出し、_ORDER.txt・マニフェストを作って再構成を検証する（UI には触れない）。
+
+        preview_ctx があれば、そのプラン（手動結合済みなど）を使う。戻り値は検証結果と次のプレビュー用 ctx。
+        差分のみ出力で前回の結果が見つかったときは、出力フォルダ名に _update を付ける（戻り値の output_dir）。
+        """
+        prev_run = None
+        if incremental:
+            prev_run = self._split2_find_previous_run(split_root, src_path, output_dir)
+            if prev_run is None:
+                self.log("【Info】前回の分割結果（マニフェスト）が見つからないため、全チャンクを書き出します。")
+            else:
+                self.log(f"【Info】差分のみ出力: 比較元 {prev_run[0]}")
+                output_dir += "_update"
+        os.makedirs(output_dir, exist_ok=True)
+
+        progress.report(f"読み込み中... {os.path.basename(src_path)}", force=True)
+        full_content = self._split2_read_full(src_path)
+        total_length = len(full_content)
+
+        # ★改良：プレビュー（手動結合済みなど）があればそれを採用する
+        plan = None
+        cached_chunks = None
+        ruby_info = None
+        if preview_ctx:
+            ctx = preview_ctx
+            # 入力ファイルが変わっていないか確認
+            if ctx.get("src_path") == src_path:
+                # さらに内容長が一致するか（ファイル書き換わり対策）
+                if len(ctx.get("full_content", "")) == total_length:
+                    # ルビ集約のON/OFFと構造ルールが一致している場合のみ採用（内容が変わるため）
+                    if (
+                        bool(ctx.get("ruby_move", False)) == move_ruby
+                        and ctx.get("rules_name") == compiled["name"]
+                    ):
+                        plan = ctx.get("plan")
+                        if plan:
+                            self.log("【Info】手動編集済みのプレビュープランを使用して分割します。")
+                            # プレビュー側の表示用メタを書き換えないよう、行は複製して使う
+                            plan = [dict(it) for it in plan]
+                            # 内容まで一致すれば、プレビューで作成済みのチャンク文字列をそのまま使う
+                            chunks_ctx = ctx.get("chunks")
+                            if (
+                                isinstance(chunks_ctx, list)
+                                and len(chunks_ctx) == len(plan)
+                                and ctx.get("full_content") == full_content
+                            ):
+                                cached_chunks = list(chunks_ctx)
+                                ruby_info = ctx.get("ruby_info")
+
+        if plan is None:
+            plan = self._split2_build_plan(src_path, output_dir, full_content, compiled=compiled)
+
+        # 元テキストの範囲が漏れなくカバーされているか（ここは必ず元の長さで検証）
+        raw_total = 0
+        for it in plan:
+            raw_total += int(it["end"]) - int(it["start"])
+        if raw_total != total_length:
+            diff = total_length - raw_total
+            raise ValueError(
+                f"分割スライス合計が一致しません。\n元: {total_length}\n合計: {raw_total}\n差: {diff}"
+            )
+
+        # チャンク文字列を生成（必要ならルビをチャンク先頭に集約）
+        if cached_chunks is not None:
+            chunks = cached_chunks
+        else:
+            chunks, _, ruby_info = self._split2_build_chunks_text(full_content, plan, move_ruby, progress)
+        progress.check()
+
+        # 書き出し（チャンクごとの SHA256 を書き出しと同時に計算）
+        # キャンセルされた場合は、途中まで書き出したフォルダをログに残す
+        try:
+            entries, combined_sha, combined_bytes = self._split2_write_chunks(
+                output_dir, plan, chunks, prev_run, progress=progress
+            )
+        except TaskCancelled:
+            self.log(f"【中断】書き出し途中のフォルダ（マニフェストなし）: {output_dir}")
+            raise
+        written_entries = [e for e in entries if e["written"]]
+        written_paths = [e["path"] for e in written_entries]
+
+        base_run = None
+        changes = None
+        if prev_run is not None:
+            base_run = os.path.basename(prev_run[0])
+            changes = self._split2_diff_runs(entries, prev_run[1])
+            changes["changed_tags"] = [e["tag"] for e in written_entries]
+            self.log(
+                f"【差分】変更 {len(changes['changed'])} / 追加 {len(changes['added'])} / "
+                f"削除 {len(changes['removed'])} / 変更なし {len(entries) - len(written_entries)}"
+            )
+            for name in changes["changed"] + changes["added"]:
+                self.log(f"  -> 更新: {name}")
+            for name in changes["removed"]:
+                self.log(f"  -> 削除: {name}")
+
+        # _ORDER.txt はこのフォルダに書き出したファイルのみ（全体の順序はマニフェストを参照）
+        order_path = os.path.join(output_dir, SPLIT2_ORDER_NAME)
+        with open(order_path, "w", encoding="utf-8", newline="") as f:
+            for p in written_paths:
+                f.write(os.path.basename(p) + "\n")
+
+        source_sha = self._split2_sha256_text(full_content)
+        manifest_path = self._split2_write_manifest(
+            output_dir, src_path, full_content, source_sha, move_ruby, entries, combined_sha, combined_bytes,
+            base_run=base_run, changes=changes,
+        )
+
+        # 再構成して検証（move_ruby=False: 元ファイル / True: ルビ集約後）
+        # ディスクからブロック単位で読み直し、チャンクごとのハッシュとサイズを照合する
+        # （差分のみ出力では、前回のファイルを参照するチャンクも含めて全体を照合する）
+        ok, reconstructed_sha, mismatch = self._split2_verify_written(entries, chunks, progress=progress)
+        expected_chars = sum(e["chars"] for e in entries)
+        if ok and not move_ruby:
+            ok = (combined_sha == source_sha and expected_chars == total_length)
+
+        # 実行後もプレビューに残す（手動結合の結果も保持）
+        # チャンク文字列は書き出し済みのものをそのまま保持する（再計算しない）
+        ctx2 = {
+            "src_path": src_path,
+            "full_content": full_content,
+            "plan": plan,
+            "output_dir": output_dir,
+            "rules_name": compiled["name"],
+            "chunks": list(chunks),
+            "ruby_move": move_ruby,
+            "ruby_info": ruby_info,
+            "undo_stack": [],
+            "redo_stack": [],
+        }
+        return {
+            "ok": ok,
+            "mismatch": mismatch,
+            "output_dir": output_dir,
+            "total_length": total_length,
+            "expected_chars": expected_chars,
+            "source_sha": source_sha,
+            "combined_sha": combined_sha,
+            "reconstructed_sha": reconstructed_sha,
+            "order_path": order_path,
+            "manifest_path": manifest_path,
+            "base_run": base_run,
+            "changes": changes,
+            "ctx": ctx2,
+        }
+
     def run_split2(self):
         src_path = self.split2_input_md_var.get().strip()
         if not src_path or not os.path.exists(src_path):
             self.safe_showerror("エラー", "入力MDファイルを指定してください")
             return
 
+        incremental = False
         try:
-            self.lbl_split2_status.config(text="分割中...", foreground="gray")
-            self.root.update()
-
-            base_dir = os.path.dirname(src_path)
-            ts = time.strftime("%Y%m%d_%H%M%S")
-            output_dir = os.path.join(base_dir, "split_output_safe", ts)
-            os.makedirs(output_dir, exist_ok=True)
-
-            full_content = self._split2_read_full(src_path)
-            total_length = len(full_content)
+            incremental = bool(self.split2_incremental_var.get())
+        except Exception:
+            incremental = False
 
+        move_ruby = False
+        try:
+            move_ruby = bool(self.split2_move_ruby_var.get())
+        except Exception:
             move_ruby = False
-            try:
-                move_ruby = bool(self.split2_move_ruby_var.get())
-            except Exception:
-                move_ruby = False
-
-            # ★改良：プレビュー（手動結合済みなど）があればそれを採用する
-            plan = None
-            if self._split2_preview_ctx:
-                ctx = self._split2_preview_ctx
-                # 入力ファイルが変わっていないか確認
-                if ctx.get("src_path") == src_path:
-                    # さらに内容長が一致するか（ファイル書き換わり対策）
-                    if len(ctx.get("full_content", "")) == total_length:
-                        # ルビ集約のON/OFFが一致している場合のみ採用（内容が変わるため）
-                        if bool(ctx.get("ruby_move", False)) == move_ruby:
-                            plan = ctx.get("plan")
-                            if plan:
-                                self.log("【Info】手動編集済みのプレビュープランを使用して分割します。")
-
-            if plan is None:
-                plan = self._split2_build_plan(src_path, output_dir, full_content)
-
-            # 元テキストの範囲が漏れなくカバーされているか（ここは必ず元の長さで検証）
-            raw_total = 0
-            for it in plan:
-                raw_total += int(it["end"]) - int(it["start"])
-            if raw_total != total_length:
-                diff = total_length - raw_total
-                self.safe_showerror(
-                    "重大なエラー",
-                    f"分割スライス合計が一致しません。\n元: {total_length}\n合計: {raw_total}\n差: {diff}",
-                )
-                self.lbl_split2_status.config(text="エラー: 文字数不一致", foreground="gray")
-                return
 
-            # チャンク文字列を生成（必要ならルビをチャンク先頭に集約）
-            chunks, expected_combined, ruby_info = self._split2_build_chunks_text(full_content, plan, move_ruby)
+        compiled = self._split2_get_rules()
+        preview_ctx = self._split2_preview_ctx
 
-            written_paths = []
-            for i, it in enumerate(plan):
-                start = int(it["start"])
-                end = int(it["end"])
-                chunk = chunks[i] if i < len(chunks) else full_content[start:end]
+        base_dir = os.path.dirname(src_path)
+        ts = time.strftime("%Y%m%d_%H%M%S")
+        split_root = os.path.join(base_dir, "split_output_safe")
+        output_dir = os.path.join(split_root, ts)
 
-                out_path = os.path.join(output_dir, it["name"])
-                with open(out_path, "w", encoding="utf-8", newline="") as f:
-                    f.write(chunk)
-                written_paths.append(out_path)
-
-                # 表示用メタ（実行後のプレビューで利用）
-                it["index"] = i
-                it["path"] = out_path
-                it["exists"] = "✓"
-                b, n_lines, chars, kb = self._split2_compute_metrics(chunk)
-                it["bytes"] = b
-                it["lines"] = n_lines
-                it["chars"] = chars
-                it["kb"] = kb
-
-            order_path = os.path.join(output_dir, "_ORDER.txt")
-            with open(order_path, "w", encoding="utf-8", newline="") as f:
-                for p in written_paths:
-                    f.write(os.path.basename(p) + "\n")
-
-            # 再構成して検証（move_ruby=False: 元ファイル / True: ルビ集約後）
-            reconstructed_parts = []
-            for p in written_paths:
-                with open(p, "r", encoding="utf-8", newline="") as f:
-                    reconstructed_parts.append(f.read())
-            reconstructed = "".join(reconstructed_parts)
+        def _work(progress):
+            return self._split2_execute(
+                src_path, output_dir, split_root, compiled, move_ruby, incremental, preview_ctx, progress
+            )
 
-            ok = (reconstructed == expected_combined)
-            if ok:
+        def _done(res):
+            output_dir = res["output_dir"]
+            total_length = res["total_length"]
+            source_sha = res["source_sha"]
+            changes = res["changes"]
+            if res["ok"]:
                 if not move_ruby:
                     summary = (
                         "検証OK: 元ファイルと完全一致（順序・欠落なし）  "
                         f"chars={total_length:,}  "
-                        f"SHA256(元)={self._split2_sha256_text(full_content)[:12]}...  "
-                        f"SHA256(再構成)={self._split2_sha256_text(reconstructed)[:12]}..."
+                        f"SHA256(元)={source_sha[:12]}...  "
+                        f"SHA256(再構成)={res['reconstructed_sha'][:12]}..."
                     )
                 else:
                     summary = (
                         "検証OK: ルビ集約後の内容と一致（元ファイルからは変更）  "
                         f"orig_chars={total_length:,}  "
-                        f"new_chars={len(expected_combined):,}  "
-                        f"SHA256(元)={self._split2_sha256_text(full_content)[:12]}...  "
-                        f"SHA256(集約後)={self._split2_sha256_text(expected_combined)[:12]}..."
+                        f"new_chars={res['expected_chars']:,}  "
+                        f"SHA256(元)={source_sha[:12]}...  "
+                        f"SHA256(集約後)={res['combined_sha'][:12]}..."
                     )
 
                 self.lbl_split2_status.config(text="完了（検証OK）", foreground="gray")
-                self.safe_showinfo(
-                    "完了",
-                    f"分割が完了しました（検証OK）\n\n出力フォルダ:\n{output_dir}\n\n結合順ファイル:\n{order_path}",
+                done_msg = (
+                    f"分割が完了しました（検証OK）\n\n出力フォルダ:\n{output_dir}\n\n結合順ファイル:\n{res['order_path']}"
+                    f"\n\nマニフェスト:\n{res['manifest_path']}"
                 )
+                if changes is not None:
+                    updated = changes["changed"] + changes["added"]
+                    summary = f"差分のみ出力: 更新 {len(updated)}件 / 削除 {len(changes['removed'])}件  " + summary
+                    done_msg += (
+                        f"\n\n比較元: {res['base_run']}\n"
+                        f"更新（校正・EPUB再作成の対象）: {len(updated)}件\n"
+                        + ("\n".join(f"  {n}" for n in updated[:20]) or "  （なし）")
+                        + ("\n  ..." if len(updated) > 20 else "")
+                    )
+                    if changes["removed"]:
+                        done_msg += "\n削除: " + ", ".join(changes["removed"])
+                self.safe_showinfo("完了", done_msg)
             else:
-                mismatch_at = None
-                min_len = min(len(reconstructed), len(expected_combined))
-                for j in range(min_len):
-                    if reconstructed[j] != expected_combined[j]:
-                        mismatch_at = j
-                        break
-                if mismatch_at is None and len(reconstructed) != len(expected_combined):
-                    mismatch_at = min_len
-
+                mismatch = res["mismatch"]
                 around = ""
-                if mismatch_at is not None:
-                    a0 = max(0, mismatch_at - 40)
-                    a1 = min(len(expected_combined), mismatch_at + 40)
+                if mismatch is not None:
                     around = (
-                        f"\n\n不一致位置: {mismatch_at}\n"
-                        f"期待(周辺): {repr(expected_combined[a0:a1])}\n"
-                        f"実際(周辺): {repr(reconstructed[a0:a1])}"
+                        f"\n\n不一致位置: {mismatch['offset']}（{mismatch['name']} 内 {mismatch['chunk_offset']}文字目）\n"
+                        f"期待(周辺): {repr(mismatch['expected'])}\n"
+                        f"実際(周辺): {repr(mismatch['actual'])}"
                     )
 
                 self.safe_showerror(
@@ -2391,29 +5660,27 @@ class UnifiedYomitokuApp:
                     f"再構成結果が期待値と一致しません。{around}\n\n出力フォルダ:\n{output_dir}",
                 )
                 self.lbl_split2_status.config(text="完了（検証NG）", foreground="gray")
+                if mismatch is not None and os.path.isfile(mismatch["path"]):
+                    # 書き出したファイルを不一致位置で開く
+                    self._open_merge_text_viewer(
+                        f"検証NG: {mismatch['name']}", path=mismatch["path"], jump_to=mismatch["chunk_offset"]
+                    )
                 summary = "検証NG: 再構成が一致しません（詳細はエラー表示を参照）"
 
-            # 実行後もプレビューに残す（手動結合の結果も保持）
-            ctx2 = {
-                "src_path": src_path,
-                "full_content": full_content,
-                "plan": plan,
-                "output_dir": output_dir,
-            }
-            self._split2_prepare_split2_ctx(ctx2, full_content, plan, move_ruby)
-            self._split2_preview_ctx = ctx2
-            self._split2_update_preview(plan, summary_text=summary)
+            self._split2_preview_ctx = res["ctx"]
+            self._split2_update_preview(res["ctx"]["plan"], summary_text=summary)
 
-        except Exception as e:
-            self.lbl_split2_status.config(text="失敗", foreground="gray")
+        def _error(e):
             self.safe_showerror("エラー", f"分割に失敗しました:\n{e}")
 
+        self._start_text_task("分割中", _work, _done, self.lbl_split2_status, on_error=_error)
+
     def init_tab_merge(self):
         frame = self.tab_merge
 
-        self.merge_stack = []
+        self.merge_stack = self._open_merge_stack()
         self.is_monitoring = False
-        self.last_clipboard_hash = None
+        self._clipboard_watcher = None
 
         container = tk.Frame(frame, pady=10)
         container.pack(fill="both", expand=True, padx=20)
@@ -2430,6 +5697,7 @@ class UnifiedYomitokuApp:
         list_frame.pack(fill="both", expand=True, pady=5)
 
         self.listbox = tk.Listbox(list_frame, height=8, selectmode="extended")
+        self._merge_list_rows = ListboxRows(self.listbox)
         scrollbar = tk.Scrollbar(list_frame, orient="vertical", command=self.listbox.yview)
         self.listbox.config(yscrollcommand=scrollbar.set)
         scrollbar.pack(side="right", fill="y")
@@ -2451,7 +5719,15 @@ class UnifiedYomitokuApp:
         self.label_stack_count.pack(side="right")
 
         tk.Button(container, text="結合して保存", command=self.save_merged_file, bg="#c8e6c9", height=2).pack(fill="x", pady=15)
-        tk.Button(container, text="リセット", command=self.reset_stack).pack(anchor="e")
+        bottom = tk.Frame(container)
+        bottom.pack(fill="x")
+        tk.Button(
+            bottom, text="フォルダから一括結合（_ORDER.txt / _MANIFEST.json）", command=self.bulk_merge_folder
+        ).pack(side="left")
+        tk.Button(bottom, text="JSONL校正結果から結合", command=self.merge_chunk_batch_results).pack(side="left", padx=10)
+        tk.Button(bottom, text="リセット", command=self.reset_stack).pack(side="right")
+        if self.merge_stack:
+            self.update_list_display()
 
     def toggle_monitoring(self):
         if pyperclip is None:
@@ -2459,39 +5735,55 @@ class UnifiedYomitokuApp:
             return
 
         if not self.is_monitoring:
-            try:
-                c = pyperclip.paste()
-                self.last_clipboard_hash = hashlib.sha256(c.encode("utf-8", "ignore")).hexdigest() if c else None
-            except Exception:
-                pass
+            watcher = self._get_clipboard_watcher()
+            watcher.prime()
             self.is_monitoring = True
             self.btn_monitor.config(text="監視停止", bg="#ffab91")
             self.label_merge_status.config(text="監視中...", fg="blue")
-            threading.Thread(target=self.monitor_loop, daemon=True).start()
+            watcher.start()
         else:
             self.is_monitoring = False
+            if self._clipboard_watcher is not None:
+                self._clipboard_watcher.stop()
             self.btn_monitor.config(text="監視開始", bg="#fff9c4")
             self.label_merge_status.config(text="一時停止中", fg="gray")
 
-    def monitor_loop(self):
-        while self.is_monitoring and self.root.winfo_exists():
-            try:
-                content = pyperclip.paste()
-                if content:
-                    chash = hashlib.sha256(content.encode("utf-8", "ignore")).hexdigest()
-                    if chash != self.last_clipboard_hash and content.strip():
-                        self.merge_stack.append(content.rstrip("\n"))
-                        self.last_clipboard_hash = chash
-                        self.root.after(0, self.update_list_display)
-            except Exception:
-                pass
-            time.sleep(1.0)
+    def _get_clipboard_watcher(self):
+        if self._clipboard_watcher is None:
+            self._clipboard_watcher = ClipboardWatcher(
+                make_clipboard_backend(),
+                lambda content: self.root.after(0, lambda: self._on_clipboard_content(content)),
+            )
+        return self._clipboard_watcher
+
+    def _on_clipboard_content(self, content: str):
+        if not self.is_monitoring:
+            return
+        self.merge_stack.append(content.rstrip("\n"))
+        self.update_list_display()
+
+    def _open_merge_stack(self):
+        """ディスク上のスタックを開く（前回の内容を復元）。開けなければ一時フォルダを使う。"""
+        try:
+            store = MergeStackStore(MERGE_STACK_DIR)
+        except Exception as e:
+            import tempfile
+
+            tmp_dir = tempfile.mkdtemp(prefix="yomitoku_merge_stack_")
+            msg = f"【警告】スタックの保存先を開けないため一時フォルダを使います: {e}"
+            # ログ欄はタブの後に作られるので、起動後に出力する
+            self.root.after(0, lambda: self.log(msg))
+            return MergeStackStore(tmp_dir)
+        if store.recovered:
+            msg = f"Tab3: 前回のスタック {store.recovered}件 を復元しました（{store.root_dir}）"
+            self.root.after(0, lambda: self.log(msg))
+        return store
 
     def update_list_display(self, select_idx=None):
-        self.listbox.delete(0, tk.END)
-        for i, t in enumerate(self.merge_stack):
-            one = t.replace("\r\n", "\n").replace("\n", " ")
-            self.listbox.insert(tk.END, f"{i+1}: {one[:80]}{'...' if len(one) > 80 else ''}")
+        # 一覧用ラベルはスタック側が項目ごとに保持している（本文は読まない）
+        labels = self.merge_stack.labels()
+        # 追加・移動・削除では変わった行だけを書き換える
+        self._merge_list_rows.sync(f"{i+1}: {lab}" for i, lab in enumerate(labels))
 
         self.label_stack_count.config(text=f"件数: {len(self.merge_stack)}")
         if select_idx is not None:
@@ -2510,7 +5802,7 @@ class UnifiedYomitokuApp:
             return
         idx = idxs[0]
         if idx > 0:
-            self.merge_stack[idx], self.merge_stack[idx - 1] = self.merge_stack[idx - 1], self.merge_stack[idx]
+            self.merge_stack.move(idx, idx - 1)
             self.update_list_display(select_idx=idx - 1)
 
     def move_item_down(self):
@@ -2519,18 +5811,17 @@ class UnifiedYomitokuApp:
             return
         idx = idxs[0]
         if idx < len(self.merge_stack) - 1:
-            self.merge_stack[idx], self.merge_stack[idx + 1] = self.merge_stack[idx + 1], self.merge_stack[idx]
+            self.merge_stack.move(idx, idx + 1)
             self.update_list_display(select_idx=idx + 1)
 
     def delete_selected_item(self):
         idxs = list(self.listbox.curselection())
         if not idxs:
             return
-        for idx in reversed(idxs):
-            try:
-                del self.merge_stack[idx]
-            except Exception:
-                pass
+        try:
+            self.merge_stack.delete(idxs)
+        except Exception as e:
+            self.safe_showerror("エラー", str(e))
         self.update_list_display()
 
     def preview_selected_item(self, event=None):
@@ -2555,7 +5846,7 @@ class UnifiedYomitokuApp:
             if not new_text.strip():
                 self.safe_showerror("エラー", "空の内容にはできません")
                 return
-            self.merge_stack[idx] = new_text
+            self.merge_stack.set(idx, new_text)
             self.update_list_display(select_idx=idx)
 
         self._open_merge_text_editor(f"選択編集（{idx+1}）", original, _on_save)
@@ -2577,21 +5868,192 @@ class UnifiedYomitokuApp:
 
         self._open_merge_text_editor("手動追加", initial, _on_save)
 
-    def _open_merge_text_viewer(self, title: str, text_value: str):
+    def _open_merge_text_viewer(self, title: str, text_value: str = None, path: str = None, jump_to=None):
+        """読み取り専用ビューア。行オフセット索引を作り、表示位置の周辺の行だけを Text に読み込む。
+
+        path を渡すとファイルを mmap で開く（全体をメモリに読み込まない）。
+        jump_to: 最初に表示する文字位置（先頭からの文字数）
+        """
+        try:
+            source = MmapLineSource(path) if path is not None else StringLineSource(text_value or "")
+        except Exception as e:
+            self.safe_showerror("エラー", f"表示に失敗しました:\n{e}")
+            return
+        total = source.line_count
+
         win = tk.Toplevel(self.root)
         win.title(title)
-        win.geometry("760x520")
+        win.geometry("760x560")
         win.transient(self.root)
         win.grab_set()
 
-        txt = scrolledtext.ScrolledText(win, wrap=tk.WORD)
-        txt.pack(fill="both", expand=True, padx=10, pady=10)
-        txt.insert("1.0", text_value)
-        txt.config(state="disabled")
+        bar = tk.Frame(win)
+        bar.pack(fill="x", padx=10, pady=(10, 0))
+        tk.Label(bar, text="検索:").pack(side="left")
+        search_var = tk.StringVar()
+        ent_search = tk.Entry(bar, textvariable=search_var, width=24)
+        ent_search.pack(side="left", padx=5)
+        tk.Button(bar, text="次へ", command=lambda: _search(True)).pack(side="left")
+        tk.Label(bar, text="移動:").pack(side="left", padx=(16, 0))
+        jump_var = tk.StringVar()
+        ent_jump = tk.Entry(bar, textvariable=jump_var, width=10)
+        ent_jump.pack(side="left", padx=5)
+        tk.Button(bar, text="行へ", command=lambda: _jump("line")).pack(side="left")
+        tk.Button(bar, text="文字位置へ", command=lambda: _jump("char")).pack(side="left", padx=(5, 0))
+
+        body = tk.Frame(win)
+        body.pack(fill="both", expand=True, padx=10, pady=10)
+        sb = tk.Scrollbar(body, orient="vertical")
+        txt = tk.Text(body, wrap=tk.WORD)
+        sb.pack(side="right", fill="y")
+        txt.pack(side="left", fill="both", expand=True)
+        txt.tag_configure("match", background="#fff59d")
 
         btns = tk.Frame(win)
         btns.pack(fill="x", padx=10, pady=(0, 10))
-        tk.Button(btns, text="閉じる", command=win.destroy, width=10).pack(side="right")
+        base_status = f"全 {total:,} 行 / {source.char_length:,} 文字" + ("（ファイルから表示）" if path else "")
+        lbl_status = tk.Label(btns, text=base_status, fg="gray")
+        lbl_status.pack(side="left")
+
+        # first..last: Text に読み込み済みの行範囲 / match: (行, 桁, 長さ)
+        view = {"first": 0, "last": 0, "match": None, "pending": False}
+        margin = int(VIEWER_WINDOW_LINES * VIEWER_EDGE_FRACTION)
+
+        def _mark_match():
+            txt.tag_remove("match", "1.0", "end")
+            m = view["match"]
+            if m is not None and view["first"] <= m[0] < view["last"]:
+                start = f"{m[0] - view['first'] + 1}.{m[1]}"
+                txt.tag_add("match", start, f"{start}+{m[2]}c")
+
+        def _load(first):
+            first = max(0, min(int(first), total - VIEWER_WINDOW_LINES))
+            last = min(total, first + VIEWER_WINDOW_LINES)
+            try:
+                lines = source.get_lines(first, last)
+            except OSError as e:
+                lbl_status.config(text=str(e))
+                return
+            txt.config(state="normal")
+            txt.delete("1.0", "end")
+            txt.insert("1.0", lines)
+            txt.config(state="disabled")
+            view["first"], view["last"] = first, last
+            _mark_match()
+
+        def _top_line():
+            return view["first"] + int(txt.index("@0,0").split(".")[0]) - 1
+
+        def _show_line(line, col=0):
+            inside = (
+                view["first"] <= line < view["last"]
+                and (view["first"] == 0 or line >= view["first"] + margin)
+                and (view["last"] == total or line < view["last"] - margin)
+            )
+            if not inside:
+                _load(line - VIEWER_WINDOW_LINES // 2)
+            txt.yview(f"{line - view['first'] + 1}.0")
+            txt.see(f"{line - view['first'] + 1}.{col}")
+
+        def _near_edge(lo, hi):
+            near_end = hi > 1.0 - VIEWER_EDGE_FRACTION and view["last"] < total
+            near_start = lo < VIEWER_EDGE_FRACTION and view["first"] > 0
+            return near_end or near_start
+
+        def _recenter():
+            view["pending"] = False
+            # 読み込み直後の通知で呼ばれることもあるので、現在の表示位置で判定し直す
+            if not _near_edge(*txt.yview()):
+                return
+            top = _top_line()
+            first = max(0, min(top - VIEWER_WINDOW_LINES // 2, total - VIEWER_WINDOW_LINES))
+            if first == view["first"]:
+                return
+            _load(first)
+            txt.yview(f"{top - view['first'] + 1}.0")
+
+        def _on_yview(lo, hi):
+            lo, hi = float(lo), float(hi)
+            n = max(1, view["last"] - view["first"])
+            sb.set((view["first"] + lo * n) / max(1, total), (view["first"] + hi * n) / max(1, total))
+            if _near_edge(lo, hi) and not view["pending"]:
+                view["pending"] = True
+                win.after_idle(_recenter)
+
+        def _on_scrollbar(*args):
+            if args and args[0] == "moveto":
+                _show_line(min(total - 1, max(0, int(float(args[1]) * total))))
+            else:
+                txt.yview(*args)
+
+        txt.config(yscrollcommand=_on_yview)
+        sb.config(command=_on_scrollbar)
+
+        def _search(again=False):
+            query = search_var.get()
+            if not query:
+                view["match"] = None
+                _mark_match()
+                lbl_status.config(text=base_status)
+                return
+            m = view["match"]
+            if m is not None:
+                line, col = m[0], m[1] + (1 if again else 0)
+            else:
+                line, col = _top_line(), 0
+            try:
+                hit = source.find(query, line, col)
+                wrapped = False
+                if hit is None:
+                    hit = source.find(query, 0, 0)
+                    wrapped = True
+            except OSError as e:
+                lbl_status.config(text=str(e))
+                return
+            if hit is None:
+                view["match"] = None
+                _mark_match()
+                lbl_status.config(text=f"見つかりません: {query}")
+                return
+            view["match"] = (hit[0], hit[1], len(query))
+            _show_line(hit[0], hit[1])
+            _mark_match()
+            lbl_status.config(text=f"{hit[0] + 1:,} 行目 / 全 {total:,} 行" + ("（先頭から再検索）" if wrapped else ""))
+
+        def _jump(kind):
+            try:
+                n = int(jump_var.get().replace(",", "").strip())
+            except ValueError:
+                lbl_status.config(text="移動先は数値で入力してください")
+                return
+            if kind == "line":
+                line, col = max(0, min(n, total) - 1), 0
+            else:
+                line, col = source.locate_char(n)
+            view["match"] = (line, col, 1)
+            _show_line(line, col)
+            _mark_match()
+            lbl_status.config(text=f"{line + 1:,} 行目 {col + 1:,} 文字目 / 全 {total:,} 行")
+
+        def _on_search_key(event):
+            if event.keysym not in ("Return", "KP_Enter"):
+                _search(False)
+
+        ent_search.bind("<KeyRelease>", _on_search_key)
+        ent_search.bind("<Return>", lambda e: _search(True))
+        ent_jump.bind("<Return>", lambda e: _jump("char"))
+
+        def _close():
+            source.close()
+            win.destroy()
+
+        win.protocol("WM_DELETE_WINDOW", _close)
+        tk.Button(btns, text="閉じる", command=_close, width=10).pack(side="right")
+
+        _load(0)
+        if jump_to is not None:
+            jump_var.set(str(int(jump_to)))
+            _jump("char")
 
     def _open_merge_text_editor(self, title: str, initial_text: str, on_save):
         win = tk.Toplevel(self.root)
@@ -2624,25 +6086,240 @@ class UnifiedYomitokuApp:
         if not self.merge_stack:
             self.safe_showerror("エラー", "スタックが空です")
             return
-        path = filedialog.asksaveasfilename(defaultextension=".md", filetypes=[("MD", "*.md"), ("All", "*.*")])
-        if path:
-            try:
-                with open(path, "w", encoding="utf-8") as f:
-                    f.write("\n\n\n".join(self.merge_stack).rstrip() + "\n")
-                self.safe_showinfo("成功", f"保存しました。\n{path}")
-            except Exception as e:
-                self.safe_showerror("エラー", str(e))
+        path = filedialog.asksaveasfilename(defaultextension=".md", filetypes=[("MD", "*.md"), ("All", "*.*")])
+        if path:
+            try:
+                # 項目を順に読みながら書き出す（全体を1つの文字列にしない）
+                last = len(self.merge_stack) - 1
+                with open(path, "w", encoding="utf-8") as f:
+                    for i, text in enumerate(self.merge_stack):
+                        if i:
+                            f.write("\n\n\n")
+                        f.write(text.rstrip() if i == last else text)
+                    f.write("\n")
+                self.safe_showinfo("成功", f"保存しました。\n{path}")
+            except Exception as e:
+                self.safe_showerror("エラー", str(e))
+
+    def reset_stack(self):
+        if messagebox.askyesno("確認", "クリアしますか？\n（直前の内容は保存先の last_reset フォルダに1世代だけ残ります）"):
+            try:
+                self.merge_stack.clear()
+            except Exception as e:
+                self.safe_showerror("エラー", str(e))
+            self.update_list_display()
+            if pyperclip is not None:
+                self._get_clipboard_watcher().prime()
+
+    def _merge_collect_chunk_files(self, folder: str) -> dict:
+        """校正済みチャンクのフォルダから、結合順のファイル一覧と欠落/余分なファイルを求める。
+
+        _MANIFEST.json があれば優先し（差分のみ出力で前回フォルダを参照するチャンクも解決する）、
+        なければ _ORDER.txt を使う。
+        戻り値: {source, files: [(name, path, expected_sha256)], missing, extra, from_other_runs}
+        """
+        manifest_path = os.path.join(folder, SPLIT2_MANIFEST_NAME)
+        order_path = os.path.join(folder, SPLIT2_ORDER_NAME)
+        split_root = os.path.dirname(os.path.abspath(folder))
+
+        entries = []
+        if os.path.isfile(manifest_path):
+            source = SPLIT2_MANIFEST_NAME
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            for e in sorted(manifest.get("chunks", []), key=lambda c: int(c.get("order", 0))):
+                entries.append((e["name"], e.get("file"), e.get("sha256")))
+        elif os.path.isfile(order_path):
+            source = SPLIT2_ORDER_NAME
+            with open(order_path, "r", encoding="utf-8-sig") as f:
+                for line in f:
+                    name = line.strip()
+                    if name:
+                        entries.append((name, None, None))
+        else:
+            raise FileNotFoundError(f"{SPLIT2_ORDER_NAME} または {SPLIT2_MANIFEST_NAME} が見つかりません:\n{folder}")
+
+        files = []
+        missing = []
+        from_other_runs = []
+        listed = set()
+        for name, rel_file, sha in entries:
+            listed.add(name)
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path) and rel_file:
+                # 差分のみ出力：このフォルダにないチャンクは、マニフェストが指す前回のファイルを使う
+                other = os.path.join(split_root, *rel_file.split("/"))
+                if os.path.isfile(other):
+                    path = other
+                    from_other_runs.append(name)
+            if os.path.isfile(path):
+                files.append((name, path, sha))
+            else:
+                missing.append(name)
+
+        extra = sorted(
+            n for n in os.listdir(folder)
+            if n not in listed
+            and n not in (SPLIT2_ORDER_NAME, SPLIT2_MANIFEST_NAME)
+            and not n.startswith(".")
+            and os.path.splitext(n)[1].lower() in (".md", ".txt")
+            and os.path.isfile(os.path.join(folder, n))
+        )
+        return {"source": source, "files": files, "missing": missing, "extra": extra, "from_other_runs": from_other_runs}
+
+    def _merge_stream_files(self, files: list, out_path: str, progress=None) -> dict:
+        """チャンクファイルを順にブロック単位でコピーして1つの Markdown にする（メモリ使用量は一定）。
+
+        ファイル先頭の BOM は除き、改行で終わっていないチャンクの後には、次のチャンクとの間にだけ改行を1つ補う
+        （最後のチャンクの後には足さない）。未校正のチャンクだけなら、分割前の元ファイルとバイト単位で同じになる。
+        """
+        total = sum(os.path.getsize(p) for _, p, _ in files)
+        done = 0
+        changed = []
+        tmp_path = out_path + ".part"
+        try:
+            with open(tmp_path, "wb") as out:
+                for i, (name, path, expected_sha) in enumerate(files, start=1):
+                    h = hashlib.sha256()
+                    last = b""
+                    first = True
+                    with open(path, "rb") as f:
+                        while True:
+                            block = f.read(SPLIT2_VERIFY_BLOCK_SIZE)
+                            if not block:
+                                break
+                            if first and block.startswith(b"\xef\xbb\xbf"):
+                                block = block[3:]
+                            first = False
+                            h.update(block)
+                            out.write(block)
+                            if block:
+                                last = block[-1:]
+                            done += len(block)
+                            if progress is not None:
+                                progress.report(
+                                    f"結合中... {i}/{len(files)}  {format_bytes(done)} / {format_bytes(total)}",
+                                    done=done, total=total, unit="bytes",
+                                )
+                    if last and last != b"\n" and i < len(files):
+                        out.write(b"\n")
+                    if expected_sha and h.hexdigest() != expected_sha:
+                        changed.append(name)
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return {"bytes": os.path.getsize(out_path), "changed": changed}
+
+    def bulk_merge_folder(self):
+        folder = filedialog.askdirectory(title="校正済みチャンクのフォルダ（_ORDER.txt / _MANIFEST.json のある場所）")
+        if not folder:
+            return
+        try:
+            found = self._merge_collect_chunk_files(folder)
+        except Exception as e:
+            self.safe_showerror("エラー", str(e))
+            return
+
+        if found["missing"]:
+            preview = "\n".join(found["missing"][:20]) + ("\n..." if len(found["missing"]) > 20 else "")
+            self.safe_showerror(
+                "ファイル不足",
+                f"{found['source']} に載っているファイルのうち {len(found['missing'])}件 が見つかりません。\n\n{preview}",
+            )
+            return
+        if not found["files"]:
+            self.safe_showerror("エラー", f"{found['source']} に結合するファイルがありません")
+            return
+        if found["extra"]:
+            preview = "\n".join(found["extra"][:20]) + ("\n..." if len(found["extra"]) > 20 else "")
+            msg = (
+                f"{found['source']} に載っていないファイルが {len(found['extra'])}件 あります（結合しません）。\n"
+                f"このまま結合しますか？\n\n{preview}"
+            )
+            if not messagebox.askyesno("確認", msg):
+                return
+
+        out_path = filedialog.asksaveasfilename(
+            initialdir=os.path.dirname(os.path.abspath(folder)),
+            initialfile=f"{os.path.basename(os.path.abspath(folder))}_merged.md",
+            defaultextension=".md",
+            filetypes=[("MD", "*.md"), ("All", "*.*")],
+        )
+        if not out_path:
+            return
+
+        files = found["files"]
+
+        def _done(stats):
+            self.label_merge_status.config(text="一括結合しました", fg="gray")
+            msg = (
+                f"{len(files)}件 を結合しました（{found['source']} の順）。\n{out_path}\n"
+                f"サイズ: {stats['bytes']:,} bytes"
+            )
+            if found["source"] == SPLIT2_MANIFEST_NAME:
+                msg += f"\n分割時から変更されたチャンク: {len(stats['changed'])}件"
+            if found["from_other_runs"]:
+                msg += f"\n前回の分割フォルダから補ったチャンク: {len(found['from_other_runs'])}件"
+            self.log(f"一括結合: {out_path}（{len(files)}件）")
+            self.safe_showinfo("成功", msg)
+
+        self._start_text_task(
+            "一括結合", lambda progress: self._merge_stream_files(files, out_path, progress), _done, self.label_merge_status
+        )
+
+    def merge_chunk_batch_results(self):
+        batch_path = filedialog.askopenfilename(
+            title="書き出したチャンクJSONL（元）", filetypes=[("JSONL", "*.jsonl"), ("All files", "*.*")]
+        )
+        if not batch_path:
+            return
+        results_path = filedialog.askopenfilename(
+            title="校正結果のJSONL",
+            initialdir=os.path.dirname(batch_path),
+            filetypes=[("JSONL", "*.jsonl"), ("All files", "*.*")],
+        )
+        if not results_path:
+            return
+        root_name = os.path.basename(batch_path)
+        for suffix in (".jsonl", ".batch"):
+            if root_name.endswith(suffix):
+                root_name = root_name[: -len(suffix)]
+        out_path = filedialog.asksaveasfilename(
+            initialdir=os.path.dirname(batch_path),
+            initialfile=f"{root_name}_merged.md",
+            defaultextension=".md",
+            filetypes=[("MD", "*.md"), ("All", "*.*")],
+        )
+        if not out_path:
+            return
 
-    def reset_stack(self):
-        if messagebox.askyesno("確認", "クリアしますか？"):
-            self.merge_stack = []
-            self.update_list_display()
-            try:
-                c = pyperclip.paste()
-                if c:
-                    self.last_clipboard_hash = hashlib.sha256(c.encode("utf-8", "ignore")).hexdigest()
-            except Exception:
-                pass
+        def _done(stats):
+            self.label_merge_status.config(text="JSONLから結合しました", fg="gray")
+            msg = (
+                f"{stats['chunks']}件 を結合しました。\n{out_path}\n\n"
+                f"校正結果を採用: {len(stats['corrected'])}件\n"
+                f"結果なし（元のまま）: {len(stats['kept'])}件"
+            )
+            if stats["rejected"]:
+                msg += f"\nハッシュ不一致・本文なし（元のまま）: {', '.join(stats['rejected'][:10])}"
+            if stats["truncated"]:
+                msg += f"\n出力の上限で途中まで（元のまま）: {', '.join(stats['truncated'][:10])}"
+                self.log(f"[WARN] 出力の上限で途中までになった校正結果は使いませんでした: {len(stats['truncated'])}件")
+            if stats["unknown"]:
+                msg += f"\n元のバッチにないID: {stats['unknown']}件（無視）"
+            self.log(f"JSONL結合: {out_path}")
+            self.safe_showinfo("成功", msg)
+
+        self._start_text_task(
+            "JSONLから結合",
+            lambda progress: merge_chunk_batch(batch_path, results_path, out_path, progress),
+            _done,
+            self.label_merge_status,
+        )
 
     # ==========================================
     # Tab 4: EPUB化
@@ -2677,9 +6354,41 @@ class UnifiedYomitokuApp:
         self.epub_author_var = tk.StringVar(value="Author")
         ttk.Entry(row4, textvariable=self.epub_author_var).pack(side="left", fill="x", expand=True, padx=5)
 
+        row4b = ttk.Frame(frm)
+        row4b.pack(fill="x", pady=5)
+        ttk.Label(row4b, text="XHTMLの分割:").pack(side="left")
+        self.epub_split_var = tk.StringVar(value=next(iter(EPUB_SPLIT_LABELS)))
+        ttk.Combobox(
+            row4b, textvariable=self.epub_split_var, values=list(EPUB_SPLIT_LABELS), state="readonly", width=30
+        ).pack(side="left", padx=5)
+        ttk.Label(row4b, text="1ファイルの上限KB（目安）:").pack(side="left", padx=(10, 0))
+        self.epub_max_kb_var = tk.IntVar(value=EPUB_DEFAULT_MAX_KB)
+        ttk.Spinbox(row4b, from_=0, to=10000, increment=50, textvariable=self.epub_max_kb_var, width=7).pack(
+            side="left", padx=5
+        )
+
+        row4c = ttk.Frame(frm)
+        row4c.pack(fill="x", pady=5)
+        ttk.Label(row4c, text="表紙・図版の画像:").pack(side="left")
+        self.epub_image_format_var = tk.StringVar(value=next(iter(EPUB_IMAGE_FORMATS)))
+        ttk.Combobox(
+            row4c, textvariable=self.epub_image_format_var, values=list(EPUB_IMAGE_FORMATS), state="readonly", width=8
+        ).pack(side="left", padx=5)
+        ttk.Label(row4c, text="画質:").pack(side="left", padx=(10, 0))
+        self.epub_image_quality_var = tk.IntVar(value=EPUB_IMAGE_DEFAULT_QUALITY)
+        ttk.Spinbox(
+            row4c, from_=EPUB_IMAGE_MIN_QUALITY, to=95, increment=5, textvariable=self.epub_image_quality_var, width=5
+        ).pack(side="left", padx=5)
+        ttk.Label(row4c, text="画像の合計上限MB（0で上限なし）:").pack(side="left", padx=(10, 0))
+        self.epub_image_budget_var = tk.IntVar(value=EPUB_IMAGE_DEFAULT_BUDGET_MB)
+        ttk.Spinbox(row4c, from_=0, to=1000, increment=5, textvariable=self.epub_image_budget_var, width=6).pack(
+            side="left", padx=5
+        )
+
         row5 = ttk.Frame(frm)
         row5.pack(fill="x", pady=10)
         ttk.Button(row5, text="EPUB作成", command=self.run_epub).pack(side="left", padx=5)
+        ttk.Button(row5, text="キャンセル", command=lambda: self.cancel_text_task(self.lbl_epub_status)).pack(side="left")
         self.lbl_epub_status = ttk.Label(row5, text="")
         self.lbl_epub_status.pack(side="left", padx=10)
 
@@ -2750,46 +6459,274 @@ class UnifiedYomitokuApp:
             self.safe_showerror("エラー", "出力EPUBを指定してください")
             return
 
+        # Tk の変数はここで読み、変換・書き出しはバックグラウンドで行う
+        mode = EPUB_SPLIT_LABELS.get(self.epub_split_var.get(), 1)
         try:
+            max_bytes = max(0, int(self.epub_max_kb_var.get())) * 1024
+        except Exception:
+            max_bytes = EPUB_DEFAULT_MAX_KB * 1024
+        compiled = self._split2_get_rules() if mode == "split2" else None
+        images_pipeline = self._epub_image_pipeline_from_ui()
+
+        def _work(progress):
+            progress.report("読み込み中...", force=True)
             with open(md_path, "r", encoding="utf-8") as f:
-                md_text = f.read()
+                # 少しずつ読んでつなぐ（一括 read() はデコード途中の一時領域でピークが数倍になる）
+                md_text = "".join(iter(lambda: f.read(1024 * 1024), ""))
+            return self._epub_build(
+                md_path, md_text, out_epub_path, title, author, mode, max_bytes, compiled, images_pipeline, progress
+            )
+
+        def _done(stats):
+            self.lbl_epub_status.config(text="EPUB作成完了")
+            self._epub_log_stats(stats)
+            self.safe_showinfo("完了", f"EPUBを作成しました:\n{out_epub_path}")
+            self.log(f"EPUB作成: {out_epub_path}")
+
+        def _error(e):
+            self.safe_showerror("エラー", str(e))
+            self.lbl_epub_status.config(text="EPUB作成失敗")
 
-            html = markdown_lib.markdown(md_text, extensions=["tables", "fenced_code"])
+        self._start_text_task("EPUB作成中", _work, _done, self.lbl_epub_status, on_error=_error)
 
-            book = epub.EpubBook()
-            book.set_identifier(hashlib.md5((title + author).encode("utf-8")).hexdigest())
-            book.set_title(title)
-            book.add_author(author)
-            book.set_language("ja")
+    def _epub_image_pipeline_from_ui(self):
+        """Tab4 の画像設定から EpubImagePipeline を作る（Tk の変数を読むので UI スレッドで呼ぶ）。"""
+        try:
+            image_quality = int(self.epub_image_quality_var.get())
+        except Exception:
+            image_quality = EPUB_IMAGE_DEFAULT_QUALITY
+        try:
+            image_budget = max(0, int(self.epub_image_budget_var.get())) * 1024 * 1024
+        except Exception:
+            image_budget = EPUB_IMAGE_DEFAULT_BUDGET_MB * 1024 * 1024
+        return EpubImagePipeline(self.epub_image_format_var.get(), image_quality, image_budget)
+
+    def _epub_build(self, md_path, md_text, out_epub_path, title, author, mode, max_bytes, compiled,
+                    images_pipeline, progress=None):
+        """Markdown 本文から EPUB を作る（md_path は表紙・図版を探すフォルダの基準）。戻り値は統計。"""
+        spans = self._epub_split_chapters(md_text, mode, max_bytes, compiled)
+        images = self._epub_prepare_images(md_path, md_text, images_pipeline, progress)
+        # 章ごとに変換したそばから EPUB に書き出す（HTML や画像を本全体ぶん持たない）
+        stats = {"images": images["stats"]}
+        rendered = self._epub_iter_rendered(md_text, spans, stats, progress)
+        stats["pack"] = self._epub_write_book(
+            md_path, out_epub_path, title, author, len(spans), rendered, progress, images
+        )
+        return stats
+
+    def _epub_log_stats(self, stats: dict):
+        self.log(
+            f"EPUB: 章 {stats['chapters']}件（変換 {stats['rendered']}件 / キャッシュ {stats['cached']}件"
+            + (" / 並列" if stats.get("parallel") else "") + "）"
+        )
+        img = stats["images"]
+        if img["images"]:
+            self.log(
+                f"EPUB: 画像 {img['images']}件 {format_bytes(img['source_bytes'])} → {format_bytes(img['bytes'])}"
+                + (f"（画質 {img['quality']} / 縮小 {img['scale']:.2f}倍）" if img["quality"] is not None else "")
+            )
+            if img["over_budget"]:
+                self.log("[WARN] 画像を縮小しても合計上限に収まりませんでした。")
+            if img["failed"]:
+                self.log(f"[WARN] 読み込めなかった画像 {img['failed']}件は入れていません。")
+        pack = stats["pack"]
+        self.log(f"EPUB: エントリ {pack['entries']}件（再利用 {pack['copied']}件 / 書き直し {pack['written']}件）")
+
+    def _epub_iter_rendered(self, md_text: str, spans: list, stats: dict, progress=None):
+        """章ごとに Markdown → HTML を順に返す。変換済みはキャッシュから読む。
+
+        キャッシュにない章が EPUB_RENDER_PARALLEL_MIN 件以上あるときは、スレッドプールで数章先まで
+        並行して変換する（返す順番は変わらない）。プロセスプールは使わない（Windows では子プロセスごとに
+        app.py と OCR のライブラリを読み込み直すため、起動の方がずっと重い）。
+        """
+        try:
+            cache = MarkdownRenderCache(EPUB_RENDER_CACHE_DIR)
+        except OSError:
+            cache = None
+        keys = [cache.key(md_text[a:b]) if cache else None for a, b in spans]
+        misses = [i for i, k in enumerate(keys) if k is None or k not in cache]
+        parallel = len(misses) >= EPUB_RENDER_PARALLEL_MIN
+        stats.update(chapters=len(spans), rendered=len(misses), cached=len(spans) - len(misses), parallel=parallel)
+        miss_set = set(misses)
+        done = 0
+
+        pool = None
+        futures = {}
+        pending = iter(misses)
+        if parallel:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=EPUB_RENDER_WORKERS, thread_name_prefix="epub")
+        try:
+            for i, (a, b) in enumerate(spans):
+                html = None
+                if pool is not None:
+                    # 先読みは数章まで（変換済みの HTML を本全体ぶん溜めない）
+                    while len(futures) < EPUB_RENDER_WORKERS * 2:
+                        j = next(pending, None)
+                        if j is None:
+                            break
+                        futures[j] = pool.submit(render_markdown_fragment, md_text[spans[j][0]:spans[j][1]])
+                if i in futures:
+                    html = futures.pop(i).result()
+                elif i not in miss_set:
+                    html = cache.get(keys[i])
+                if html is None:
+                    html = render_markdown_fragment(md_text[a:b])
+                if i in miss_set:
+                    done += 1
+                    if cache is not None:
+                        try:
+                            cache.put(keys[i], html)
+                        except OSError:
+                            pass
+                if progress is not None:
+                    progress.report(
+                        f"変換・書き出し中... {i + 1}/{len(spans)}（変換 {done}件）", done=i + 1, total=len(spans), unit="章"
+                    )
+                yield html
+        finally:
+            if pool is not None:
+                for f in futures.values():
+                    f.cancel()
+                pool.shutdown(wait=True)
+
+        if cache is not None and misses:
+            try:
+                cache.prune()
+            except OSError:
+                pass
 
-            # ---- 表紙設定（Tab1で保存した無加工 cover.png があれば利用） ----
+    def _epub_write_book(self, md_path, out_epub_path, title, author, n_chapters, rendered, progress=None, images=None):
+        """rendered（章ごとの HTML を順に返すもの）を1章ずつ EPUB に書き出す。
+
+        EpubBook には目次・OPF を作るための情報だけを残し、本文や画像の中身は持たない。
+        """
+        book = epub.EpubBook()
+        book.set_identifier(hashlib.md5((title + author).encode("utf-8")).hexdigest())
+        book.set_title(title)
+        book.add_author(author)
+        book.set_language("ja")
+
+        # 前回の出力と同じエントリ（表紙画像や変わっていない章）は圧縮済みデータを使い回す
+        with EpubPackWriter(out_epub_path, progress) as pack:
+            images = images or {"cover": None, "figures": [], "src_map": {}}
+            # ---- 表紙設定（Tab1で保存した cover.png を最適化したものがあれば利用） ----
             try:
-                cover_path = os.path.join(os.path.dirname(md_path), "cover.png")
-                if os.path.exists(cover_path):
-                    with open(cover_path, "rb") as f:
-                        book.set_cover("cover.png", f.read())
-                    self.log(f"表紙を設定しました: {cover_path}")
+                if images["cover"]:
+                    path, name, _ = images["cover"]
+                    pack.add_file(f"{book.FOLDER_NAME}/{name}", path)
+                    book.set_cover(name, b"")
+                    self.log(f"表紙を設定しました: {os.path.join(os.path.dirname(md_path), 'cover.png')}")
+            except TaskCancelled:
+                raise
             except Exception as e:
                 self.log(f"[WARN] 表紙設定に失敗しました: {e}")
 
-            c1 = epub.EpubHtml(title=title, file_name="content.xhtml", lang="ja")
-            c1.content = html
+            # 本文中の図版（中身は pack に直接書き、book には OPF に載せるための情報だけを入れる）
+            for n, (path, name, media_type) in enumerate(images["figures"], start=1):
+                pack.add_file(f"{book.FOLDER_NAME}/{name}", path)
+                book.add_item(epub.EpubImage(uid=f"img{n}", file_name=name, media_type=media_type, content=b""))
 
-            book.add_item(c1)
-            book.toc = (epub.Link("content.xhtml", title, "content"),)
-            book.spine = ["nav", c1]
+            # 章ごとに XHTML を作り、同じループで見出しを集めて入れ子の目次にする
+            items = []
+            toc_entries = []
+            for i, html in enumerate(rendered, start=1):
+                file_name = "content.xhtml" if n_chapters == 1 else f"chap_{i:04d}.xhtml"
+                html, headings = add_heading_ids(rewrite_img_src(html, images["src_map"]), f"c{i}")
+                if headings:
+                    chap_title = headings[0][1]
+                elif i == 1:
+                    chap_title = title
+                else:
+                    # 上限サイズで分けた続きの部分（目次には載せず、直前の章の続きとして扱う）
+                    chap_title = f"{items[-1].title}（続き）"
+                item = epub.EpubHtml(title=chap_title, file_name=file_name, lang="ja")
+                item.content = html
+                book.add_item(item)
+                pack.add(f"{book.FOLDER_NAME}/{file_name}", item.get_content())
+                item.content = "<p></p>"  # 書き出し済み（OPF・目次には名前とタイトルだけを使う）
+                items.append(item)
+
+                toc_heads = [h for h in headings if h[0] <= EPUB_TOC_DEPTH]
+                if (i == 1 and not toc_heads) or (toc_heads and toc_heads[0][0] > min(h[0] for h in toc_heads)):
+                    # 先頭の前書き部分や、章の頭が最上位の見出しでない場合は、ファイル自体を目次に載せる
+                    toc_entries.append((min([h[0] for h in toc_heads] or [1]), chap_title, file_name, f"c{i}"))
+                for level, text, hid in toc_heads:
+                    toc_entries.append((level, text or chap_title, f"{file_name}#{hid}", hid))
+
+            book.toc = self._epub_toc_items(build_toc_tree(toc_entries))
+            book.spine = ["nav"] + items
+            self.log(f"EPUB: XHTML {len(items)}ファイル / 目次 {len(toc_entries)}項目")
             book.add_item(epub.EpubNcx())
             book.add_item(epub.EpubNav())
 
-            epub.write_epub(out_epub_path, book)
-
-            self.lbl_epub_status.config(text="EPUB作成完了")
-            self.safe_showinfo("完了", f"EPUBを作成しました:\n{out_epub_path}")
-            self.log(f"EPUB作成: {out_epub_path}")
-
-        except Exception as e:
-            self.safe_showerror("エラー", str(e))
-            self.lbl_epub_status.config(text="EPUB作成失敗")
+            # OPF・nav・NCX は集めた情報から最後に書く
+            if progress is not None:
+                progress.report("目次を書き出し中...", force=True)
+            for name, data in epub_metadata_entries(book, pack):
+                pack.add(name, data)
+            return pack.close()
+
+    def _epub_prepare_images(self, md_path: str, md_text: str, pipeline, progress=None) -> dict:
+        """表紙（cover.png）と本文から参照されているローカル画像を最適化し、EPUB 内の名前を決める。"""
+        base_dir = os.path.dirname(md_path)
+        cover_path = os.path.join(base_dir, "cover.png")
+        sources = [(cover_path, "cover")] if os.path.exists(cover_path) else []
+        ref_paths = {}
+        for ref in markdown_image_refs(md_text):
+            path = local_image_path(ref, base_dir, confine=not self.EPUB_IMAGES_OUTSIDE_FOLDER)
+            if path is not None:
+                ref_paths[html_lib.unescape(ref).strip()] = path
+        fig_paths = list(dict.fromkeys(ref_paths.values()))
+        sources += [(p, "figure") for p in fig_paths]
+
+        if sources and progress is not None:
+            progress.report(f"画像を最適化中... 0/{len(sources)}", force=True)
+        results, stats = pipeline.run(sources, progress)
+
+        cover = None
+        if sources and sources[0][1] == "cover":
+            res = results.pop(0)
+            if res is not None:
+                cover = (res[0], "cover" + res[1], res[2])
+        figures = []
+        names = {}
+        for path, res in zip(fig_paths, results):
+            if res is None:
+                continue
+            # 名前は元画像のハッシュから付ける（図の追加・削除で他の図の名前がずれず、差分パッケージングが効く）
+            name = f"images/{res[3][:16]}{res[1]}"
+            if name not in names.values():
+                figures.append((res[0], name, res[2]))
+            names[path] = name
+        # 読み込めなかった図は None にしておき、本文の <img> を外す
+        src_map = {ref: names.get(path) for ref, path in ref_paths.items()}
+        return {"cover": cover, "figures": figures, "src_map": src_map, "stats": stats}
+
+    def _epub_split_chapters(self, md_text: str, mode, max_bytes: int, compiled=None, quiet: bool = False) -> list:
+        """Markdown を XHTML 単位の (開始, 終了) に分ける（mode は EPUB_SPLIT_LABELS の値）。"""
+        if mode == "split2":
+            # Tab2-2 と同じ本文構造ルールで章境界を求める（目次・索引は別ファイルになる）
+            plan = self._split2_build_plan("", None, md_text, compiled=compiled, quiet=quiet)
+            spans = split_markdown_spans(md_text, [int(it["start"]) for it in plan])
+        elif mode:
+            spans = split_markdown_spans(md_text, markdown_heading_offsets(md_text, mode))
+        else:
+            return [(0, len(md_text))]
+
+        capped = []
+        for a, b in spans:
+            capped.extend(cap_markdown_span(md_text, a, b, max_bytes))
+        return capped
+
+    def _epub_toc_items(self, nodes):
+        """build_toc_tree の結果を ebooklib の目次（Link / (Section, [...])）へ変換する。"""
+        out = []
+        for title, href, uid, children in nodes:
+            if children:
+                out.append((epub.Section(title, href=href), self._epub_toc_items(children)))
+            else:
+                out.append(epub.Link(href, title, uid))
+        return out
 
     # ==========================================
     # Tab 5: その他
@@ -2800,6 +6737,281 @@ class UnifiedYomitokuApp:
 
         ttk.Button(frm, text="Send to Kindle を開く", command=self.open_send_to_kindle).pack(anchor="w", pady=5)
         ttk.Button(frm, text="ログクリア", command=self.clear_log).pack(anchor="w", pady=5)
+        batch = ttk.Frame(frm)
+        batch.pack(anchor="w", fill="x", pady=5)
+        ttk.Label(batch, text="チャンクJSONLの形式:").pack(side="left")
+        self.chunk_batch_format_var = tk.StringVar(value=next(iter(CHUNK_BATCH_FORMATS)))
+        cb = ttk.Combobox(
+            batch, textvariable=self.chunk_batch_format_var, values=list(CHUNK_BATCH_FORMATS), state="readonly", width=34
+        )
+        cb.pack(side="left", padx=5)
+        cb.bind("<<ComboboxSelected>>", self._on_chunk_batch_format)
+        ttk.Label(batch, text="モデル:").pack(side="left")
+        self.chunk_batch_model_var = tk.StringVar(value=CHUNK_BATCH_DEFAULT_MODELS["openai"])
+        ttk.Entry(batch, textvariable=self.chunk_batch_model_var, width=24).pack(side="left", padx=5)
+        ttk.Button(
+            frm, text="チャンクJSONLの動作確認（そのまま返す結果を作成）", command=self.run_chunk_batch_stub
+        ).pack(anchor="w", pady=5)
+
+        wf = ttk.LabelFrame(frm, text="ワークフロー（Tab1〜4の設定で、入力が変わった段階だけ作り直す）")
+        wf.pack(fill="both", expand=True, pady=(10, 0))
+        row = ttk.Frame(wf)
+        row.pack(fill="x", padx=5, pady=5)
+        ttk.Label(row, text="作るもの:").pack(side="left")
+        self.workflow_target_var = tk.StringVar(value=next(iter(WORKFLOW_TARGET_LABELS)))
+        ttk.Combobox(
+            row, textvariable=self.workflow_target_var, values=list(WORKFLOW_TARGET_LABELS), state="readonly", width=22
+        ).pack(side="left", padx=5)
+        ttk.Button(row, text="確認（ドライラン）", command=self.run_workflow_plan).pack(side="left", padx=5)
+        ttk.Button(row, text="実行", command=self.run_workflow).pack(side="left")
+        ttk.Button(row, text="キャンセル", command=lambda: self.cancel_text_task(self.lbl_workflow_status)).pack(
+            side="left", padx=5
+        )
+        self.lbl_workflow_status = ttk.Label(row, text="")
+        self.lbl_workflow_status.pack(side="left", padx=10)
+
+        self.workflow_tree = ttk.Treeview(wf, columns=("stage", "verdict", "reason"), show="headings", height=6)
+        for col, text, width in (("stage", "段階", 110), ("verdict", "判定", 90), ("reason", "理由", 520)):
+            self.workflow_tree.heading(col, text=text)
+            self.workflow_tree.column(col, width=width, stretch=(col == "reason"))
+        self.workflow_tree.pack(fill="both", expand=True, padx=5, pady=(0, 5))
+
+        jf = ttk.LabelFrame(frm, text="ジョブ（全タブの実行中・待機中・終了した処理）")
+        jf.pack(fill="both", expand=True, pady=(10, 0))
+        row = ttk.Frame(jf)
+        row.pack(fill="x", padx=5, pady=5)
+        ttk.Button(row, text="選択したジョブをキャンセル", command=self.cancel_selected_jobs).pack(side="left")
+        ttk.Button(row, text="終了したジョブを消す", command=self.clear_finished_jobs).pack(side="left", padx=5)
+        self.jobs_tree = ttk.Treeview(
+            jf, columns=("id", "title", "state", "progress", "rate", "elapsed"), show="headings", height=6
+        )
+        for col, text, width in (
+            ("id", "#", 40), ("title", "処理", 140), ("state", "状態", 70),
+            ("progress", "進捗", 360), ("rate", "速度", 100), ("elapsed", "経過", 60),
+        ):
+            self.jobs_tree.heading(col, text=text)
+            self.jobs_tree.column(col, width=width, stretch=(col == "progress"))
+        self.jobs_tree.pack(fill="both", expand=True, padx=5, pady=(0, 5))
+        self._jobs_ticking = False
+        self.jobs.subscribe(self._jobs_on_event)
+
+    # ---- ワークフロー（入力が変わった段階だけ再実行） ----
+    def _workflow_stages(self) -> list:
+        """Tab1〜4 の今の設定からワークフローの段階を組み立てる（Tk の変数を読むので UI スレッドで呼ぶ）。
+
+        成果物はすべて Tab1 の出力先フォルダに置く:
+          output.md / cover.png → output.epub（下書き）と split_output_safe/<日時>/ → merged.md → <PDF名>.epub
+        """
+        pdf_path = self.pdf_path_var.get().strip()
+        out_dir = self.output_dir_var.get().strip()
+        if not out_dir:
+            raise ValueError("Tab1 の出力先フォルダを指定してください")
+        scope = os.path.abspath(out_dir)
+        stem = os.path.splitext(os.path.basename(pdf_path))[0] or "book"
+        md_path = os.path.join(scope, "output.md")
+        cover_path = os.path.join(scope, "cover.png")
+        draft_path = os.path.join(scope, "output.epub")
+        merged_path = os.path.join(scope, "merged.md")
+        book_path = os.path.join(scope, stem + ".epub")
+        split_root = os.path.join(scope, "split_output_safe")
+
+        compiled = self._split2_get_rules()
+        move_ruby = bool(self.split2_move_ruby_var.get())
+        title = self.epub_title_var.get()
+        author = self.epub_author_var.get()
+        mode = EPUB_SPLIT_LABELS.get(self.epub_split_var.get(), 1)
+        try:
+            max_bytes = max(0, int(self.epub_max_kb_var.get())) * 1024
+        except Exception:
+            max_bytes = EPUB_DEFAULT_MAX_KB * 1024
+        epub_compiled = compiled if mode == "split2" else None
+        images = [self.epub_image_format_var.get(), self.epub_image_quality_var.get(), self.epub_image_budget_var.get()]
+        # 下書きと仕上げの EPUB は同時に動くことがあるので、画像の変換器は別々に持つ
+        draft_images = self._epub_image_pipeline_from_ui()
+        book_images = self._epub_image_pipeline_from_ui()
+
+        def _ocr(progress, upstream):
+            self.root.after(0, lambda: self.btn_run_ocr.config(state="disabled"))
+            # 下書きEPUBは別の段階で作る（分割と同時に進められる）。Tab1 の OCR が実行中なら process_ocr が断る
+            if not self.process_ocr(stream_epub=False, notify=False, progress=progress):
+                if progress.cancel_event.is_set():
+                    raise TaskCancelled()
+                raise RuntimeError("OCR に失敗しました（詳細はログを参照）")
+            return [p for p in (md_path, cover_path) if os.path.exists(p)]
+
+        def _read_md(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return "".join(iter(lambda: f.read(1024 * 1024), ""))
+
+        def _draft(progress, upstream):
+            stats = self._epub_build(
+                md_path, _read_md(md_path), draft_path, stem, author, "split2", EPUB_DEFAULT_MAX_KB * 1024,
+                compiled, draft_images, progress,
+            )
+            self._epub_log_stats(stats)
+
+        def _split(progress, upstream):
+            output_dir = os.path.join(split_root, time.strftime("%Y%m%d_%H%M%S"))
+            res = self._split2_execute(md_path, output_dir, split_root, compiled, move_ruby, False, None, progress)
+            if not res["ok"]:
+                raise RuntimeError(f"分割の検証NG: 再構成が一致しません\n{output_dir}")
+            return [output_dir]
+
+        def _merge(progress, upstream):
+            folder = upstream["split"][0]
+            found = self._merge_collect_chunk_files(folder)
+            if found["missing"]:
+                raise FileNotFoundError("見つからないチャンクがあります: " + ", ".join(found["missing"][:10]))
+            self._merge_stream_files(found["files"], merged_path, progress)
+
+        def _book(progress, upstream):
+            stats = self._epub_build(
+                merged_path, _read_md(merged_path), book_path, title, author, mode, max_bytes, epub_compiled,
+                book_images, progress,
+            )
+            self._epub_log_stats(stats)
+
+        rules = compiled["rules"]
+        return [
+            WorkflowStage(
+                "ocr", "OCR", _ocr, f"ocr|{scope}", inputs=[pdf_path], outputs=[md_path],
+                params={"pages": [self.page_start_var.get(), self.page_end_var.get()],
+                        "crop": [self.top_crop_var.get(), self.bottom_crop_var.get()]},
+            ),
+            WorkflowStage(
+                "draft", "下書きEPUB", _draft, f"draft|{scope}", deps=["ocr"], outputs=[draft_path],
+                params={"rules": rules, "images": images, "author": author},
+            ),
+            WorkflowStage(
+                "split", "分割", _split, f"split|{scope}", deps=["ocr"],
+                params={"rules": rules, "move_ruby": move_ruby},
+            ),
+            WorkflowStage("merge", "結合", _merge, f"merge|{scope}", deps=["split"], outputs=[merged_path]),
+            WorkflowStage(
+                "book", "EPUB", _book, f"book|{scope}", deps=["merge"], inputs=[cover_path], outputs=[book_path],
+                params={"title": title, "author": author, "mode": mode, "max_bytes": max_bytes,
+                        "rules": rules if epub_compiled else None, "images": images},
+            ),
+        ]
+
+    def _workflow_runner(self):
+        try:
+            stages = self._workflow_stages()
+        except Exception as e:
+            self.safe_showerror("エラー", str(e))
+            return None
+        return WorkflowRunner(stages, ArtifactStore(), log=self.log)
+
+    def _workflow_show_rows(self, rows):
+        self.workflow_tree.delete(*self.workflow_tree.get_children())
+        for stage, verdict, reason in rows:
+            self.workflow_tree.insert("", "end", iid=stage.name, values=(stage.label, verdict, reason))
+
+    def run_workflow_plan(self):
+        runner = self._workflow_runner()
+        if runner is None:
+            return
+        target = WORKFLOW_TARGET_LABELS.get(self.workflow_target_var.get())
+        status = self.lbl_workflow_status
+
+        def _work(progress):
+            progress.report("成果物を確認中...", force=True)
+            return runner.plan(target)
+
+        def _done(rows):
+            self._workflow_show_rows(rows)
+            n = sum(1 for _, verdict, _ in rows if verdict != WORKFLOW_FRESH)
+            status.config(text=f"再実行候補 {n}件 / {len(rows)}段階", foreground="gray")
+
+        self._start_text_task("ワークフローの確認", _work, _done, status)
+
+    def run_workflow(self):
+        runner = self._workflow_runner()
+        if runner is None:
+            return
+        target = WORKFLOW_TARGET_LABELS.get(self.workflow_target_var.get())
+        status = self.lbl_workflow_status
+        self._workflow_show_rows([(runner.stages[n], "待機", "") for n in runner.closure(target)])
+
+        def _on_stage(stage, verdict, reason):
+            self.root.after(0, lambda: self.workflow_tree.item(stage.name, values=(stage.label, verdict, reason)))
+
+        def _done(rows):
+            self._workflow_show_rows(rows)
+            n = sum(1 for _, verdict, _ in rows if verdict != WORKFLOW_FRESH)
+            status.config(text=f"完了（実行 {n}件 / 省略 {len(rows) - n}件）", foreground="gray")
+            self.log(f"ワークフロー完了: 実行 {n}件 / 省略 {len(rows) - n}件")
+
+        # OCR 段階はこのジョブの cancel_event をページごとに見て止まる（Tab1 の OCR には効かない）
+        self._start_text_task(
+            "ワークフロー実行", lambda progress: runner.run(target, progress, _on_stage), _done, status,
+        )
+
+    # ---- ジョブ一覧 ----
+    @staticmethod
+    def _jobs_row(job) -> tuple:
+        text = job.text
+        if job.total:
+            text = f"{job.done / job.total:.0%}  {text}"
+        rate = job.rate() if job.state == JOB_RUNNING else None
+        if rate is None:
+            rate_text = ""
+        elif job.unit == "bytes":
+            rate_text = f"{format_bytes(rate)}/s"
+        else:
+            rate_text = f"{rate:.1f} {job.unit}/s"
+        t = int(job.elapsed())
+        return (job.id, job.title, job.state, text, rate_text, f"{t // 60}:{t % 60:02d}" if job.started else "")
+
+    def _jobs_on_event(self, ev):
+        iid = str(ev.job.id)
+        if self.jobs_tree.exists(iid):
+            self.jobs_tree.item(iid, values=self._jobs_row(ev.job))
+        else:
+            # 一覧から外れた古い終了済みジョブの行も消す
+            keep = {str(j.id) for j in self.jobs.jobs()}
+            self.jobs_tree.delete(*[i for i in self.jobs_tree.get_children() if i not in keep])
+            self.jobs_tree.insert("", "end", iid=iid, values=self._jobs_row(ev.job))
+        if ev.kind == "state" and not self._jobs_ticking:
+            self._jobs_ticking = True
+            self.root.after(1000, self._jobs_tick)
+
+    def _jobs_tick(self):
+        """実行中のジョブがある間、経過時間と速度を1秒ごとに更新する。"""
+        active = [j for j in self.jobs.jobs() if j.active]
+        for job in active:
+            if self.jobs_tree.exists(str(job.id)):
+                self.jobs_tree.item(str(job.id), values=self._jobs_row(job))
+        if active:
+            self.root.after(1000, self._jobs_tick)
+        else:
+            self._jobs_ticking = False
+
+    def cancel_selected_jobs(self):
+        ids = {int(iid) for iid in self.jobs_tree.selection()}
+        for job in self.jobs.jobs():
+            if job.id in ids:
+                self.jobs.cancel(job)
+
+    def clear_finished_jobs(self):
+        self.jobs.clear_finished()
+        keep = {str(j.id) for j in self.jobs.jobs()}
+        self.jobs_tree.delete(*[iid for iid in self.jobs_tree.get_children() if iid not in keep])
+
+    def run_chunk_batch_stub(self):
+        batch_path = filedialog.askopenfilename(
+            title="書き出したチャンクJSONL", filetypes=[("JSONL", "*.jsonl"), ("All files", "*.*")]
+        )
+        if not batch_path:
+            return
+        out_path = os.path.splitext(batch_path)[0] + ".results.jsonl"
+        try:
+            n = run_local_batch_stub(batch_path, out_path)
+        except Exception as e:
+            self.safe_showerror("エラー", str(e))
+            return
+        self.log(f"動作確認用の校正結果: {out_path}（{n}件）")
+        self.safe_showinfo("完了", f"{n}件の結果を作成しました。\n{out_path}")
 
     def open_send_to_kindle(self):
         webbrowser.open("https://www.amazon.co.jp/sendtokindle")
@@ -2813,11 +7025,973 @@ class UnifiedYomitokuApp:
             pass
 
 
+# ==========================================
+# サービスモード（python app.py --serve）：画面なしで OCR・分割・EPUB のジョブを HTTP で受け付ける
+# ==========================================
+SERVICE_DEFAULT_PORT = 8765
+SERVICE_ROOT_DIR = os.path.join(APP_DATA_DIR, "service")
+SERVICE_MAX_JOBS = 8  # 待機中＋実行中のジョブ数の上限（超えたら 503 で断る）
+SERVICE_MAX_UPLOAD = 1024 * 1024 * 1024  # 受け付ける PDF / Markdown の上限
+SERVICE_HISTORY = 200  # 一覧に残す終了済みジョブの数
+SERVICE_EVENT_BACKLOG = 500  # 1ジョブあたり保持するイベント数（SSE の途中参加・再接続用）
+SERVICE_KEEPALIVE_SEC = 15
+SERVICE_EPUB_SPLITS = {"0": 0, "1": 1, "2": 2, "3": 3, "split2": "split2"}
+
+# 監視フォルダ（--watch）
+WATCH_INDEX_FILE = ".yomitoku_watch_index.json"  # 処理済み PDF の一覧（サイズ・更新時刻・状態）
+WATCH_SETTINGS_FILE = "yomitoku_watch.json"  # フォルダごとの既定値（ページ範囲・トリミングなど）
+WATCH_STATUS_FILE = "status.json"  # 出力フォルダに置く処理状況
+WATCH_SETTING_KEYS = ("start", "end", "top", "bottom", "epub", "author")
+WATCH_POLL_SEC = 5.0
+WATCH_STABLE_SEC = 10.0  # サイズ・更新時刻がこの秒数変わらなければ書き込み完了とみなす
+WATCH_RESCAN_SEC = 300.0  # inotify を使っていても、この間隔でフォルダ全体を見直す（取りこぼし対策）
+WATCH_DEBOUNCE_SEC = 1.0  # 変化の通知が続く間はまとめて待つ
+
+
+class _Value:
+    """Tk の変数の代わり（サービスモードで、タブの設定を読む処理をそのまま使うため）。"""
+
+    def __init__(self, value=None):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+
+class _NullWidget:
+    def config(self, **kwargs):
+        pass
+
+
+class _ImmediateRoot:
+    """root.after(ms, fn) をその場で呼ぶ（サービスモードには Tk のイベントループがない）。"""
+
+    def after(self, ms, fn):
+        fn()
+
+
+class _StubResults:
+    def __init__(self, text: str):
+        self.text = text
+
+    def to_markdown(self, path, img=None):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.text)
+
+
+class StubDocumentAnalyzer:
+    """動作確認用の DocumentAnalyzer の代わり（--stub-analyzer）。ページ番号と画像の大きさだけを本文にする。"""
+
+    def __init__(self):
+        self.pages = 0
+
+    def __call__(self, img):
+        self.pages += 1
+        h, w = img.shape[:2] if hasattr(img, "shape") else img.size[::-1]
+        return _StubResults(f"スタブ本文 {self.pages}ページ目（{w}x{h}）\n")
+
+
+class ServiceError(Exception):
+    """HTTP の状態コードつきで要求を断る。"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class OcrJobService(UnifiedYomitokuApp):
+    """画面を作らずに、タブと同じ処理（OCR・安全分割・EPUB作成）をジョブとして実行する。
+
+    OCR は読み込んだ DocumentAnalyzer を使い回すため1本ずつ（ocr_jobs）、分割と EPUB は別の
+    プールで同時に動かす（jobs）。各ジョブの入出力は root_dir/<ID>/ に置く。
+    """
+
+    # 送られた Markdown の画像参照で、ジョブのフォルダの外にあるサーバー上のファイルを読ませない
+    EPUB_IMAGES_OUTSIDE_FOLDER = False
+
+    def __init__(self, root_dir: str, poppler_path: str, analyzer=None, max_jobs: int = SERVICE_MAX_JOBS):
+        self.root = _ImmediateRoot()
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self.device = "cuda" if (torch and torch.cuda.is_available()) else "cpu"
+        self.analyzer = analyzer
+        self.ocr_lock = threading.Lock()
+        self.max_jobs = max_jobs
+        self._split2_compiled_rules = {}
+        self.jobs = JobManager(lambda fn: fn(), max_workers=2)
+        self.ocr_jobs = JobManager(lambda fn: fn(), max_workers=1)
+        self._changed = threading.Condition()
+        self._records = {}  # ID -> ジョブの記録（登録順）
+        self._next_seq = 1
+        self._tls = threading.local()
+
+        # process_ocr などが読むタブの設定（OCR は1本ずつなので、ジョブごとに書き換えて使う）
+        self.pdf_path_var = _Value("")
+        self.poppler_path_var = _Value(poppler_path)
+        self.output_dir_var = _Value("")
+        self.page_start_var = _Value(1)
+        self.page_end_var = _Value(9999)
+        self.top_crop_var = _Value(0.0)
+        self.bottom_crop_var = _Value(100.0)
+        self.ocr_stream_epub_var = _Value(False)
+        self.ocr_epub_checkpoint_var = _Value(0)
+        self.epub_author_var = _Value("")
+        self.split2_rules_var = _Value(SPLIT2_DEFAULT_RULESET)
+        self.epub_image_format_var = _Value(next(iter(EPUB_IMAGE_FORMATS)))
+        self.epub_image_quality_var = _Value(EPUB_IMAGE_DEFAULT_QUALITY)
+        self.epub_image_budget_var = _Value(EPUB_IMAGE_DEFAULT_BUDGET_MB)
+        self.progress_var = _Value(0.0)
+        self.btn_run_ocr = _NullWidget()
+        self.lbl_status = _NullWidget()
+
+    # ---- 画面の代わり ----
+    def log(self, message):
+        rec = getattr(self._tls, "record", None)
+        if rec is not None:
+            with self._changed:
+                rec["log"].append(message)
+                del rec["log"][:-MAX_LOG_LINES]
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+
+    def safe_showinfo(self, title, message):
+        self.log(f"{title}: {message}")
+
+    def safe_showerror(self, title, message):
+        self.log(f"[ERROR] {title}: {message}")
+
+    def warm_up(self):
+        """DocumentAnalyzer を先に読み込んでおく（最初の OCR ジョブを待たせない）。"""
+        if self.analyzer is not None:
+            return
+        self.log(f"AIモデルロード中 ({self.device})...")
+        try:
+            self.analyzer = DocumentAnalyzer(device=self.device)
+        except RuntimeError:
+            if self.device != "cuda":
+                raise
+            self.log("CUDAで読み込めないためCPUで再試行します。")
+            self.device = "cpu"
+            self.analyzer = DocumentAnalyzer(device=self.device)
+
+    def shutdown(self):
+        self.ocr_jobs.shutdown()
+        self.jobs.shutdown()
+
+    # ---- ジョブ ----
+    def submit(self, kind: str, params: dict, body=None, length: int = 0) -> dict:
+        """ジョブを受け付ける。body（PDF / Markdown）は length バイトだけ読んでジョブのフォルダに保存する。"""
+        if kind not in ("ocr", "split", "epub"):
+            raise ServiceError(404, f"unknown job type: {kind}")
+        if length > SERVICE_MAX_UPLOAD:
+            raise ServiceError(413, f"too large: {length} bytes (max {SERVICE_MAX_UPLOAD})")
+        rec = self._register(kind, params)
+        try:
+            work = getattr(self, f"_service_{kind}")(rec, params, body, length)
+        except Exception:
+            self._unregister(rec)
+            raise
+        return self._start(rec, work)
+
+    def submit_pdf(self, pdf_path: str, out_dir: str, params: dict, on_change=None) -> dict:
+        """手元の PDF を OCR するジョブ（監視フォルダ用）。出力は out_dir に置く。
+
+        on_change(status) はジョブの状態が変わるたびに（終わったときは結果を記録してから）呼ばれる。
+        """
+        rec = self._register("ocr", params, out_dir, on_change)
+        try:
+            work = self._ocr_work(rec, pdf_path, params)
+        except Exception:
+            self._unregister(rec)
+            raise
+        return self._start(rec, work)
+
+    def _register(self, kind: str, params: dict, out_dir=None, on_change=None) -> dict:
+        with self._changed:
+            active = sum(1 for r in self._records.values() if r["job"] is None or r["job"].active)
+            if active >= self.max_jobs:
+                raise ServiceError(503, f"busy: {active} jobs queued or running")
+            job_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{self._next_seq:04d}"
+            self._next_seq += 1
+            rec = {
+                "id": job_id, "type": kind, "params": params, "dir": out_dir or os.path.join(self.root_dir, job_id),
+                "owned": out_dir is None, "on_change": on_change,
+                "job": None, "error": None, "result": None, "log": [], "events": [], "seq": 0,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._records[job_id] = rec  # アップロード中も上限に数える
+        os.makedirs(rec["dir"], exist_ok=True)
+        return rec
+
+    def _unregister(self, rec: dict):
+        with self._changed:
+            self._records.pop(rec["id"], None)
+        if rec["owned"]:
+            shutil.rmtree(rec["dir"], ignore_errors=True)
+
+    def _start(self, rec: dict, work) -> dict:
+        def _run(progress):
+            self._tls.record = rec
+            try:
+                return work(progress)
+            finally:
+                self._tls.record = None
+
+        def _done(result):
+            rec["result"] = result
+            self._notify(rec)
+
+        def _error(e):
+            rec["error"] = str(e)
+            self.log(f"[ERROR] {rec['id']}: {e}")
+            self._notify(rec)
+
+        kind = rec["type"]
+        manager = self.ocr_jobs if kind == "ocr" else self.jobs
+        with self._changed:
+            rec["job"] = manager.submit(f"{kind} {rec['id']}", _run, _done, _error, lambda ev: self._on_event(rec, ev))
+            finished = [r for r in self._records.values() if r["job"] is not None and not r["job"].active]
+            for old in finished[: max(0, len(finished) - SERVICE_HISTORY)]:
+                del self._records[old["id"]]
+        return self.status(rec["id"])
+
+    def _notify(self, rec: dict):
+        if rec["on_change"] is not None and rec["job"] is not None:
+            try:
+                rec["on_change"](self.status(rec["id"]))
+            except Exception as e:
+                self.log(f"[WARN] {rec['id']}: 状態の記録に失敗しました: {e}")
+
+    def _save_body(self, rec: dict, name: str, body, length: int) -> str:
+        path = os.path.join(rec["dir"], name)
+        left = length
+        with open(path, "wb") as f:
+            while left > 0:
+                block = body.read(min(left, 1024 * 1024))
+                if not block:
+                    raise ServiceError(400, "request body ended early")
+                f.write(block)
+                left -= len(block)
+        return path
+
+    def _service_source_md(self, rec: dict, params: dict, body, length: int) -> str:
+        """分割・EPUB の入力 Markdown。from=<ID> なら、その OCR ジョブの output.md を使う。"""
+        src_id = params.get("from")
+        if src_id:
+            with self._changed:
+                src = self._records.get(src_id)
+            if src is None:
+                raise ServiceError(404, f"unknown job: {src_id}")
+            if src["job"] is None or src["job"].state != JOB_DONE:
+                raise ServiceError(409, f"job {src_id} is not done")
+            md_path = os.path.join(src["dir"], "output.md")
+            if not os.path.isfile(md_path):
+                raise ServiceError(409, f"job {src_id} has no output.md")
+            return md_path
+        if length <= 0:
+            raise ServiceError(400, "send Markdown in the body or from=<job id>")
+        return self._save_body(rec, "input.md", body, length)
+
+    def _service_ocr(self, rec: dict, params: dict, body, length: int):
+        if length <= 0:
+            raise ServiceError(400, "send the PDF in the request body")
+        return self._ocr_work(rec, self._save_body(rec, "input.pdf", body, length), params)
+
+    def _ocr_work(self, rec: dict, pdf_path: str, params: dict):
+        try:
+            pages = (int(params.get("start", 1)), int(params.get("end", 9999)))
+            crop = (float(params.get("top", 0.0)), float(params.get("bottom", 100.0)))
+        except ValueError as e:
+            raise ServiceError(400, f"bad parameter: {e}")
+        stream_epub = params.get("epub") == "1"
+        author = params.get("author", "")
+
+        def _work(progress):
+            self.pdf_path_var.set(pdf_path)
+            self.output_dir_var.set(rec["dir"])
+            self.page_start_var.set(pages[0])
+            self.page_end_var.set(pages[1])
+            self.top_crop_var.set(crop[0])
+            self.bottom_crop_var.set(crop[1])
+            self.epub_author_var.set(author)
+            ok = self.process_ocr(stream_epub=stream_epub, notify=False, progress=progress)
+            if progress.cancel_event.is_set():
+                raise TaskCancelled()
+            if not ok:
+                raise RuntimeError("OCR に失敗しました（ジョブのログを参照）")
+
+        return _work
+
+    def _service_split(self, rec: dict, params: dict, body, length: int):
+        rules = params.get("rules", SPLIT2_DEFAULT_RULESET)
+        if rules not in SPLIT2_STRUCTURE_RULESETS:
+            raise ServiceError(400, f"unknown rules: {rules}")
+        compiled = self._split2_get_rules(rules)
+        move_ruby = params.get("ruby", "1") == "1"
+        md_path = self._service_source_md(rec, params, body, length)
+        split_root = os.path.join(rec["dir"], "split")
+
+        def _work(progress):
+            output_dir = os.path.join(split_root, time.strftime("%Y%m%d_%H%M%S"))
+            res = self._split2_execute(md_path, output_dir, split_root, compiled, move_ruby, False, None, progress)
+            if not res["ok"]:
+                raise RuntimeError("分割の検証NG: 再構成が一致しません")
+            return {"chunks": len(res["ctx"]["plan"]), "chars": res["total_length"]}
+
+        return _work
+
+    def _service_epub(self, rec: dict, params: dict, body, length: int):
+        mode = SERVICE_EPUB_SPLITS.get(params.get("split", "1"))
+        if mode is None:
+            raise ServiceError(400, f"split must be one of {', '.join(SERVICE_EPUB_SPLITS)}")
+        image_format = params.get("images", next(iter(EPUB_IMAGE_FORMATS)))
+        if image_format not in EPUB_IMAGE_FORMATS:
+            raise ServiceError(400, f"images must be one of {', '.join(EPUB_IMAGE_FORMATS)}")
+        try:
+            max_bytes = max(0, int(params.get("max_kb", EPUB_DEFAULT_MAX_KB))) * 1024
+            quality = int(params.get("quality", EPUB_IMAGE_DEFAULT_QUALITY))
+            budget = max(0, int(params.get("budget_mb", EPUB_IMAGE_DEFAULT_BUDGET_MB))) * 1024 * 1024
+        except ValueError as e:
+            raise ServiceError(400, f"bad parameter: {e}")
+        title = params.get("title", "EPUB Title")
+        author = params.get("author", "")
+        compiled = self._split2_get_rules(params.get("rules")) if mode == "split2" else None
+        md_path = self._service_source_md(rec, params, body, length)
+        out_path = os.path.join(rec["dir"], "book.epub")
+
+        def _work(progress):
+            with open(md_path, "r", encoding="utf-8") as f:
+                md_text = "".join(iter(lambda: f.read(1024 * 1024), ""))
+            stats = self._epub_build(
+                md_path, md_text, out_path, title, author, mode, max_bytes, compiled,
+                EpubImagePipeline(image_format, quality, budget), progress,
+            )
+            self._epub_log_stats(stats)
+            return {"chapters": stats["chapters"], "images": stats["images"]["images"]}
+
+        return _work
+
+    def _on_event(self, rec: dict, ev):
+        with self._changed:
+            rec["seq"] += 1
+            rec["events"].append((rec["seq"], {
+                "kind": ev.kind, "state": ev.state, "text": ev.text, "done": ev.done, "total": ev.total, "unit": ev.unit,
+            }))
+            del rec["events"][:-SERVICE_EVENT_BACKLOG]
+            self._changed.notify_all()
+        if ev.kind == "state" and ev.state not in (JOB_DONE, JOB_FAILED):
+            # 完了・失敗は結果を記録してから _done / _error で知らせる
+            self._notify(rec)
+
+    def cancel(self, job_id: str) -> dict:
+        rec = self._record(job_id)
+        manager = self.ocr_jobs if rec["type"] == "ocr" else self.jobs
+        if rec["job"] is not None:
+            manager.cancel(rec["job"])
+        return self.status(job_id)
+
+    def _record(self, job_id: str) -> dict:
+        with self._changed:
+            rec = self._records.get(job_id)
+        if rec is None or rec["job"] is None:
+            raise ServiceError(404, f"unknown job: {job_id}")
+        return rec
+
+    def status(self, job_id: str) -> dict:
+        rec = self._record(job_id)
+        job = rec["job"]
+        rate = job.rate()
+        files = []
+        if not job.active:
+            for root, dirs, names in os.walk(rec["dir"]):
+                dirs.sort()
+                for name in sorted(names):
+                    files.append(os.path.relpath(os.path.join(root, name), rec["dir"]).replace(os.sep, "/"))
+        return {
+            "id": rec["id"], "type": rec["type"], "created": rec["created"], "state": job.state,
+            "text": job.text, "done": job.done, "total": job.total, "unit": job.unit,
+            "elapsed": round(job.elapsed(), 2), "rate": None if rate is None else round(rate, 2),
+            "error": rec["error"], "result": rec["result"], "files": files,
+        }
+
+    def list_jobs(self) -> list:
+        with self._changed:
+            ids = [r["id"] for r in self._records.values() if r["job"] is not None]
+        return [self.status(i) for i in ids]
+
+    def health(self) -> dict:
+        with self._changed:
+            jobs = [r["job"] for r in self._records.values() if r["job"] is not None]
+        return {
+            "analyzer": self.analyzer is not None, "device": self.device, "max_jobs": self.max_jobs,
+            "queued": sum(1 for j in jobs if j.state == JOB_QUEUED),
+            "running": sum(1 for j in jobs if j.state == JOB_RUNNING),
+        }
+
+    def events(self, job_id: str, after: int = 0):
+        """(seq, イベント) を順に返すイテレータ。ジョブが終わって残りを出し切ったら止まる。
+
+        しばらくイベントがなければ None を返す（keepalive 用）。不明な ID はここで ServiceError。
+        """
+        return self._iter_events(self._record(job_id), after)
+
+    def _iter_events(self, rec: dict, after: int):
+        while True:
+            with self._changed:
+                batch = [e for e in rec["events"] if e[0] > after]
+                if not batch and rec["job"].active:
+                    self._changed.wait(SERVICE_KEEPALIVE_SEC)
+                    batch = [e for e in rec["events"] if e[0] > after]
+                finished = not rec["job"].active
+            if not batch:
+                if finished:
+                    return
+                yield None
+                continue
+            for seq, event in batch:
+                after = seq
+                yield seq, event
+
+    def file_path(self, job_id: str, rel: str) -> str:
+        rec = self._record(job_id)
+        base = os.path.realpath(rec["dir"])
+        path = os.path.realpath(os.path.join(base, *[p for p in rel.split("/") if p]))
+        if not path.startswith(base + os.sep) or not os.path.isfile(path):
+            raise ServiceError(404, f"no such file: {rel}")
+        return path
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """REST API:
+      POST   /jobs/ocr?start=&end=&top=&bottom=&epub=1   本文は PDF
+      POST   /jobs/split?rules=&ruby=0|1[&from=<ID>]      本文は Markdown（from で OCR ジョブの output.md）
+      POST   /jobs/epub?title=&author=&split=&images=[&from=<ID>]
+      GET    /jobs  /jobs/<ID>  /jobs/<ID>/events（SSE）  /jobs/<ID>/files/<パス>  /health
+      DELETE /jobs/<ID>                                   キャンセル
+    """
+
+    service = None
+    token = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        print(f"[{time.strftime('%H:%M:%S')}] {self.address_string()} {fmt % args}", file=sys.stderr, flush=True)
+
+    def _send_json(self, status: int, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method: str):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            if self.token is not None:
+                auth = self.headers.get("Authorization", "")
+                # http.server はヘッダーを ISO-8859-1 で読むので、送られてきたバイト列に戻して比べる
+                if not hmac.compare_digest(auth.encode("latin-1"), f"Bearer {self.token}".encode("utf-8")):
+                    raise ServiceError(401, "unauthorized")
+            svc = self.service
+            if method == "GET" and parts == ["health"]:
+                return self._send_json(200, svc.health())
+            if not parts or parts[0] != "jobs":
+                raise ServiceError(404, "not found")
+            if method == "POST" and len(parts) == 2:
+                return self._send_json(202, svc.submit(parts[1], params, self.rfile, length))
+            if method == "GET" and len(parts) == 1:
+                return self._send_json(200, svc.list_jobs())
+            if method == "GET" and len(parts) == 2:
+                return self._send_json(200, svc.status(parts[1]))
+            if method == "DELETE" and len(parts) == 2:
+                return self._send_json(200, svc.cancel(parts[1]))
+            if method == "GET" and len(parts) == 3 and parts[2] == "events":
+                return self._send_events(parts[1], int(self.headers.get("Last-Event-ID") or params.get("after", 0)))
+            if method == "GET" and len(parts) >= 4 and parts[2] == "files":
+                return self._send_file(svc.file_path(parts[1], "/".join(parts[3:])))
+            raise ServiceError(404, "not found")
+        except ServiceError as e:
+            if method == "POST":
+                # 読まなかった本文が残っているかもしれないので、この接続は閉じる
+                self.close_connection = True
+            headers = {"Retry-After": "30"} if e.status == 503 else None
+            self._send_json(e.status, {"error": str(e)}, headers)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+
+    def _send_events(self, job_id: str, after: int):
+        events = self.service.events(job_id, after)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for item in events:
+                if item is None:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    seq, event = item
+                    data = json.dumps(event, ensure_ascii=False)
+                    self.wfile.write(f"id: {seq}\nevent: {event['kind']}\ndata: {data}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            status = json.dumps(self.service.status(job_id), ensure_ascii=False)
+            self.wfile.write(f"event: end\ndata: {status}\n\n".encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_file(self, path: str):
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+def make_service_server(service: OcrJobService, host: str = "127.0.0.1", port: int = SERVICE_DEFAULT_PORT, token=None):
+    """サービスの HTTP サーバーを作る（serve_forever() は呼び出し側で。port=0 なら空いている番号）。"""
+    handler = type("ServiceHandler", (_ServiceHandler,), {"service": service, "token": token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class _InotifyWaker:
+    """inotify（Linux）でフォルダへの書き込み完了・移動を待つ。使えない環境では available=False（呼び出し側はポーリング）。"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, folders):
+        self.fd = -1
+        self._folders = {}
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for folder in folders:
+            wd = libc.inotify_add_watch(fd, os.fsencode(folder), mask)
+            if wd < 0:
+                # 1つでも見張れないフォルダがあれば、すべてポーリングにする
+                os.close(fd)
+                self._folders = {}
+                return
+            self._folders[wd] = folder
+        self.fd = fd
+
+    @property
+    def available(self) -> bool:
+        return self.fd >= 0
+
+    def wait(self, timeout: float) -> dict:
+        """変化のあったフォルダ → ファイル名の集合（None はフォルダ全体を見直す）。timeout 秒で空の dict。"""
+        if self.fd < 0:
+            time.sleep(timeout)
+            return {}
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return {}
+        changed = {}
+        deadline = time.monotonic() + WATCH_DEBOUNCE_SEC
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                data = b""
+            pos = 0
+            while pos + self._EVENT.size <= len(data):
+                wd, mask, _cookie, length = self._EVENT.unpack_from(data, pos)
+                name = data[pos + self._EVENT.size:pos + self._EVENT.size + length].rstrip(b"\0")
+                pos += self._EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.update((f, None) for f in self._folders.values())
+                    continue
+                folder = self._folders.get(wd)
+                if folder is not None and name and changed.get(folder, set()) is not None:
+                    changed.setdefault(folder, set()).add(os.fsdecode(name))
+            rest = deadline - time.monotonic()
+            if rest <= 0 or not select.select([self.fd], [], [], rest)[0]:
+                return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class WatchFolderIngest:
+    """監視フォルダに置かれた PDF を、書き込みが終わるのを待ってから自動で OCR する。
+
+    結果は PDF と同じ場所の <名前>_out/ に output.md・cover.png・status.json として置く（Tab1 の既定の出力先と同じ）。
+    処理済みの PDF はフォルダごとの一覧（WATCH_INDEX_FILE）にサイズと更新時刻を記録し、変わらない限り処理し直さない。
+    """
+
+    def __init__(self, service: OcrJobService, folders, defaults=None, poll_sec=WATCH_POLL_SEC, stable_sec=WATCH_STABLE_SEC):
+        self.service = service
+        self.folders = [os.path.abspath(f) for f in folders]
+        self.defaults = dict(defaults or {})
+        self.poll_sec = poll_sec
+        self.stable_sec = stable_sec
+        self._lock = threading.Lock()
+        self._index = {f: self._load_index(f) for f in self.folders}
+        self._settings = {}  # folder -> (設定ファイルの更新時刻, 内容)
+        self._dir_mtime = {}
+        self._last_scan = {}
+        self._pending = {}  # path -> (size, mtime_ns, 最後に変化を見た時刻)
+        self._stop = threading.Event()
+        self._thread = None
+        self.waker = None
+
+    # ---- 処理済み一覧 ----
+    def _load_index(self, folder: str) -> dict:
+        try:
+            with open(os.path.join(folder, WATCH_INDEX_FILE), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(index, dict):
+            return {}
+        # 前回の終了時に待機中・実行中だったものは、もう一度処理する
+        return {
+            name: e for name, e in index.items()
+            if isinstance(e, dict) and e.get("state") not in (JOB_QUEUED, JOB_RUNNING)
+        }
+
+    def _save_index(self, folder: str):
+        path = os.path.join(folder, WATCH_INDEX_FILE)
+        with self._lock:
+            data = json.dumps(self._index[folder], ensure_ascii=False, indent=1)
+        self._write_atomic(path, data)
+
+    @staticmethod
+    def _write_atomic(path: str, text: str):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    # ---- フォルダごとの既定値 ----
+    def _params(self, folder: str) -> dict:
+        path = os.path.join(folder, WATCH_SETTINGS_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        cached = self._settings.get(folder)
+        if cached is None or cached[0] != mtime:
+            data = {}
+            if mtime is not None:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if not isinstance(data, dict):
+                        raise ValueError("JSON のオブジェクトではありません")
+                    self.service.log(f"監視フォルダの設定を読み込みました: {path}")
+                except (OSError, ValueError) as e:
+                    self.service.log(f"[WARN] 監視フォルダの設定を読めません: {path}: {e}")
+                    data = {}
+            cached = self._settings[folder] = (mtime, data)
+        params = dict(self.defaults)
+        for key in WATCH_SETTING_KEYS:
+            if key in cached[1]:
+                value = cached[1][key]
+                params[key] = ("1" if value else "0") if isinstance(value, bool) else str(value)
+        return params
+
+    # ---- 見つける ----
+    @staticmethod
+    def _is_target(name: str) -> bool:
+        return name.lower().endswith(".pdf") and not name.startswith((".", "~"))
+
+    def _consider(self, folder: str, name: str, st, now: float):
+        entry = self._index[folder].get(name)
+        if entry is not None and (entry.get("size"), entry.get("mtime_ns")) == (st.st_size, st.st_mtime_ns):
+            return  # 処理済み（または処理中）で変わっていない
+        path = os.path.join(folder, name)
+        if path not in self._pending:
+            self._pending[path] = (st.st_size, st.st_mtime_ns, now)
+
+    def _scan(self, folder: str, now: float):
+        seen = set()
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not self._is_target(entry.name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                seen.add(entry.name)
+                self._consider(folder, entry.name, st, now)
+        with self._lock:
+            gone = [n for n in self._index[folder] if n not in seen]
+            for name in gone:
+                del self._index[folder][name]
+        if gone:
+            self._save_index(folder)
+
+    def poll_once(self, changed=None):
+        """1回分の確認。changed は _InotifyWaker.wait() の戻り値（None ならポーリング）。"""
+        now = time.monotonic()
+        for folder in self.folders:
+            try:
+                dir_mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                continue
+            names = (changed or {}).get(folder, set())
+            full = (
+                folder not in self._last_scan
+                or now - self._last_scan[folder] >= WATCH_RESCAN_SEC
+                or names is None
+                # ポーリングでは、ファイルの追加・削除でフォルダの更新時刻が変わったときだけ全体を見る
+                or (changed is None and dir_mtime != self._dir_mtime.get(folder))
+            )
+            if full:
+                try:
+                    self._scan(folder, now)
+                except OSError as e:
+                    self.service.log(f"[WARN] 監視フォルダを読めません: {folder}: {e}")
+                    continue
+                self._dir_mtime[folder] = dir_mtime
+                self._last_scan[folder] = now
+                continue
+            for name in names:
+                if self._is_target(name):
+                    try:
+                        st = os.stat(os.path.join(folder, name))
+                    except OSError:
+                        continue
+                    self._consider(folder, name, st, now)
+        self._check_pending(now)
+
+    def _check_pending(self, now: float):
+        for path, (size, mtime_ns, since) in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                self._pending[path] = (st.st_size, st.st_mtime_ns, now)
+                continue
+            if st.st_size == 0 or now - since < self.stable_sec:
+                continue
+            try:
+                # Windows では書き込み中のファイルは開けない
+                with open(path, "rb"):
+                    pass
+            except OSError:
+                continue
+            if self._enqueue(path, st):
+                del self._pending[path]
+
+    # ---- 処理する ----
+    def _enqueue(self, path: str, st) -> bool:
+        """OCR ジョブに入れる。混んでいて断られたら False（次の確認でもう一度）。"""
+        folder, name = os.path.split(path)
+        out_dir = os.path.join(folder, f"{os.path.splitext(name)[0]}_out")
+        params = self._params(folder)
+        entry = {
+            "size": st.st_size, "mtime_ns": st.st_mtime_ns, "state": JOB_QUEUED, "job": None,
+            "out_dir": out_dir, "queued": time.strftime("%Y-%m-%d %H:%M:%S"), "finished": None, "error": None,
+        }
+        with self._lock:
+            self._index[folder][name] = entry
+        try:
+            status = self.service.submit_pdf(
+                path, out_dir, params, on_change=lambda s: self._on_change(folder, name, entry, params, s)
+            )
+        except ServiceError as e:
+            if e.status == 503:
+                with self._lock:
+                    if self._index[folder].get(name) is entry:
+                        del self._index[folder][name]
+                return False
+            entry.update(state=JOB_FAILED, error=str(e), finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+            self.service.log(f"[ERROR] {path}: {e}")
+            self._save_index(folder)
+            try:
+                os.makedirs(out_dir, exist_ok=True)
+                self._write_status(out_dir, name, entry, params, None)
+            except OSError:
+                pass
+            return True
+        self.service.log(f"監視フォルダ: {path} → ジョブ {status['id']}")
+        self._on_change(folder, name, entry, params, status)
+        return True
+
+    def _on_change(self, folder: str, name: str, entry: dict, params: dict, status: dict):
+        with self._lock:
+            if self._index[folder].get(name) is not entry:
+                return  # 差し替えられた新しい PDF の処理が始まっている
+            if entry["state"] in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+                return
+            entry.update(state=status["state"], job=status["id"], error=status["error"])
+            if status["state"] in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+                entry["finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self._save_index(folder)
+            self._write_status(entry["out_dir"], name, entry, params, status)
+        except OSError as e:
+            self.service.log(f"[WARN] 監視フォルダの状態を書けません: {folder}: {e}")
+
+    def _write_status(self, out_dir: str, name: str, entry: dict, params: dict, status):
+        data = {
+            "source": name, "state": entry["state"], "job": entry["job"], "params": params,
+            "queued": entry["queued"], "finished": entry["finished"], "error": entry["error"],
+        }
+        if status is not None:
+            data.update(
+                elapsed=status["elapsed"], done=status["done"], total=status["total"],
+                files=[f for f in status["files"] if f != WATCH_STATUS_FILE],
+            )
+        self._write_atomic(os.path.join(out_dir, WATCH_STATUS_FILE), json.dumps(data, ensure_ascii=False, indent=1))
+
+    # ---- 監視ループ ----
+    def run(self):
+        self.waker = _InotifyWaker(self.folders)
+        how = "inotify" if self.waker.available else f"{self.poll_sec:g}秒ごとに確認"
+        self.service.log(f"フォルダ監視開始（{how}）: {', '.join(self.folders)}")
+        changed = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll_once(changed)
+                except Exception as e:
+                    self.service.log(f"[WARN] フォルダ監視: {e}")
+                timeout = self.poll_sec
+                if self._pending:
+                    timeout = min(timeout, max(0.5, self.stable_sec / 2))
+                changed = self.waker.wait(timeout) if self.waker.available else None
+                if changed is None:
+                    self._stop.wait(timeout)
+        finally:
+            self.waker.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="watch-folder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_sec + WATCH_DEBOUNCE_SEC + 1)
+
+
+def serve(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="app.py --serve", description="OCR・分割・EPUB のジョブを HTTP で受け付ける／フォルダを監視して OCR する（画面なし）"
+    )
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--host", default="127.0.0.1", help="LAN から使うなら 0.0.0.0（--token も指定すること）")
+    parser.add_argument("--port", type=int, default=SERVICE_DEFAULT_PORT)
+    parser.add_argument("--root", default=SERVICE_ROOT_DIR, help="ジョブの入出力を置くフォルダ")
+    parser.add_argument("--poppler", default=None, help="Poppler の bin フォルダ（省略時は既定の場所か PATH）")
+    parser.add_argument("--max-jobs", type=int, default=SERVICE_MAX_JOBS, help="待機中＋実行中のジョブ数の上限")
+    parser.add_argument("--token", default=None, help="指定すると Authorization: Bearer <token> を要求する")
+    parser.add_argument(
+        "--stub-analyzer", action="store_true", help="YomiToku の代わりに動作確認用のスタブで OCR する"
+    )
+    parser.add_argument(
+        "--no-warm", action="store_true", help="起動時にモデルを読み込まない（最初の OCR ジョブで読み込む）"
+    )
+    parser.add_argument(
+        "--watch", action="append", default=[], metavar="FOLDER",
+        help="このフォルダに置かれた PDF を自動で OCR する（複数指定可。--serve なしなら監視だけ）",
+    )
+    parser.add_argument("--poll", type=float, default=WATCH_POLL_SEC, help="監視フォルダを確認する間隔（秒）")
+    parser.add_argument(
+        "--stable-sec", type=float, default=WATCH_STABLE_SEC, help="この秒数サイズが変わらなければ書き込み完了とみなす"
+    )
+    parser.add_argument("--start", type=int, default=1, help="監視フォルダの既定の開始ページ")
+    parser.add_argument("--end", type=int, default=9999, help="監視フォルダの既定の終了ページ")
+    parser.add_argument("--top", type=float, default=0.0, help="監視フォルダの既定の上端トリミング（%%）")
+    parser.add_argument("--bottom", type=float, default=100.0, help="監視フォルダの既定の下端トリミング（%%）")
+    parser.add_argument("--epub", action="store_true", help="監視フォルダの PDF から下書きEPUBも作る")
+    args = parser.parse_args(argv)
+    if not args.serve and not args.watch:
+        parser.error("--serve か --watch を指定してください")
+    for folder in args.watch:
+        if not os.path.isdir(folder):
+            parser.error(f"監視フォルダがありません: {folder}")
+
+    poppler = args.poppler
+    if not poppler:
+        found = shutil.which("pdftoppm")
+        poppler = DEFAULT_POPPLER_PATH if os.path.isdir(DEFAULT_POPPLER_PATH) or not found else os.path.dirname(found)
+    service = OcrJobService(
+        args.root, poppler, analyzer=StubDocumentAnalyzer() if args.stub_analyzer else None, max_jobs=args.max_jobs
+    )
+    if not args.no_warm:
+        service.warm_up()
+    watcher = None
+    if args.watch:
+        defaults = {
+            "start": str(args.start), "end": str(args.end), "top": str(args.top), "bottom": str(args.bottom),
+            "epub": "1" if args.epub else "0",
+        }
+        watcher = WatchFolderIngest(service, args.watch, defaults, args.poll, args.stable_sec)
+        watcher.start()
+    server = None
+    try:
+        if args.serve:
+            server = make_service_server(service, args.host, args.port, args.token)
+            service.log(f"サービス開始: http://{args.host}:{server.server_address[1]}/（ジョブ: {args.root}）")
+            server.serve_forever()
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if server is not None:
+            server.server_close()
+        service.shutdown()
+
+
 def main():
     root = tk.Tk()
-    UnifiedYomitokuApp(root)
-    root.mainloop()
+    app = UnifiedYomitokuApp(root)
+    try:
+        root.mainloop()
+    finally:
+        app.jobs.shutdown()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if _headless(sys.argv[1:]):
+        serve(sys.argv[1:])
+    else:
+        main()
\ No newline at end of file
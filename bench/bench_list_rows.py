@@ -0,0 +1,173 @@
+"""分割プレビュー（Treeview）と Tab3 スタック一覧（Listbox）の差分更新を、1,000行以上で測る。
+
+実際のウィジェットの代わりに、呼び出し回数を数える偽物を使う（Tk の描画は含まない）。
+実際の Tk では呼び出し1回ごとに Tcl 側の処理と再描画の予約が入るので、呼び出し回数の差がそのまま効く。
+「作り直し」は全行を消して入れ直す以前のやり方。
+
+    python bench/bench_list_rows.py [--rows 1000,5000]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from common import app, best_of
+
+
+class FakeTree:
+    def __init__(self):
+        self.calls = 0
+        self._n = 0
+
+    def insert(self, parent, index, values=()):
+        self.calls += 1
+        self._n += 1
+        return f"I{self._n}"
+
+    def item(self, iid, values=()):
+        self.calls += 1
+
+    def delete(self, *iids):
+        self.calls += 1
+
+
+class FakeListbox:
+    def __init__(self):
+        self.calls = 0
+
+    def insert(self, index, *rows):
+        self.calls += 1
+
+    def delete(self, first, last=None):
+        self.calls += 1
+
+
+def _plan_rows(n):
+    return [(i + 1, f"chunk_{i + 1:04d}.md", f"{(i * 37) % 900 + 10:.1f}", i * 3) for i in range(n)]
+
+
+def _renumber(rows):
+    return [(i + 1,) + tuple(r[1:]) for i, r in enumerate(rows)]
+
+
+def _scenarios(rows):
+    """(名前, 変更後の行) の一覧。いずれも rows を表示している状態からの1回の更新。"""
+    n = len(rows)
+    mid = n // 2
+    swapped = list(rows)
+    swapped[mid], swapped[mid + 1] = swapped[mid + 1], swapped[mid]
+    edited = list(rows)
+    edited[mid] = edited[mid][:2] + ("999.9",) + edited[mid][3:]
+    return [
+        ("末尾に追加", rows + [(n + 1, "new.md", "1.0", 0)]),
+        ("隣と入れ替え", _renumber(swapped)),
+        ("1行の値を変更", edited),
+        ("中ほどの5件を結合", _renumber(rows[:mid] + [(0, "merged.md", "50.0", 0)] + rows[mid + 5:])),
+    ]
+
+
+def _timed_update(setup, update, repeat):
+    """setup() で表示済みの状態を作り、update(state) だけを測る。戻り値: (呼び出し回数, 最短秒数)"""
+    best = None
+    calls = 0
+    for _ in range(repeat):
+        state = setup()
+        widget = state[0]
+        widget.calls = 0
+        t0 = time.perf_counter()
+        update(state)
+        dt = time.perf_counter() - t0
+        calls = widget.calls
+        best = dt if best is None else min(best, dt)
+    return calls, best
+
+
+def bench_tree(n, repeat):
+    rows = _plan_rows(n)
+    print(f"--- Treeview {n:,}行（1回の更新の呼び出し回数 / 時間） ---")
+
+    def _setup_sync():
+        tree = FakeTree()
+        view = app.TreeRows(tree)
+        view.sync(rows)
+        return tree, view
+
+    def _setup_rebuild():
+        tree = FakeTree()
+        return tree, [tree.insert("", "end", values=r) for r in rows]
+
+    for name, new_rows in _scenarios(rows):
+        def _rebuild(state):
+            tree, iids = state
+            tree.delete(*iids)
+            for r in new_rows:
+                tree.insert("", "end", values=r)
+
+        calls, t_sync = _timed_update(_setup_sync, lambda state: state[1].sync(new_rows), repeat)
+        old_calls, t_rebuild = _timed_update(_setup_rebuild, _rebuild, repeat)
+        print(
+            f"  {name:<12} 差分 {calls:>6,}回 {t_sync * 1000:7.2f}ms   "
+            f"作り直し {old_calls:>6,}回 {t_rebuild * 1000:7.2f}ms"
+        )
+
+
+def bench_stack(n, appends, repeat):
+    """Tab3: n 件のスタックにクリップボードから appends 件追加したときの一覧更新。"""
+    tmp = tempfile.mkdtemp()
+    try:
+        stack = app.MergeStackStore(tmp)
+        body = "本文の段落。" * 1000
+        for i in range(n):
+            stack.append(f"{body}{i}")
+        texts = [f"追加{body}{i}" for i in range(appends)]
+
+        def _diff():
+            box = FakeListbox()
+            view = app.ListboxRows(box)
+            view.sync(f"{i + 1}: {lab}" for i, lab in enumerate(stack.labels()))
+            box.calls = 0
+            labels = stack.labels()
+            for i, text in enumerate(texts):
+                labels.append(app.merge_item_label(text))
+                view.sync(f"{k + 1}: {lab}" for k, lab in enumerate(labels))
+            return box.calls
+
+        def _rebuild():
+            # 以前: 追加のたびに全項目の本文から表示用の文字列を作り直し、全行を入れ直す
+            items = [f"{body}{i}" for i in range(n)]
+            box = FakeListbox()
+            for text in texts:
+                items.append(text)
+                box.delete(0, "end")
+                for i, t in enumerate(items):
+                    one = t.replace("\r\n", "\n").replace("\n", " ")
+                    box.insert("end", f"{i + 1}: {one[:80]}{'...' if len(one) > 80 else ''}")
+            return box.calls
+
+        calls = _diff()
+        t_diff = best_of(_diff, repeat)
+        old_calls = _rebuild()
+        t_old = best_of(_rebuild, 1)
+        print(f"--- Tab3 スタック {n:,}件 + 追加 {appends}件（1件 約{len(body) * 3 // 1024}KB） ---")
+        print(f"  差分     {calls:>8,}回 {t_diff:7.3f}s")
+        print(f"  作り直し {old_calls:>8,}回 {t_old:7.3f}s")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1000,5000", help="Treeview の行数（カンマ区切り）")
+    parser.add_argument("--stack", type=int, default=1500, help="Tab3 スタックの件数")
+    parser.add_argument("--appends", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for n in (int(x) for x in args.rows.split(",")):
+        bench_tree(n, args.repeat)
+    bench_stack(args.stack, args.appends, 3)
+
+
+if __name__ == "__main__":
+    t0 = time.perf_counter()
+    main()
+    print(f"（合計 {time.perf_counter() - t0:.1f}s）")
@@ -0,0 +1,39 @@
+"""Tab2-2「ルビ近接」のプレビュー計算（分割案 + ルビ集約）が本の大きさに比例して伸びるかを測る。
+
+ルビ情報は行オフセットの索引を持ち、各チャンクは二分探索で自分の範囲の行・ルビだけを見る。
+チャンクごとに全行を走査していた頃は 章数 × 行数 で伸びていた。
+
+    python bench/bench_split2_ruby.py [--sizes 50,100,200,400,800]
+"""
+import argparse
+
+from common import app, best_of, headless_app, make_book
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="50,100,200,400,800", help="1章あたりの段落数（本の大きさ）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    a = headless_app()
+    compiled = a._split2_get_rules(app.SPLIT2_DEFAULT_RULESET)
+    print(f"{'段落/章':>8} {'大きさ':>10} {'行数':>8} {'チャンク':>8} {'分割案':>9} {'ルビ集約':>9} {'ms/MB':>8}")
+    base = None
+    for paras in (int(x) for x in args.sizes.split(",")):
+        text = make_book(paras=paras)
+        plan = a._split2_build_plan("book.md", None, text, compiled=compiled, quiet=True)
+        t_plan = best_of(lambda: a._split2_build_plan("book.md", None, text, compiled=compiled, quiet=True), args.repeat)
+        t_ruby = best_of(lambda: a._split2_build_chunks_text(text, plan, True), args.repeat)
+        mb = len(text.encode("utf-8")) / (1024 * 1024)
+        per_mb = (t_plan + t_ruby) * 1000 / mb
+        base = base or per_mb
+        print(
+            f"{paras:>8} {mb:>8.2f}MB {text.count(chr(10)):>8,} {len(plan):>8} "
+            f"{t_plan * 1000:>7.1f}ms {t_ruby * 1000:>7.1f}ms {per_mb:>8.1f}"
+        )
+    print(f"（ms/MB がほぼ一定なら大きさに比例。最初の行との比: {per_mb / base:.2f}倍）")
+
+
+if __name__ == "__main__":
+    main()
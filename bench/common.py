@@ -0,0 +1,53 @@
+"""ベンチマーク共通: app.py の読み込みと、計測用の合成 Markdown。"""
+import os
+import random
+import sys
+import time
+
+# 分割・一覧の計測に OCR モデルは使わない（YomiToku・torch がなくても読み込めるように）
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def headless_app():
+    """画面を作らずに UnifiedYomitokuApp のメソッドを呼べるインスタンス。"""
+    obj = app.UnifiedYomitokuApp.__new__(app.UnifiedYomitokuApp)
+    obj._split2_compiled_rules = {}
+    obj.log = lambda msg: None
+    return obj
+
+
+def make_book(chapters: int = 15, paras: int = 200, seed: int = 1) -> str:
+    """目次・本文（章見出し・ルビ行・小さい文字のルビ）・索引のある合成の本。paras で大きさを変える。"""
+    rnd = random.Random(seed)
+    out = ["# 前書き\n\nはじめに本書について。\n\n# 目次\n\n"]
+    for c in range(1, chapters + 1):
+        out.append(f"# {c}<br>第{c}章の題\n\n")
+        out.extend(f"{c}.{k} 節の見出しとその概要説明をここに書く。\n" for k in range(1, 6))
+        out.append("\n")
+    for c in range(1, chapters + 1):
+        out.append(f"# {c}<br>第{c}章 本文\n\n《ポイント》学習の目標\n\n")
+        for k in range(paras * (1 + c % 3)):
+            if k % 17 == 0:
+                out.append("\n<small>あおき しゅうぞう</small>\n\n")
+                out.append(f"外務卿は青木周蔵と会談した{k}。\n\n")
+            elif k % 11 == 0:
+                out.append("かいだん\n\n会談の記録を政府が残した。\n\n")
+            else:
+                out.append(f"本文テキスト{c}-{k}、日本の近代外交について{rnd.randint(0, 999)}述べる。\n")
+        out.append("\n## 小見出し\n\n内容\n\n")
+    out.append("# 人名索引\n\nあ行 青木周蔵\n")
+    return "".join(out)
+
+
+def best_of(fn, repeat: int = 3) -> float:
+    """fn() を repeat 回実行した最短の秒数。"""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
@@ -0,0 +1,72 @@
+"""チャンクJSONL（Batch API）の書き出し → 校正結果から結合 を、OpenAI / Anthropic の出力の形で確かめる。
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+CHUNKS = [("01.md", "# 1\n第一章の本文。\n"), ("02.md", "# 2\n第二章の本文。\n"), ("03.md", "# 3\n第三章の本文。\n")]
+
+
+class ChunkBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def round_trip(self, fmt, truncate):
+        """2番目のチャンクの結果だけ truncate で「出力の上限で途中まで」にして結合する。"""
+        batch = os.path.join(self.tmp, f"{fmt}.jsonl")
+        results = os.path.join(self.tmp, f"{fmt}.results.jsonl")
+        merged = os.path.join(self.tmp, f"{fmt}.md")
+        self.assertEqual(app.write_chunk_batch(batch, CHUNKS, fmt), len(CHUNKS))
+        with open(batch, encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f]
+        app.run_local_batch_stub(batch, results, transform=lambda t: t.replace("本文", "校正済み本文"))
+        with open(results, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        truncate(lines[1])
+        with open(results, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(rec, ensure_ascii=False) + "\n" for rec in lines)
+
+        stats = app.merge_chunk_batch(batch, results, merged)
+        with open(merged, encoding="utf-8") as f:
+            text = f.read()
+        self.assertEqual(stats["corrected"], ["01.md", "03.md"])
+        self.assertEqual(stats["truncated"], ["02.md"])
+        self.assertIn("# 1\n第一章の校正済み本文。\n", text)
+        self.assertIn("# 2\n第二章の本文。\n", text)  # 途中までの結果ではなく元のチャンク
+        self.assertIn("# 3\n第三章の校正済み本文。\n", text)
+        return requests
+
+    def test_openai_length_is_not_merged(self):
+        def _truncate(rec):
+            choice = rec["response"]["body"]["choices"][0]
+            choice["finish_reason"] = "length"
+            choice["message"]["content"] = "# 2\n第二章"
+
+        requests = self.round_trip("openai", _truncate)
+        self.assertGreaterEqual(requests[0]["body"]["max_completion_tokens"], 1024)
+
+    def test_anthropic_max_tokens_is_not_merged(self):
+        def _truncate(rec):
+            message = rec["result"]["message"]
+            message["stop_reason"] = "max_tokens"
+            message["content"] = [{"type": "text", "text": "# 2\n第二章"}]
+
+        requests = self.round_trip("anthropic", _truncate)
+        self.assertLessEqual(requests[0]["params"]["max_tokens"], app.CHUNK_BATCH_MAX_TOKENS["anthropic"])
+
+
+if __name__ == "__main__":
+    unittest.main()
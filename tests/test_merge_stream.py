@@ -0,0 +1,56 @@
+"""Tab3 の一括結合（_merge_stream_files）が、未校正のチャンクから元ファイルをバイト単位で
+復元できることを確かめる。
+
+    python -m unittest discover tests
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class MergeStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.app = app.UnifiedYomitokuApp.__new__(app.UnifiedYomitokuApp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write_chunks(self, chunks):
+        files = []
+        for i, data in enumerate(chunks):
+            path = os.path.join(self.tmp, f"{i:02d}.md")
+            with open(path, "wb") as f:
+                f.write(data)
+            files.append((os.path.basename(path), path, hashlib.sha256(data.lstrip(b"\xef\xbb\xbf")).hexdigest()))
+        return files
+
+    def merge(self, files):
+        out_path = os.path.join(self.tmp, "merged.md")
+        stats = self.app._merge_stream_files(files, out_path)
+        with open(out_path, "rb") as f:
+            return f.read(), stats
+
+    def test_round_trip_without_final_newline(self):
+        source = "# 1<br>第1章\n本文。\n".encode("utf-8"), "# 2<br>第2章\n最後の行".encode("utf-8")
+        merged, stats = self.merge(self.write_chunks(source))
+        self.assertEqual(merged, b"".join(source))
+        self.assertEqual(stats["changed"], [])
+
+    def test_newline_only_between_chunks(self):
+        # 校正でチャンク末尾の改行が消えても、次の見出しが前の行につながらない
+        files = self.write_chunks([b"\xef\xbb\xbf# 1\nA", b"# 2\nB"])
+        merged, _ = self.merge(files)
+        self.assertEqual(merged, b"# 1\nA\n# 2\nB")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Tab2-1 の上限指定モード（partition_by_budget）で、上限を超えるのが「単独で上限より大きい
+ブロック」だけになることを確かめる。
+
+    python -m unittest discover tests
+"""
+import os
+import random
+import sys
+import unittest
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def _groups(sizes, starts):
+    bounds = list(starts) + [len(sizes)]
+    return [sizes[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+class PartitionByBudgetTest(unittest.TestCase):
+    def assert_within_budget(self, sizes, budget):
+        starts = app.partition_by_budget(sizes, budget)
+        self.assertEqual(starts[:1], [0] if sizes else [])
+        self.assertEqual(starts, sorted(set(starts)))
+        for group in _groups(sizes, starts):
+            if sum(group) > budget:
+                self.assertEqual(len(group), 1, (sizes, budget, starts))
+        # グループ数は「超過ブロック＋その間を先頭から詰めた数」より多くならない
+        expected = 0
+        run = []
+        for s in sizes + [None]:
+            if s is None or s > budget:
+                expected += len(app._partition_greedy(run, budget)) + (s is not None)
+                run = []
+            else:
+                run.append(s)
+        self.assertEqual(len(starts), expected, (sizes, budget, starts))
+        return starts
+
+    def test_oversize_block_does_not_raise_other_chunks(self):
+        self.assertEqual(self.assert_within_budget([30, 30, 30, 100], 50), [0, 1, 2, 3])
+        self.assertEqual(self.assert_within_budget([10, 10, 10, 10, 45], 20), [0, 2, 4])
+        self.assertEqual(self.assert_within_budget([100, 10, 10, 200, 30], 25), [0, 1, 3, 4])
+
+    def test_random(self):
+        rng = random.Random(26)
+        for trial in range(500):
+            sizes = [rng.choice((rng.randint(1, 30), rng.randint(1, 120))) for _ in range(rng.randint(0, 40))]
+            budget = rng.randint(10, 80)
+            with self.subTest(trial=trial):
+                self.assert_within_budget(sizes, budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
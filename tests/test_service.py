@@ -0,0 +1,178 @@
+"""サービスモード（app.py --serve）を localhost で動かして確かめる。
+
+YomiToku の代わりに StubDocumentAnalyzer を使い、PDF の画像化（Poppler）も差し替えるので、
+OCR モデルや Poppler がなくても動く。
+
+    python -m unittest discover tests
+"""
+import http.client
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+import zipfile
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from PIL import Image  # noqa: E402
+
+TOKEN = "s3cret"
+PAGES = 3
+
+
+def _fake_convert(pdf_path, first_page, last_page, poppler_path=None):
+    return [Image.new("RGB", (200, 300), "white")]
+
+
+def _fake_pdfinfo(pdf_path, poppler_path=None):
+    return {"Pages": PAGES}
+
+
+class ServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls._saved = {
+            name: getattr(app, name)
+            for name in ("convert_from_path", "pdfinfo_from_path", "EPUB_RENDER_CACHE_DIR", "EPUB_IMAGE_CACHE_DIR")
+        }
+        app.convert_from_path = _fake_convert
+        app.pdfinfo_from_path = _fake_pdfinfo
+        app.EPUB_RENDER_CACHE_DIR = os.path.join(cls.tmp, "render_cache")
+        app.EPUB_IMAGE_CACHE_DIR = os.path.join(cls.tmp, "image_cache")
+        cls.service = app.OcrJobService(
+            os.path.join(cls.tmp, "jobs"), cls.tmp, analyzer=app.StubDocumentAnalyzer(), max_jobs=4
+        )
+        cls.server = app.make_service_server(cls.service, "127.0.0.1", 0, token=TOKEN)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.port = cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.shutdown()
+        for name, value in cls._saved.items():
+            setattr(app, name, value)
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def request(self, method, path, body=None, auth=f"Bearer {TOKEN}"):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        try:
+            conn.putrequest(method, path)
+            if auth is not None:
+                # bytes で渡すと、そのまま（UTF-8 のまま）送られる
+                conn.putheader("Authorization", auth.encode("utf-8"))
+            conn.putheader("Content-Length", str(len(body or b"")))
+            conn.endheaders(body)
+            res = conn.getresponse()
+            data = res.read()
+        finally:
+            conn.close()
+        try:
+            return res.status, json.loads(data)
+        except ValueError:
+            return res.status, data
+
+    def wait_done(self, job_id, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status, job = self.request("GET", f"/jobs/{job_id}")
+            self.assertEqual(status, 200)
+            if job["state"] not in (app.JOB_QUEUED, app.JOB_RUNNING):
+                return job
+            time.sleep(0.05)
+        self.fail(f"job {job_id} did not finish")
+
+    def test_requires_token(self):
+        self.assertEqual(self.request("GET", "/health", auth=None)[0], 401)
+        self.assertEqual(self.request("GET", "/health", auth="Bearer wrong")[0], 401)
+        status, health = self.request("GET", "/health")
+        self.assertEqual(status, 200)
+        self.assertTrue(health["analyzer"])
+
+    def test_non_ascii_token(self):
+        server = app.make_service_server(self.service, "127.0.0.1", 0, token="合言葉")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port, self.port = self.port, server.server_address[1]
+        try:
+            self.assertEqual(self.request("GET", "/health", auth="Bearer 合言葉")[0], 200)
+            self.assertEqual(self.request("GET", "/health", auth="Bearer 合言")[0], 401)
+        finally:
+            self.port = port
+            server.shutdown()
+            server.server_close()
+
+    def test_ocr_split_epub(self):
+        status, job = self.request("POST", f"/jobs/ocr?start=1&end={PAGES}", b"%PDF-1.4 stub")
+        self.assertEqual(status, 202)
+        job = self.wait_done(job["id"])
+        self.assertEqual(job["state"], app.JOB_DONE, job["error"])
+        self.assertEqual((job["done"], job["total"]), (PAGES, PAGES))
+        self.assertIn("output.md", job["files"])
+        self.assertIn("cover.png", job["files"])
+        status, md = self.request("GET", f"/jobs/{job['id']}/files/output.md")
+        self.assertEqual(status, 200)
+        self.assertEqual(md.decode("utf-8").count("スタブ本文"), PAGES)
+
+        status, split = self.request("POST", f"/jobs/split?from={job['id']}")
+        self.assertEqual(status, 202)
+        split = self.wait_done(split["id"])
+        self.assertEqual(split["state"], app.JOB_DONE, split["error"])
+        self.assertGreaterEqual(split["result"]["chunks"], 1)
+
+        status, book = self.request("POST", f"/jobs/epub?from={job['id']}&title=T")
+        self.assertEqual(status, 202)
+        book = self.wait_done(book["id"])
+        self.assertEqual(book["state"], app.JOB_DONE, book["error"])
+        self.assertIn("book.epub", book["files"])
+
+    def test_epub_ignores_images_outside_job(self):
+        secrets = []
+        for name in ("secret.png", "secret2.png"):
+            path = os.path.join(self.tmp, name)
+            with open(path, "wb") as f:
+                f.write(f"TOP-SECRET {name}".encode("utf-8"))
+            secrets.append(path)
+        md = f"# 1\n\n![](../../secret.png)\n\n![]({secrets[1]})\n\n![](file.png/../../../secret.png)\n"
+        images = urllib.parse.quote("そのまま")
+        status, job = self.request("POST", f"/jobs/epub?images={images}&title=T", md.encode("utf-8"))
+        self.assertEqual(status, 202)
+        job = self.wait_done(job["id"])
+        self.assertEqual(job["state"], app.JOB_DONE, job["error"])
+        status, data = self.request("GET", f"/jobs/{job['id']}/files/book.epub")
+        self.assertEqual(status, 200)
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            self.assertFalse([n for n in z.namelist() if "images/" in n])
+            for name in z.namelist():
+                self.assertNotIn(b"TOP-SECRET", z.read(name), name)
+
+    def test_events_stream_until_end(self):
+        status, job = self.request("POST", "/jobs/ocr", b"%PDF-1.4 stub")
+        self.assertEqual(status, 202)
+        status, body = self.request("GET", f"/jobs/{job['id']}/events")
+        self.assertEqual(status, 200)
+        blocks = [b for b in body.decode("utf-8").split("\n\n") if b.strip()]
+        self.assertTrue(blocks[-1].startswith("event: end"), blocks[-1])
+        self.assertEqual(self.wait_done(job["id"])["state"], app.JOB_DONE)
+
+    def test_errors(self):
+        self.assertEqual(self.request("POST", "/jobs/unknown")[0], 404)
+        self.assertEqual(self.request("POST", "/jobs/ocr")[0], 400)
+        self.assertEqual(self.request("POST", "/jobs/split?from=nope")[0], 404)
+        self.assertEqual(self.request("GET", "/jobs/nope")[0], 404)
+        status, job = self.request("POST", "/jobs/ocr", b"%PDF-1.4 stub")
+        self.wait_done(job["id"])
+        self.assertEqual(self.request("GET", f"/jobs/{job['id']}/files/../../secret")[0], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
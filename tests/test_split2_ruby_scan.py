@@ -0,0 +1,202 @@
+"""Tab2-2 のルビ行判定（1回の走査で行を分類する版）が、以前の1行ずつ正規表現で調べる実装と
+同じ結果になることを、ランダムに作った入力で確かめる。
+
+    python -m unittest discover tests
+"""
+import os
+import random
+import re
+import sys
+import unittest
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+# ---- 以前の実装（比較の基準。行ごとにタグ除去と正規表現の判定をやり直す） ----
+def _ref_strip_html_tags(s: str) -> str:
+    return re.sub(r"<[^>]+>", "", s)
+
+
+def _ref_ruby_candidate_line(raw_line: str) -> str:
+    txt = _ref_strip_html_tags(raw_line).strip()
+    if not txt:
+        return ""
+    if re.search(r"[一-鿿]", txt):
+        return ""
+    if len(txt) <= 24 and re.fullmatch(r"[ぁ-ゖァ-ヶー]+", txt):
+        return txt
+    norm = txt.replace("　", " ").strip()
+    if " " in norm and len(norm) <= 120 and re.fullmatch(r"[ぁ-ゖァ-ヶー ]+", norm):
+        norm = re.sub(r"\s{2,}", " ", norm).strip()
+        if len(norm) >= 3:
+            return norm
+    raw_low = raw_line.lower()
+    if ("<small" in raw_low) or ("font-size" in raw_low):
+        if len(norm) <= 200 and re.fullmatch(r"[ぁ-ゖァ-ヶー ]+", norm):
+            norm = re.sub(r"\s{2,}", " ", norm).strip()
+            return norm
+    return ""
+
+
+def _ref_ruby_info(full_content: str) -> dict:
+    lines = full_content.splitlines(keepends=True)
+    ruby_to_base = {}
+    ruby_text = {}
+    n = len(lines)
+    for i in range(n):
+        cand = _ref_ruby_candidate_line(lines[i])
+        if not cand:
+            continue
+        j = i + 1
+        found = None
+        seen_nonempty = 0
+        while j < n and seen_nonempty < 8:
+            s = _ref_strip_html_tags(lines[j]).strip()
+            if s == "":
+                j += 1
+                continue
+            seen_nonempty += 1
+            if re.search(r"[一-龠々]{2,}", s):
+                found = j
+                break
+            j += 1
+        if found is None:
+            continue
+        if not re.search(r"[一-龠々]{2,}", _ref_strip_html_tags(lines[found]).strip()):
+            continue
+        ruby_to_base[i] = found
+        ruby_text[i] = cand
+    return {"lines": lines, "ruby_line_set": set(ruby_to_base), "ruby_to_base": ruby_to_base, "ruby_text": ruby_text}
+
+
+def _ref_transform_chunk(app_obj, start: int, end: int, ruby_info: dict) -> str:
+    """以前の _split2_transform_chunk_ruby_to_header（全行・全ルビを毎チャンク走査する版）。"""
+    lines = ruby_info["lines"]
+    offsets = []
+    pos = 0
+    for ln in lines:
+        offsets.append(pos)
+        pos += len(ln)
+    ruby_line_set = ruby_info["ruby_line_set"]
+    ruby_to_base = ruby_info["ruby_to_base"]
+    ruby_text = ruby_info["ruby_text"]
+
+    out_lines = []
+    orig_to_outpos = {}
+    skip_next_blank = False
+    for i, ln in enumerate(lines):
+        off = offsets[i]
+        if off < start:
+            continue
+        if off >= end:
+            break
+        if skip_next_blank:
+            if _ref_strip_html_tags(ln).strip() == "":
+                skip_next_blank = False
+                continue
+            skip_next_blank = False
+        if i in ruby_line_set:
+            skip_next_blank = True
+            continue
+        orig_to_outpos[i] = len(out_lines)
+        out_lines.append(ln)
+
+    base_to_rubies = {}
+    for ruby_i, base_i in ruby_to_base.items():
+        if not (start <= offsets[base_i] < end):
+            continue
+        t = ruby_text.get(ruby_i, "").strip()
+        if not t:
+            continue
+        base_to_rubies.setdefault(base_i, [])
+        if t not in base_to_rubies[base_i]:
+            base_to_rubies[base_i].append(t)
+
+    for base_i in sorted(base_to_rubies.keys(), key=lambda x: orig_to_outpos.get(x, -1), reverse=True):
+        pos = orig_to_outpos.get(base_i, None)
+        if pos is None:
+            continue
+        ruby_line = " ".join(base_to_rubies[base_i]).strip()
+        if not ruby_line:
+            continue
+        new_line, ok = app_obj._split2_try_inject_ruby_into_line(out_lines[pos], ruby_line)
+        if ok:
+            out_lines[pos] = new_line
+        else:
+            out_lines.insert(pos, ruby_line + "\n")
+    return re.sub(r"\n{3,}", "\n\n", "".join(out_lines))
+
+
+PIECES = [
+    "あおき", "しゅうぞう", "カタカナ", "ー", "　", " ", "  ", "<small>", "</small>", "<SMALL>",
+    "<span style='font-size:8px'>", "</span>", "青木周蔵", "々々", "会談", "外務卿", "は", "が", "x", "1", "\t", "漢",
+    "<br>", "#", "ゔ", "ヵ", "〆",
+]
+
+
+def _random_text(rnd: random.Random) -> str:
+    lines = []
+    for _ in range(rnd.randint(1, 120)):
+        if rnd.random() < 0.25:
+            lines.append(rnd.choice(["", " ", "<small></small>"]))
+        else:
+            lines.append("".join(rnd.choice(PIECES) for _ in range(rnd.randint(1, 8))))
+    return "\n".join(lines) + rnd.choice(["", "\n", "\r\n"])
+
+
+class RubyScanEquivalenceTest(unittest.TestCase):
+    TRIALS = 400
+
+    def setUp(self):
+        self.app = app.UnifiedYomitokuApp.__new__(app.UnifiedYomitokuApp)
+        self.app._split2_compiled_rules = {}
+        self.app.log = lambda msg: None
+
+    def test_same_as_reference(self):
+        rnd = random.Random(29)
+        for trial in range(self.TRIALS):
+            text = _random_text(rnd)
+            with self.subTest(trial=trial):
+                for line in text.splitlines(keepends=True):
+                    self.assertEqual(
+                        self.app._split2_get_ruby_candidate_line(line), _ref_ruby_candidate_line(line), repr(line)
+                    )
+                got = self.app._split2_build_ruby_info(text)
+                want = _ref_ruby_info(text)
+                for key in ("lines", "ruby_line_set", "ruby_to_base", "ruby_text"):
+                    self.assertEqual(got[key], want[key], key)
+
+    def test_book_chunks_unchanged(self):
+        """合成の本を章ごとに分割し、チャンクごとのルビ集約結果が以前の実装と一致する。"""
+        rnd = random.Random(1)
+        lines = []
+        for k in range(600):
+            if k % 40 == 0:
+                lines += [f"# {k // 40 + 1}<br>第{k // 40 + 1}章", ""]
+            r = rnd.random()
+            if r < 0.1:
+                lines += ["<small>あおき しゅうぞう</small>", "", f"外務卿は青木周蔵と会談した{k}。"]
+            elif r < 0.2:
+                lines += ["かいだん", "", "# 見出し", "会談の記録を政府が残した。"]
+            else:
+                lines.append(f"本文{k}、日本の近代外交について述べる。")
+        text = "\n".join(lines) + "\n"
+        compiled = self.app._split2_get_rules(app.SPLIT2_DEFAULT_RULESET)
+        plan = self.app._split2_build_plan("book.md", None, text, compiled, quiet=True)
+        self.assertGreater(len(plan), 10)
+
+        got, _, info = self.app._split2_build_chunks_text(text, plan, True)
+        want_info = _ref_ruby_info(text)
+        self.assertEqual(info["ruby_to_base"], want_info["ruby_to_base"])
+        self.assertGreater(len(info["ruby_to_base"]), 50)
+        want = [_ref_transform_chunk(self.app, int(it["start"]), int(it["end"]), want_info) for it in plan]
+        self.assertEqual(len(got), len(want))
+        for i, (g, w) in enumerate(zip(got, want)):
+            self.assertEqual(g, w, f"chunk {i}")
+        self.assertTrue(any("（" in g for g in got))
+
+if __name__ == "__main__":
+    unittest.main()
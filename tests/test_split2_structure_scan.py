@@ -0,0 +1,133 @@
+"""Tab2-2 の本文構造の検出（結合パターン1回の走査）が、以前の規則ごとに正規表現で探す実装と
+同じ分割計画を作ることを、ランダムに作った入力で確かめる（既定の「放送大学（15章）」ルール）。
+
+    python -m unittest discover tests
+"""
+import os
+import random
+import re
+import sys
+import unittest
+
+os.environ.setdefault("YOMITOKU_STUB_ANALYZER", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+# ---- 以前の実装（比較の基準。規則ごとに全文を探し直す） ----
+def _ref_body_start(full_content: str) -> int:
+    candidates = list(re.compile(r"(?m)^#\s+1(?:<br>|\s|$)").finditer(full_content))
+    if not candidates:
+        return 0
+    keyword_pattern = re.compile(r"《.*(?:ポイント|目標).*》")
+    for m in candidates:
+        if keyword_pattern.search(full_content[m.end():m.end() + 1000]):
+            return m.start()
+    toc_match = re.search(r"(?m)^#\s+目次", full_content)
+    if toc_match:
+        for m in candidates:
+            if m.start() > toc_match.end():
+                return m.start()
+    if len(candidates) >= 2:
+        return candidates[1].start()
+    return candidates[0].start()
+
+
+def _ref_plan(full_content: str) -> list:
+    total_length = len(full_content)
+    body_start_pos = _ref_body_start(full_content)
+    cut_points = [0, total_length, body_start_pos]
+    chapter_matches = list(re.compile(r"(?m)^(?:#\s*)?(\d+)(?:<br>|\s+#)").finditer(full_content, body_start_pos))
+    chapter_map = {}
+    for m in chapter_matches:
+        cut_points.append(m.start())
+        chapter_map[m.start()] = int(m.group(1))
+
+    idx_split_pos = -1
+    start_pos_15 = next((m.start() for m in chapter_matches if int(m.group(1)) == 15), -1)
+    if start_pos_15 != -1:
+        index_match = re.compile(r"(?m)^#\s+人名索引.*").search(full_content[start_pos_15:])
+        if index_match:
+            idx_split_pos = start_pos_15 + index_match.start()
+            cut_points.append(idx_split_pos)
+
+    cut_points = sorted(set(p for p in cut_points if 0 <= p <= total_length))
+    used = set()
+    plan = []
+    for start, end in zip(cut_points, cut_points[1:]):
+        if start == 0:
+            name, tag = "00_前書き・目次.md", "front"
+        elif idx_split_pos != -1 and start == idx_split_pos:
+            name, tag = "16_索引・その他.md", "index"
+        elif start in chapter_map:
+            num = chapter_map[start]
+            name, tag = f"{num:02d}_第{num}章.md", f"chapter {num}"
+        else:
+            name, tag = f"unknown_{start}.md", "unknown"
+        base, ext = os.path.splitext(name)
+        counter = 1
+        while name in used:
+            name = f"{base}_{counter}{ext}"
+            counter += 1
+        used.add(name)
+        plan.append((start, end, name, tag))
+    return plan
+
+
+LINES = [
+    "# 1<br>はじめに", "# 1 はじめに", "#  1", "# 1", "1<br>序", "# 2<br>二章", "3 # 三章", "# 15<br>終章", "15 #",
+    "# 目次", "#　目次", "# 人名索引", "# 人名索引《ポイント》", "《ポイント》", "《学習目標》", "《ポイント》の説明》",
+    "本文《目標", "》", "#", "", "", "本文です。", "# 見出し", "12<br>", "# 16<br>付録",
+]
+
+
+def _random_text(rnd: random.Random) -> str:
+    lines = []
+    for _ in range(rnd.randint(0, 60)):
+        r = rnd.random()
+        if r < 0.6:
+            lines.append(rnd.choice(LINES))
+        elif r < 0.8:
+            # 目印の窓（1000文字）の境目をまたぐように、長さのばらばらな本文を挟む
+            lines.append("あ" * rnd.choice((rnd.randint(0, 40), rnd.randint(900, 1100))))
+        else:
+            lines.append(rnd.choice(LINES) + rnd.choice(["", " ", "<br>", "あ" * rnd.randint(980, 1010) + "》"]))
+    return "\n".join(lines) + rnd.choice(["", "\n"])
+
+
+class StructureScanEquivalenceTest(unittest.TestCase):
+    TRIALS = 600
+
+    def setUp(self):
+        self.app = app.UnifiedYomitokuApp.__new__(app.UnifiedYomitokuApp)
+        self.app._split2_compiled_rules = {}
+        self.app.log = lambda msg: None
+        self.compiled = self.app._split2_get_rules(app.SPLIT2_DEFAULT_RULESET)
+
+    def plan(self, text):
+        plan = self.app._split2_build_plan("book.md", None, text, self.compiled, quiet=True)
+        return [(it["start"], it["end"], it["name"], it["tag"]) for it in plan]
+
+    def test_same_as_reference(self):
+        rnd = random.Random(33)
+        for trial in range(self.TRIALS):
+            text = _random_text(rnd)
+            with self.subTest(trial=trial):
+                self.assertEqual(
+                    self.app._split2_find_body_start_pos(text, compiled=self.compiled, quiet=True), _ref_body_start(text)
+                )
+                self.assertEqual(self.plan(text), _ref_plan(text))
+
+    def test_keyword_edge_cases(self):
+        # 目印が窓の終わりをまたいでも、窓の中で閉じる短い一致があれば本文開始とみなす
+        text = "# 1<br>本文\n" + "あ" * 970 + "《ポイント》" + "い" * 40 + "》\n# 1 付録\n# 1 索引\n"
+        self.assertEqual(_ref_body_start(text), 0)
+        self.assertEqual(self.app._split2_find_body_start_pos(text, compiled=self.compiled, quiet=True), 0)
+        # 索引行の中の目印も数える
+        text = "# 目次\n# 1<br>目次の項目\n# 1<br>本文\n# 人名索引《ポイント》\n"
+        self.assertEqual(self.plan(text), _ref_plan(text))
+
+
+if __name__ == "__main__":
+    unittest.main()